@@ -1,18 +1,14 @@
 from flask import Flask, request, current_app
 from config import Config
 from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
 from flask_login import LoginManager
 from flask_mail import Mail
 from flask_bootstrap import Bootstrap # This is responsive !!
 from flask_moment import Moment
 from flask_babel import Babel
-import logging
-from logging.handlers import SMTPHandler, RotatingFileHandler # StreamHandler
-import os
-from elasticsearch import Elasticsearch
-from redis import Redis
-import rq
+from app import replicas
+from functools import cached_property
+import click
 # from rq import Worker, Queue, Connection
 # import os
 # from urllib.parse import urlparse
@@ -20,8 +16,8 @@ import rq
 def get_locale():
     return request.accept_languages.best_match(current_app.config['LANGUAGES'])
 
-db = SQLAlchemy()
-migrate = Migrate()
+db = SQLAlchemy(session_options={'class_': replicas.RoutingSession}) # reads can go to a replica, see app/replicas.py
+replicas.listen(db.session)
 login = LoginManager()
 login.login_view = 'auth.login'
 mail = Mail()
@@ -29,21 +25,63 @@ bootstrap = Bootstrap()
 moment = Moment()
 babel = Babel()
 
+
+# clients that not every process uses are made on first use, so the imports behind them (elasticsearch,
+# rq, alembic) don't slow down the start of every web worker, task worker and flask command
+class RohanApp(Flask):
+    @cached_property
+    def elasticsearch(self):
+        if not self.config['ELASTICSEARCH_URL']:
+            return None # None during unit testing
+        from elasticsearch import Elasticsearch
+        return Elasticsearch([self.config['ELASTICSEARCH_URL']])
+
+    @cached_property
+    def redis(self):
+        from app import instrumentation
+        return instrumentation.InstrumentedRedis.from_url(self.config['REDIS_URL']) # a Redis that times its calls
+
+    @cached_property
+    def task_queues(self):
+        from app import task_queues
+        return task_queues.create_queues(self)
+
+    @property
+    def task_queue(self):
+        return self.task_queues['default']
+
+
+class MigrateGroup(click.Group):
+    # stands in for Flask-Migrate's "flask db" group, which is only imported (with alembic) when a
+    # db command is looked up
+    def _commands(self):
+        if 'migrate' not in current_app.extensions:
+            from flask_migrate import Migrate
+            Migrate(current_app._get_current_object(), db)
+        from flask_migrate.cli import db as db_commands
+        return db_commands
+
+    def list_commands(self, ctx):
+        return self._commands().list_commands(ctx)
+
+    def get_command(self, ctx, name):
+        return self._commands().get_command(ctx, name)
+
+
 def create_app(config_class=Config):
-    app = Flask(__name__)
+    app = RohanApp(__name__)
     app.config.from_object(config_class)
 
+    replicas.configure(app) # pool options, and the replica bind if there is one
     db.init_app(app)
-    migrate.init_app(app, db)
+    app.cli.add_command(MigrateGroup('db', help='Perform database migrations.'))
     login.init_app(app)
     mail.init_app(app)
     bootstrap.init_app(app)
     moment.init_app(app)
     babel.init_app(app, locale_selector=get_locale)
-    app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) \
-        if app.config['ELASTICSEARCH_URL'] else None # None during unit testing
     # print('THE REDIS_URL CONFIG VAR IS: ' + app.config['REDIS_URL'])
-    app.redis = Redis.from_url(app.config['REDIS_URL'])
+    from app import instrumentation
     # listen = ['high', 'default', 'low']
     # REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379')
     # app.conn = Redis.from_url(REDIS_URL)
@@ -51,7 +89,11 @@ def create_app(config_class=Config):
     # urlparse.uses_netloc.append('redis')
     # url = urlparse(REDIS_URL)
     # app.conn = Redis(host=url.hostname, port=url.port, db=0, password=url.password)
-    app.task_queue = rq.Queue('rohanapp-tasks', connection=app.redis)
+    instrumentation.init_app(app) # Server-Timing headers and slow request logging
+    from app import metrics
+    metrics.init_app(app) # request, cache and job counters for /metrics
+    from app import profiler
+    profiler.init_app(app) # only if PROFILER_* settings ask for it
 
     # if __name__ == '__main__':
     #    with Connection(app.conn):
@@ -70,38 +112,8 @@ def create_app(config_class=Config):
     from app.api import bp as api_bp
     app.register_blueprint(api_bp, url_prefix='/api')
 
-    if not app.debug and not app.testing:
-        if app.config['MAIL_SERVER']:
-            auth = None
-            if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
-                auth = (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
-            secure = None
-            if app.config['MAIL_USE_TLS']:
-                secure = ()
-            mail_handler = SMTPHandler(
-                mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
-                fromaddr='no-reply@' + app.config['MAIL_SERVER'],
-                toaddrs=app.config['ADMINS'],
-                subject='RohanApp Failure', # ideally only 500 errors
-                credentials=auth,
-                secure=secure)
-            mail_handler.setLevel(logging.ERROR) # only errors, not warnings
-            app.logger.addHandler(mail_handler)
-    
-        if app.config['LOG_TO_STDOUT']:
-            stream_handler = logging.StreamHandler()
-            stream_handler.setLevel(logging.INFO)
-            app.logger.addHandler(stream_handler)
-        else:
-            if not os.path.exists('logs'):
-                os.mkdir('logs')
-            file_handler = RotatingFileHandler('logs/rohanapp.log', maxBytes=10240, backupCount=10)
-            file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
-            file_handler.setLevel(logging.INFO)
-            app.logger.addHandler(file_handler)
-
-        app.logger.setLevel(logging.INFO) # records each instance of the app starting up
-        app.logger.info('RohanApp startup')
+    from app import log
+    log.init_app(app) # request ids, and outside debug and testing the queued file/stdout/email logging
 
     return app
 
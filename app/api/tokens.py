@@ -1,5 +1,18 @@
+from flask import jsonify
+from app import db
+from app.api import bp
+from app.api.auth import basic_auth, token_auth
+
+@bp.route('/tokens', methods=['POST'])
+@basic_auth.login_required
 def get_token():
-    pass
+    token = basic_auth.current_user().get_token()
+    db.session.commit() # also saves a password hash upgraded by check_password
+    return jsonify({'token': token})
 
+@bp.route('/tokens', methods=['DELETE'])
+@token_auth.login_required
 def revoke_token():
-    pass
\ No newline at end of file
+    token_auth.current_user().revoke_token(token_auth.get_auth().token) # the one this request used
+    db.session.commit()
+    return '', 204 # no content
@@ -3,12 +3,18 @@ from flask import jsonify, request, url_for
 from app.models import User
 from app import db
 from app.api.errors import bad_request
+from app.api.auth import token_auth
+from app.replicas import replica
 
 @bp.route('/users/<int:id>', methods=['GET']) # Why not just <id> like <username>?
+@token_auth.login_required
+@replica
 def get_user(id):
     return jsonify(User.query.get_or_404(id).to_dict())
 
 @bp.route('/users', methods=['GET'])
+@token_auth.login_required
+@replica
 def get_users():
     page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 10, type=int), 100) # Why not just app.config['POSTS_PER_PAGE']?
@@ -16,6 +22,8 @@ def get_users():
     return jsonify(data)
 
 @bp.route('/users/<int:id>/followers', methods=['GET'])
+@token_auth.login_required
+@replica
 def get_followers(id):
     user = User.query.get_or_404(id)
     page = request.args.get('page', 1, type=int)
@@ -24,6 +32,8 @@ def get_followers(id):
     return jsonify(data)
 
 @bp.route('/users/<int:id>/followed', methods=['GET'])
+@token_auth.login_required
+@replica
 def get_followed(id):
     user = User.query.get_or_404(id)
     page = request.args.get('page', 1, type=int)
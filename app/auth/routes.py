@@ -23,6 +23,7 @@ def login():
             flash('Invalid username or password')
             return redirect(url_for('auth.login'))
         login_user(user, remember=form.remember_me.data)
+        db.session.commit() # in case check_password upgraded the hash
         next_page = request.args.get('next')
         if not next_page or urlsplit(next_page).netloc != '': # urlsplit(next_page).netloc is nonempty if next_page is absolute URL
             next_page = url_for('main.index')
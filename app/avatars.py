@@ -0,0 +1,94 @@
+from flask import current_app, url_for
+from hashlib import md5
+import os
+import re
+import struct
+import tempfile
+import zlib
+
+# avatars are drawn from the MD5 digest of the email, which is stored with the user (User.email_digest)
+# by default they come from gravatar.com; with LOCAL_AVATARS the app draws the same kind of identicon
+# itself, so pages don't wait on a third party: each PNG is generated once per digest and size, kept in
+# AVATAR_DIR, and served with headers that let browsers keep it, since the URL changes with the email
+# only the sizes the pages use are drawn, and only for digests of existing users, so requests can't fill
+# the disk; the scheduler's prune_avatars job deletes the files of digests no user has any more
+
+DIGEST = re.compile('^[0-9a-f]{32}$')
+SIZES = [24, 64, 70, 128, 175] # pixels, as in the templates and the API
+CACHE_MAX_AGE = 365 * 24 * 3600 # seconds
+FILENAME = re.compile(r'^([0-9a-f]{32})-(\d+)\.png$')
+
+def email_digest(email):
+    return md5((email or '').lower().encode('utf-8')).hexdigest()
+
+def avatar_url(digest, size):
+    if current_app.config['LOCAL_AVATARS']:
+        # the smallest drawn size that is large enough
+        return url_for('main.avatar', digest=digest, size=min([s for s in SIZES if s >= size] or [SIZES[-1]]))
+    return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(digest, size)
+
+def _chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+def identicon(digest, size):
+    # PNG of a 5x5 grid, mirrored left to right, cells and colour picked by the digest
+    digest = bytes.fromhex(digest)
+    colour = bytes([64 + digest[13] % 160, 64 + digest[14] % 160, 64 + digest[15] % 160])
+    background = b'\xf0\xf0\xf0'
+    margin = size // 10
+    inner = max(size - 2 * margin, 5)
+    cells = [[digest[row * 3 + min(column, 4 - column)] & 1 for column in range(5)] for row in range(5)]
+    columns = [min((x - margin) * 5 // inner, 4) if margin <= x < margin + inner else None for x in range(size)]
+    lines = []
+    for y in range(size):
+        row = min((y - margin) * 5 // inner, 4) if margin <= y < margin + inner else None
+        line = b''.join(colour if row is not None and column is not None and cells[row][column] else background
+                        for column in columns)
+        lines.append(b'\x00' + line) # no filter
+    header = struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0) # 8-bit RGB
+    return b'\x89PNG\r\n\x1a\n' + _chunk(b'IHDR', header) + _chunk(b'IDAT', zlib.compress(b''.join(lines), 9)) + \
+        _chunk(b'IEND', b'')
+
+def path(digest, size, known):
+    # the cached PNG, drawn first if it isn't there yet and known(digest) says a user has the digest,
+    # None if no user has it
+    directory = os.path.join(current_app.config['AVATAR_DIR'], digest[:2])
+    filename = os.path.join(directory, '{}-{}.png'.format(digest, size))
+    if not os.path.exists(filename):
+        if not known(digest):
+            return None
+        os.makedirs(directory, exist_ok=True)
+        fd, temporary = tempfile.mkstemp(dir=directory, prefix='.avatar-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(identicon(digest, size))
+        os.chmod(temporary, 0o644)
+        os.replace(temporary, filename) # workers drawing the same avatar at once each write a whole file
+    return filename
+
+def prune(known_digests, batch_size=500):
+    # deletes the files of digests that known_digests(digests) doesn't return (no user has them any more),
+    # and of sizes that are no longer drawn; returns how many were deleted
+    directory = current_app.config['AVATAR_DIR']
+    if not os.path.isdir(directory):
+        return 0
+    files = {} # digest -> [(path, size)]
+    for subdirectory in os.listdir(directory):
+        for name in os.listdir(os.path.join(directory, subdirectory)):
+            match = FILENAME.match(name)
+            if match:
+                files.setdefault(match.group(1), []).append((os.path.join(directory, subdirectory, name),
+                                                              int(match.group(2))))
+    digests = sorted(files)
+    deleted = 0
+    for first in range(0, len(digests), batch_size):
+        batch = digests[first:first + batch_size]
+        known = known_digests(batch)
+        for digest in batch:
+            for filename, size in files[digest]:
+                if digest not in known or size not in SIZES:
+                    try:
+                        os.remove(filename)
+                        deleted += 1
+                    except FileNotFoundError:
+                        pass
+    return deleted
@@ -1,5 +1,7 @@
 import os
+import time
 import click
+import redis
 
 def register(app):
     @app.cli.group()
@@ -32,5 +34,156 @@ def register(app):
             raise RuntimeError('init command failed')
         os.remove('messages.pot')
 
+    @app.cli.group()
+    def suggestions():
+        """Follow suggestion commands."""
+        pass
+
+    @suggestions.command()
+    @click.option('--now', is_flag=True, help='Compute in this process instead of the task queue.')
+    def rebuild(now):
+        """Recompute follow suggestions for all users."""
+        try:
+            if now:
+                from app import suggestions as follow_suggestions
+                click.echo('Computed suggestions for {} users'.format(follow_suggestions.compute_all()))
+            else:
+                from app import task_queues
+                task_queues.enqueue('bulk', 'app.tasks.compute_follow_suggestions', job_timeout=3600)
+                click.echo('Queued suggestion rebuild')
+        except redis.exceptions.RedisError as e:
+            click.echo('Could not rebuild suggestions, Redis is unavailable: {}'.format(e))
+
+    @app.cli.group()
+    def conversations():
+        """Conversation summary commands."""
+        pass
+
+    @conversations.command()
+    def backfill():
+        """Rebuild conversation summaries from existing messages."""
+        from app import db
+        from app.models import Conversation
+        count = Conversation.backfill()
+        db.session.commit()
+        click.echo('Rebuilt {} conversation summaries'.format(count))
+
+    @app.cli.group()
+    def scheduler():
+        """Periodic maintenance commands."""
+        pass
+
+    @scheduler.command()
+    def start():
+        """Start the maintenance tick on the task queue, unless it is running."""
+        from app import scheduler as maintenance
+        click.echo('Scheduler started' if maintenance.start() else 'Scheduler already running')
+
+    @scheduler.command()
+    @click.argument('name')
+    def run(name):
+        """Run one maintenance job now, in this process."""
+        from app import scheduler as maintenance
+        if name not in maintenance.JOBS:
+            raise click.ClickException('no such job, choose from ' + ', '.join(maintenance.JOBS))
+        click.echo('{} returned {}'.format(name, maintenance.run_job(name)))
+
+    @scheduler.command()
+    def stats():
+        """Show run counts and times of the maintenance jobs."""
+        from app import scheduler as maintenance
+        for name, fields in maintenance.stats().items():
+            runs = int(float(fields.get(b'runs', 0)))
+            click.echo('{:<22} runs {:>5}  failures {:>3}  last {:>8.2f}s  mean {:>8.2f}s  last result {}'.format(
+                name, runs, int(float(fields.get(b'failures', 0))), float(fields.get(b'last_seconds', 0)),
+                float(fields.get(b'total_seconds', 0)) / runs if runs else 0.0,
+                fields.get(b'last_result', b'').decode()))
+
+    @app.cli.group()
+    def profile():
+        """Sampling profiler reports."""
+        pass
+
+    @profile.command()
+    @click.option('--endpoint', multiple=True, help='Only this endpoint (repeatable, default: all).')
+    @click.option('--hours', type=float, help='Only profiles from the last this many hours.')
+    @click.option('--count', default=20, help='Number of functions to show.')
+    def top(endpoint, hours, count):
+        """Show the functions with the most samples."""
+        from app import profiler
+        stacks, files = profiler.load(app.config['PROFILER_DIR'], endpoint, hours and time.time() - 3600 * hours)
+        total = sum(stacks.values()) or 1
+        click.echo('{} samples from {} profiles'.format(sum(stacks.values()), files))
+        click.echo('{:>7} {:>7}  {}'.format('self %', 'total %', 'function'))
+        for frame, own, inclusive in profiler.top(stacks, count):
+            click.echo('{:>7.1f} {:>7.1f}  {}'.format(100.0 * own / total, 100.0 * inclusive / total, frame))
+
+    @profile.command()
+    @click.option('--endpoint', multiple=True, help='Only this endpoint (repeatable, default: all).')
+    @click.option('--hours', type=float, help='Only profiles from the last this many hours.')
+    @click.option('--output', default='flamegraph.svg', help='SVG file to write.')
+    @click.option('--collapsed', help='Also write the merged stacks to this file, e.g. for speedscope.')
+    def flamegraph(endpoint, hours, output, collapsed):
+        """Merge profiles into a flame graph."""
+        from app import profiler
+        stacks, files = profiler.load(app.config['PROFILER_DIR'], endpoint, hours and time.time() - 3600 * hours)
+        if not stacks:
+            raise click.ClickException('no profiles found in ' + app.config['PROFILER_DIR'])
+        with open(output, 'w') as f:
+            f.write(profiler.flamegraph(stacks, title=', '.join(endpoint) or 'all endpoints'))
+        if collapsed:
+            with open(collapsed, 'w') as f:
+                f.writelines('{} {}\n'.format(stack, count) for stack, count in stacks.most_common())
+        click.echo('Wrote {} from {} profiles'.format(output, files))
+
+    @app.cli.group()
+    def perf():
+        """Performance diagnostics."""
+        pass
+
+    @perf.command()
+    @click.option('--username', help='User to build the queries for (default: first user).')
+    @click.option('--analyze', is_flag=True, help='Run the queries (EXPLAIN ANALYZE, PostgreSQL only).')
+    def explain(username, analyze):
+        """Show the query plans of the hot queries."""
+        from app import db
+        from app.models import User, Post, Notification, Task, Conversation, Message
+        user = User.query.filter_by(username=username).first() if username else User.query.first()
+        if user is None:
+            raise click.ClickException('no such user')
+        other = User.query.filter(User.id != user.id).first() or user
+        queries = {
+            'followed_posts': user.followed_posts().limit(10),
+            'user_posts': user.posts.order_by(Post.timestamp.desc()).limit(10),
+            'explore': Post.query.order_by(Post.timestamp.desc()).limit(10),
+            'is_following': user.followed.filter_by(id=other.id),
+            'followers': user.followers,
+            'inbox': Message.query.join(Conversation, Conversation.last_received_id == Message.id).filter(
+                Conversation.user_id == user.id).order_by(Conversation.last_received_timestamp.desc()).limit(10),
+            'thread': user.all_messages_with_other(other).limit(10),
+            'new_messages': db.session.query(db.func.sum(Conversation.unread_count)).filter(
+                Conversation.user_id == user.id),
+            'notifications': user.notifications.filter(Notification.timestamp > 0).filter_by(
+                name='unread_message_count'),
+            'tasks_in_progress': Task.query.filter_by(user_id=user.id, complete=False),
+        }
+        dialect = db.engine.dialect
+        if dialect.name == 'sqlite':
+            prefix = 'EXPLAIN QUERY PLAN '
+            full_scan = lambda line: line.startswith('SCAN') and 'USING' not in line
+        else:
+            prefix = 'EXPLAIN ANALYZE ' if analyze else 'EXPLAIN '
+            full_scan = lambda line: 'Seq Scan' in line
+        connection = db.session.connection()
+        for name, query in queries.items():
+            compiled = query.statement.compile(dialect=dialect)
+            params = compiled.params
+            if compiled.positional:
+                params = tuple(params[key] for key in compiled.positiontup)
+            click.echo('== {}'.format(name))
+            for row in connection.exec_driver_sql(prefix + str(compiled), params):
+                line = str(row[-1]) # the detail column, for both SQLite and PostgreSQL
+                click.echo(('  ! ' if full_scan(line) else '    ') + line)
+
 # Unsure about syntax for flask translate init lang command
-# Still have to manually update LANGUAGES config var
\ No newline at end of file
+# Still have to manually update LANGUAGES config var
@@ -1,22 +1,183 @@
 from flask import current_app
 from flask_mail import Message
-from app import mail
-from threading import Thread
+from app import mail, task_queues
+from threading import Thread, Lock
+import json
+import queue
+import smtplib
+import time
+import redis
+import sys
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+# outgoing mail is delivered in the background, either by a small pool of threads in this process
+# (MAIL_QUEUE='pool') or by a job on the task queue (MAIL_QUEUE='rq')
+# either way messages are sent in batches over one SMTP connection, and retried with backoff
+# (messages the server refuses outright are skipped)
+# to try it locally, run an SMTP sink (e.g. python -m aiosmtpd -n -l localhost:8025)
+# and set MAIL_SERVER=localhost MAIL_PORT=8025
+
+OUTBOX_KEY = 'mail:outbox'
+DRAIN_SCHEDULED_KEY = 'mail:drain-scheduled'
+DEAD_LETTER_KEY = 'mail:dead' # emails that failed MAIL_MAX_ATTEMPTS drains, kept for a look
+
+def _build_message(payload):
+    msg = Message(payload['subject'], sender=payload['sender'], recipients=payload['recipients'])
+    msg.body = payload['text_body']
+    msg.html = payload['html_body']
+    for attachment in payload['attachments'] or []:
+        msg.attach(*attachment)
+    return msg
+
+class MailError(Exception):
+    # the retries ran out, unsent holds the messages that weren't sent, the one that failed first
+    def __init__(self, unsent):
+        super().__init__('{} emails not sent'.format(len(unsent)))
+        self.unsent = unsent
+
+def _permanent(error):
+    # the server refused this message for good, sending it again won't help
+    return isinstance(error, smtplib.SMTPRecipientsRefused) or \
+        (isinstance(error, (smtplib.SMTPDataError, smtplib.SMTPSenderRefused)) and error.smtp_code >= 500)
+
+def send_messages(messages):
+    # sends over as few connections as possible, on failure the unsent ones are retried on a new connection
+    # messages the server refuses are logged and skipped, the rest still go; returns how many were sent
+    pending = list(messages)
+    sent = 0
+    retries = current_app.config['MAIL_MAX_RETRIES']
+    for attempt in range(retries + 1):
+        try:
+            with mail.connect() as conn:
+                while pending:
+                    try:
+                        conn.send(pending[0])
+                        sent += 1
+                    except smtplib.SMTPException as e:
+                        if not _permanent(e):
+                            raise
+                        current_app.logger.error('Email "%s" to %s refused: %s', pending[0].subject,
+                                                 pending[0].recipients, e)
+                    pending.pop(0)
+            return sent
+        except (smtplib.SMTPException, OSError) as e:
+            if attempt == retries:
+                current_app.logger.error('Giving up on %d emails', len(pending), exc_info=True)
+                raise MailError(pending) from e
+            time.sleep(current_app.config['MAIL_RETRY_BACKOFF'] * 2 ** attempt)
+
+class MailDispatcher(object):
+    # bounded in-process queue served by a fixed number of threads, so bursts don't create a thread per email
+    def __init__(self, app):
+        self.app = app
+        self.queue = queue.Queue(maxsize=app.config['MAIL_QUEUE_SIZE'])
+        self.threads = []
+        self.lock = Lock()
+
+    def submit(self, payload):
+        self._start()
+        try:
+            self.queue.put_nowait(_build_message(payload))
+        except queue.Full:
+            # backpressure: the queue is full, so the email goes to the outbox rather than making
+            # the request wait on SMTP
+            self.app.logger.warning('Mail queue is full, moving email to the outbox')
+            _spill(payload)
+
+    def join(self):
+        self.queue.join()
+
+    def _start(self):
+        with self.lock:
+            self.threads = [thread for thread in self.threads if thread.is_alive()] # none survive a fork
+            for i in range(self.app.config['MAIL_POOL_WORKERS'] - len(self.threads)):
+                thread = Thread(target=self._work, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.app.config['MAIL_BATCH_SIZE']:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with self.app.app_context():
+                    send_messages(batch)
+            except MailError:
+                pass # already logged by send_messages
+            except Exception:
+                self.app.logger.exception('Could not send %d emails', len(batch))
+            finally:
+                for msg in batch:
+                    self.queue.task_done()
+
+def get_dispatcher():
+    app = current_app._get_current_object()
+    if 'mail_dispatcher' not in app.extensions:
+        app.extensions['mail_dispatcher'] = MailDispatcher(app)
+    return app.extensions['mail_dispatcher']
+
+def queue_email(payload):
+    # adds to the Redis outbox, and schedules a drain job unless one is already waiting
+    connection = current_app.redis
+    connection.rpush(OUTBOX_KEY, json.dumps(payload))
+    if connection.set(DRAIN_SCHEDULED_KEY, 1, nx=True, ex=current_app.config['MAIL_DRAIN_TIMEOUT']):
+        task_queues.enqueue('interactive', 'app.tasks.deliver_mail')
+
+def _spill(payload):
+    # never sends from the request: if the outbox is unavailable too, the email is dropped
+    try:
+        queue_email(payload)
+    except redis.exceptions.RedisError:
+        current_app.logger.error('Mail outbox unavailable, dropping email "%s" to %s', payload['subject'],
+                                 payload['recipients'], exc_info=True)
+
+def _requeue(connection, payloads):
+    # the email that failed goes to the back of the outbox, or to the dead letters once it has failed
+    # MAIL_MAX_ATTEMPTS drains, so it can't hold up the others; the untried ones go back to the front
+    failed, untried = payloads[0], payloads[1:]
+    failed['attempts'] = failed.get('attempts', 0) + 1
+    pipe = connection.pipeline()
+    if untried:
+        pipe.lpush(OUTBOX_KEY, *[json.dumps(payload) for payload in reversed(untried)])
+    if failed['attempts'] >= current_app.config['MAIL_MAX_ATTEMPTS']:
+        current_app.logger.error('Moving email "%s" to %s after %d attempts', failed['subject'], DEAD_LETTER_KEY,
+                                 failed['attempts'])
+        pipe.rpush(DEAD_LETTER_KEY, json.dumps(failed))
+        pipe.ltrim(DEAD_LETTER_KEY, -current_app.config['MAIL_DEAD_LETTERS'], -1)
+    else:
+        pipe.rpush(OUTBOX_KEY, json.dumps(failed))
+    pipe.execute()
+
+def drain_outbox():
+    connection = current_app.redis
+    connection.delete(DRAIN_SCHEDULED_KEY) # emails queued from now on schedule another drain
+    sent = 0
+    while True:
+        payloads = connection.lpop(OUTBOX_KEY, current_app.config['MAIL_BATCH_SIZE'])
+        if not payloads:
+            return sent
+        payloads = [json.loads(payload) for payload in payloads]
+        try:
+            sent += send_messages([_build_message(payload) for payload in payloads])
+        except MailError as e:
+            _requeue(connection, payloads[len(payloads) - len(e.unsent):]) # the sent ones aren't sent again
+            raise
+
+def _in_job():
+    # a job can only be running if rq was imported, web processes don't import it just to ask
+    return 'rq' in sys.modules and sys.modules['rq'].get_current_job() is not None
 
 def send_email(subject, sender, recipients, text_body, html_body, attachments=None, sync=False):
     # attachments is list of triples
-    msg = Message(subject, sender=sender, recipients=recipients) # recipients as a list
-    msg.body = text_body
-    msg.html = html_body
-    if attachments:
-        for attachment in attachments:
-            msg.attach(*attachment)
+    payload = {'subject': subject, 'sender': sender, 'recipients': recipients, # recipients as a list
+               'text_body': text_body, 'html_body': html_body, 'attachments': attachments}
     if sync:
-        mail.send(msg)
-    else: # corresponds to latter 'if'
-        Thread(target=send_async_email, args=(current_app._get_current_object(), msg)).start() # .end() ?
-        # ._get_current_object() ?
\ No newline at end of file
+        send_messages([_build_message(payload)])
+    elif current_app.config['MAIL_QUEUE'] == 'rq' or _in_job():
+        # a job's process exits when the job ends, so it can't rely on background threads
+        _spill(payload)
+    else:
+        get_dispatcher().submit(payload)
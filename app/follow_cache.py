@@ -0,0 +1,61 @@
+from flask import current_app
+from app import metrics
+import redis
+
+# each user's followed ids are kept in a Redis set, so is_following is a single SISMEMBER
+# the set always contains the sentinel member 0 (never a real user id)
+# otherwise users who follow nobody would have no key and would hit the database every time
+
+SENTINEL = 0
+
+def _key(user_id):
+    return 'followed:{}'.format(user_id)
+
+def is_following(user_id, other_id, load_followed_ids):
+    # returns None if Redis is unavailable, so the caller can fall back to SQL
+    key = _key(user_id)
+    try:
+        pipe = current_app.redis.pipeline()
+        pipe.exists(key)
+        pipe.sismember(key, other_id)
+        exists, member = pipe.execute()
+        metrics.cache_lookup('followed', bool(exists))
+        if exists:
+            return bool(member)
+        ids = load_followed_ids()
+        pipe = current_app.redis.pipeline()
+        pipe.sadd(key, SENTINEL, *ids)
+        pipe.expire(key, current_app.config['FOLLOW_CACHE_TTL'])
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        return None
+    return other_id in ids
+
+# only touch a set that is already cached, a missing set is rebuilt from SQL on next use
+# done in a script so the set cannot expire between the check and the update
+_UPDATE_IF_CACHED = """
+if redis.call('exists', KEYS[1]) == 1 then
+    return redis.call(ARGV[1], KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+def apply_changes(changes):
+    # changes is a list of (follower_id, followed_id, followed) tuples from committed transactions
+    if not changes:
+        return
+    try:
+        script = current_app.redis.register_script(_UPDATE_IF_CACHED)
+        pipe = current_app.redis.pipeline()
+        for follower_id, followed_id, followed in changes:
+            script(keys=[_key(follower_id)], args=['sadd' if followed else 'srem', followed_id], client=pipe)
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        # a stale set could now disagree with the database, so drop the affected sets
+        invalidate(*[follower_id for follower_id, followed_id, followed in changes])
+
+def invalidate(*user_ids):
+    try:
+        current_app.redis.delete(*[_key(user_id) for user_id in user_ids])
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Could not invalidate follow cache for users %s', user_ids)
@@ -0,0 +1,31 @@
+from app import db, log, metrics
+import gc
+
+# gunicorn (gunicorn.conf.py) creates the app once in its master process and forks the web workers from
+# it, so they share its memory (imported modules, compiled templates) until they write to it
+# what a worker must not share with the master, or with the other workers, is replaced after the fork
+
+def preload(app):
+    # in the master: compiles every template once for all workers, then moves everything made so far
+    # out of the garbage collector's way, so collections in the workers don't write to (and so copy)
+    # the shared pages
+    for name in app.jinja_env.list_templates(extensions=['html', 'txt']):
+        app.jinja_env.get_template(name)
+    gc.collect()
+    gc.freeze()
+
+def after_fork(app):
+    # in each worker
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False) # leaves the master's connections open for the master
+    if 'redis' in app.__dict__: # made on first use, see RohanApp
+        app.redis.connection_pool.reset() # drops the master's connections without closing them
+    # the password process pool, mail threads, HTTP session and lookup table reader (with its writer
+    # lock) are made again when first used
+    for name in ('password_pool', 'mail_dispatcher', 'translate_session', 'lookup_tables'):
+        app.extensions.pop(name, None)
+    if 'metrics' in app.extensions:
+        app.extensions['metrics'] = metrics.Recorder()
+    if 'log_listener' in app.extensions:
+        log.start_listener(app) # no thread survives a fork
@@ -0,0 +1,100 @@
+from flask import current_app, g, has_request_context, request, template_rendered, before_render_template
+from contextlib import contextmanager
+from redis import Redis
+from redis.client import Pipeline
+from app import db
+import time
+
+# per-request counts and times of SQL statements, Redis, Elasticsearch and HTTP calls and template rendering
+# with SERVER_TIMING they are sent back in a Server-Timing header (visible in the browser's network panel), off
+# by default as it tells every client how the request was served; either way a request over
+# REQUEST_QUERY_BUDGET statements or REQUEST_TIME_BUDGET seconds is logged with all of them
+# template time includes any queries run from the template, e.g. lazy relationships
+
+KINDS = ['db', 'redis', 'es', 'http', 'template']
+
+def record(kind, seconds):
+    if has_request_context() and 'timings' in g:
+        entry = g.timings.setdefault(kind, [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+
+@contextmanager
+def timer(kind):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(kind, time.perf_counter() - start)
+
+
+class InstrumentedPipeline(Pipeline):
+    def execute(self, *args, **kwargs):
+        with timer('redis'):
+            return super(InstrumentedPipeline, self).execute(*args, **kwargs)
+
+
+class InstrumentedRedis(Redis):
+    # every command (including scripts) is timed, a pipeline counts as one call
+    def execute_command(self, *args, **options):
+        with timer('redis'):
+            return super(InstrumentedRedis, self).execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_start = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    record('db', time.perf_counter() - context._query_start)
+
+def _before_render_template(sender, template, context, **extra):
+    if has_request_context():
+        g.setdefault('template_start', []).append(time.perf_counter())
+
+def _template_rendered(sender, template, context, **extra):
+    if has_request_context() and g.get('template_start'):
+        record('template', time.perf_counter() - g.template_start.pop())
+
+def _start_request():
+    g.timings = {}
+    g.request_start = time.perf_counter()
+
+def server_timing(timings, total):
+    metrics = ['{};dur={:.1f};desc="{} calls"'.format(kind, 1000 * timings[kind][1], timings[kind][0])
+               for kind in KINDS if kind in timings]
+    return ', '.join(metrics + ['total;dur={:.1f}'.format(1000 * total)])
+
+def _finish_request(response):
+    if 'timings' not in g:
+        return response
+    total = time.perf_counter() - g.request_start
+    timings = g.timings
+    if current_app.config['SERVER_TIMING']:
+        response.headers['Server-Timing'] = server_timing(timings, total)
+    fields = {'method': request.method, 'path': request.path, 'endpoint': request.endpoint,
+              'status': response.status_code, 'duration': round(total, 4)}
+    for kind, (count, seconds) in timings.items():
+        fields[kind + '_calls'] = count
+        fields[kind + '_seconds'] = round(seconds, 4)
+    queries = timings.get('db', [0])[0]
+    if queries > current_app.config['REQUEST_QUERY_BUDGET'] or total > current_app.config['REQUEST_TIME_BUDGET']:
+        current_app.logger.warning('Request over budget: %s %s took %.0fms with %d queries',
+                                   request.method, request.path, 1000 * total, queries, extra={'request': fields})
+    elif current_app.config['LOG_REQUESTS']:
+        current_app.logger.info('%s %s %s %.0fms', request.method, request.path, response.status_code,
+                                1000 * total, extra={'request': fields})
+    return response
+
+def init_app(app):
+    with app.app_context():
+        for engine in db.engines.values():
+            if not db.event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+                db.event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+                db.event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    before_render_template.connect(_before_render_template, app)
+    template_rendered.connect(_template_rendered, app)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
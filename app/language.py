@@ -0,0 +1,125 @@
+from flask import current_app
+from app import db, task_queues
+from importlib import import_module
+import functools
+import guess_language
+import redis
+
+# language detection sits behind a small detector interface so the model can be swapped
+# with LANGUAGE_DETECTOR, and detection can be moved off the request with LANGUAGE_DETECTION_DEFERRED
+
+class LanguageDetector(object):
+    def detect(self, text):
+        raise NotImplementedError
+
+    def __call__(self, text):
+        # empty string when the language can't be determined, as stored in Post.language
+        language = self.detect(text)
+        if not language or language == guess_language.UNKNOWN or len(language) > 5:
+            return ''
+        return language
+
+
+class GuessLanguageDetector(LanguageDetector):
+    def detect(self, text):
+        return guess_language.guess_language(text)
+
+
+class TrigramDetector(LanguageDetector):
+    # same trigram models and scoring as guess_language, but the models are inverted into
+    # trigram -> [(language, rank)], so a text is scored against every language in one pass
+    # instead of one pass per language; non-Latin scripts are left to guess_language
+
+    def __init__(self):
+        self._index = None
+
+    def _model(self, language):
+        key = language.lower()
+        if key not in guess_language.models:
+            try:
+                guess_language.models[key] = import_module(guess_language.MODEL_ROOT + key).model
+            except ImportError:
+                guess_language.models[key] = None
+        return guess_language.models[key]
+
+    def _build_index(self):
+        index = {}
+        for language in guess_language.ALL_LATIN | guess_language.PT:
+            model = self._model(language)
+            for trigram, rank in (model or {}).items():
+                index.setdefault(trigram, []).append((language, rank))
+        return index
+
+    def _closest(self, trigrams, languages):
+        scores = dict.fromkeys([language for language in languages if self._model(language)],
+                               guess_language.MAX_GRAMS * len(trigrams))
+        if not scores:
+            return guess_language.UNKNOWN
+        for i, trigram in enumerate(trigrams):
+            for language, rank in self._index.get(trigram, ()):
+                if language in scores:
+                    scores[language] += abs(i - rank) - guess_language.MAX_GRAMS
+        return min((score, language) for language, score in scores.items())[1]
+
+    def detect(self, text):
+        words = guess_language.WORD_RE.findall(text[:guess_language.MAX_LENGTH].replace('’', "'"))
+        scripts = guess_language.find_runs(words)
+        if not scripts or not set(scripts) <= {'Basic Latin', 'Extended Latin'}:
+            return guess_language.identify(words, scripts)
+        sample = ' '.join(words)
+        if len(sample) < guess_language.MIN_LENGTH:
+            return guess_language.UNKNOWN
+        if self._index is None:
+            self._index = self._build_index()
+        trigrams = guess_language.create_ordered_model(sample)[:guess_language.MAX_GRAMS]
+        if 'Extended Latin' in scripts:
+            language = self._closest(trigrams, guess_language.EXTENDED_LATIN)
+            if language == 'pt':
+                return self._closest(trigrams, guess_language.PT)
+            return language
+        return self._closest(trigrams, guess_language.ALL_LATIN)
+
+
+DETECTORS = {
+    'guess_language': GuessLanguageDetector,
+    'trigram': TrigramDetector,
+}
+
+def get_detector():
+    detector = current_app.extensions.get('language_detector')
+    if detector is None:
+        detector = DETECTORS[current_app.config['LANGUAGE_DETECTOR']]()
+        if current_app.config['LANGUAGE_CACHE_SIZE']:
+            # posts and messages are short and often repeated ("hi", "thanks!"), so memoize results
+            detector = functools.lru_cache(maxsize=current_app.config['LANGUAGE_CACHE_SIZE'])(detector)
+        current_app.extensions['language_detector'] = detector
+    return detector
+
+def detect_language(text):
+    return get_detector()(text.strip())
+
+def language_for_new(text):
+    # None means "not detected yet", the background job fills it in after the commit
+    if current_app.config['LANGUAGE_DETECTION_DEFERRED']:
+        return None
+    return detect_language(text)
+
+def schedule_detection():
+    if not current_app.config['LANGUAGE_DETECTION_DEFERRED']:
+        return
+    try:
+        task_queues.enqueue('interactive', 'app.tasks.detect_languages')
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Could not schedule language detection')
+
+def backfill(model, batch_size=500):
+    # detects the language of every row that doesn't have one yet, including rows from before language existed
+    count = 0
+    while True:
+        rows = model.query.filter(model.language.is_(None)).order_by(model.id).limit(batch_size).all()
+        if not rows:
+            return count
+        for row in rows:
+            row.language = detect_language(row.body or '')
+        db.session.commit()
+        count += len(rows)
@@ -0,0 +1,35 @@
+from flask import current_app
+import json
+import time
+import redis
+
+# notifications that are only interesting while they change (NOTIFICATIONS_IN_REDIS, e.g. task progress)
+# are kept in a Redis hash per user, name -> {data, timestamp}, instead of a table row rewritten on every tick
+
+def _key(user_id):
+    return 'notifications:{}'.format(user_id)
+
+def add(user_id, name, data):
+    # False if Redis is unavailable, the caller then stores the notification in the database
+    value = json.dumps({'data': data, 'timestamp': time.time()})
+    try:
+        pipe = current_app.redis.pipeline()
+        pipe.hset(_key(user_id), name, value)
+        pipe.expire(_key(user_id), current_app.config['NOTIFICATION_REDIS_TTL'])
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        return False
+    return True
+
+def since(user_id, timestamp):
+    # [{name, data, timestamp}] newer than timestamp, in no particular order
+    try:
+        values = current_app.redis.hgetall(_key(user_id))
+    except redis.exceptions.RedisError:
+        return []
+    notifications = []
+    for name, value in values.items():
+        value = json.loads(value)
+        if value['timestamp'] > timestamp:
+            notifications.append({'name': name.decode(), 'data': value['data'], 'timestamp': value['timestamp']})
+    return notifications
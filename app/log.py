@@ -0,0 +1,213 @@
+from flask import g, has_request_context, request
+from flask.logging import default_handler
+from logging.handlers import QueueHandler, QueueListener, WatchedFileHandler, SMTPHandler
+from datetime import datetime, timezone
+from threading import Lock
+from uuid import uuid4
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import re
+import time
+
+# the app logger only puts records on a queue, a listener thread does the formatting, file writes and
+# emails, so a slow disk or SMTP server never holds up the request that logged
+# records carry the request id (from an X-Request-ID header, or a new one, echoed in the response) and
+# whatever the caller passed as extra fields, e.g. the timings from app.instrumentation
+# every gunicorn worker and RQ worker appends to the same LOG_FILE, so the app doesn't rotate it (processes
+# rotating at once lose lines): logrotate does, see deployment/logrotate, and each process reopens the
+# file once it has been moved
+
+REQUEST_FIELDS = ['request_id', 'method', 'path', 'remote_addr', 'user_id']
+REQUEST_ID = re.compile(r'^[A-Za-z0-9._-]{1,64}$') # what a client's X-Request-ID may be, to be logged and echoed
+
+
+class RequestFilter(logging.Filter):
+    # runs in the thread that logs, while the request context is still there
+    def filter(self, record):
+        if has_request_context():
+            record.request_id = g.get('request_id')
+            record.method = request.method
+            record.path = request.path
+            record.remote_addr = request.remote_addr
+            user = g.get('_login_user') # only if flask_login already loaded it
+            record.user_id = getattr(user, 'id', None)
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'location': '{}:{}'.format(record.pathname, record.lineno),
+        }
+        for field in REQUEST_FIELDS:
+            if getattr(record, field, None) is not None:
+                data[field] = getattr(record, field)
+        if getattr(record, 'request', None):
+            data['request'] = record.request
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super(TextFormatter, self).__init__('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]')
+
+    def format(self, record):
+        line = super(TextFormatter, self).format(record)
+        if getattr(record, 'request_id', None):
+            line += ' [request {}]'.format(record.request_id)
+        return line
+
+
+class LogQueueHandler(QueueHandler):
+    def __init__(self, log_queue, listener):
+        super(LogQueueHandler, self).__init__(log_queue)
+        self.listener = listener
+        self.pid = os.getpid()
+
+    def prepare(self, record):
+        # the message and traceback are rendered here, the extra fields stay for the JSON formatter
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg, record.args, record.exc_info = record.message, None, None
+        return record
+
+    def emit(self, record):
+        if os.getpid() != self.pid:
+            # a forked child (e.g. RQ's work horse) has no listener thread, and may exit without
+            # running atexit, so it writes directly
+            self.listener.handle(self.prepare(record))
+            return
+        super(LogQueueHandler, self).emit(record)
+
+
+class ThrottledSMTPHandler(SMTPHandler):
+    # one email per distinct error (same place, same exception type) per interval, and at most
+    # max_per_hour emails in all; the next email says how many were held back
+    def __init__(self, *args, interval=300, max_per_hour=10, **kwargs):
+        super(ThrottledSMTPHandler, self).__init__(*args, **kwargs)
+        self.interval = interval
+        self.max_per_hour = max_per_hour
+        self.last_sent = {} # error key -> time of its last email
+        self.sent = [] # times of the emails sent in the last hour
+        self.suppressed = 0
+        self.throttle_lock = Lock()
+
+    def _key(self, record):
+        # records arrive prepared, so the exception type comes from the last line of the traceback
+        if record.exc_text:
+            return record.pathname, record.lineno, record.exc_text.rstrip().splitlines()[-1].split(':')[0]
+        return record.pathname, record.lineno, record.msg
+
+    def emit(self, record):
+        now = time.time()
+        key = self._key(record)
+        with self.throttle_lock:
+            self.sent = [sent for sent in self.sent if sent > now - 3600]
+            if now - self.last_sent.get(key, 0) < self.interval or len(self.sent) >= self.max_per_hour:
+                self.suppressed += 1
+                return
+            self.last_sent[key] = now
+            self.sent.append(now)
+            suppressed, self.suppressed = self.suppressed, 0
+        if suppressed:
+            record = copy.copy(record)
+            record.msg = '{}\n\n({} similar or rate limited errors were not emailed)'.format(record.msg, suppressed)
+        super(ThrottledSMTPHandler, self).emit(record)
+
+    def getSubject(self, record):
+        return '{}: {}'.format(self.subject, record.getMessage().splitlines()[0][:100])
+
+
+def _formatter(app):
+    return JSONFormatter() if app.config['LOG_FORMAT'] == 'json' else TextFormatter()
+
+def _handlers(app):
+    handlers = []
+    if app.config['MAIL_SERVER']:
+        auth = None
+        if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
+            auth = (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
+        secure = None
+        if app.config['MAIL_USE_TLS']:
+            secure = ()
+        mail_handler = ThrottledSMTPHandler(
+            mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
+            fromaddr='no-reply@' + app.config['MAIL_SERVER'],
+            toaddrs=app.config['ADMINS'], subject='RohanApp Failure', credentials=auth, secure=secure,
+            interval=app.config['LOG_MAIL_INTERVAL'], max_per_hour=app.config['LOG_MAIL_MAX_PER_HOUR'])
+        mail_handler.setFormatter(TextFormatter())
+        mail_handler.setLevel(logging.ERROR) # only errors, not warnings
+        handlers.append(mail_handler)
+    if app.config['LOG_TO_STDOUT']:
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(_formatter(app))
+        stream_handler.setLevel(logging.INFO)
+        handlers.append(stream_handler)
+    else:
+        directory = os.path.dirname(app.config['LOG_FILE'])
+        if directory and not os.path.exists(directory):
+            os.mkdir(directory)
+        file_handler = WatchedFileHandler(app.config['LOG_FILE'])
+        file_handler.setFormatter(_formatter(app))
+        file_handler.setLevel(logging.INFO)
+        handlers.append(file_handler)
+    return handlers
+
+def stop_listener(app):
+    # writes out whatever is still queued, only the process that started the thread can stop it
+    listener = app.extensions.get('log_listener')
+    if listener is not None and listener._thread is not None and app.extensions['log_pid'] == os.getpid():
+        listener.stop()
+
+def start_listener(app):
+    # (re)starts the listener thread, e.g. in each web worker after a fork, keeping the handlers
+    old = app.extensions.get('log_listener')
+    stop_listener(app)
+    handlers = _handlers(app) if old is None else old.handlers
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    for handler in list(app.logger.handlers):
+        if isinstance(handler, LogQueueHandler):
+            app.logger.removeHandler(handler)
+    handler = LogQueueHandler(log_queue, listener)
+    handler.addFilter(RequestFilter())
+    app.logger.addHandler(handler)
+    app.extensions['log_listener'] = listener
+    app.extensions['log_pid'] = os.getpid()
+    if old is None:
+        atexit.register(stop_listener, app)
+    return listener
+
+def _assign_request_id():
+    request_id = request.headers.get('X-Request-ID')
+    g.request_id = request_id if request_id and REQUEST_ID.match(request_id) else uuid4().hex
+
+def _send_request_id(response):
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+    return response
+
+def init_app(app):
+    app.before_request(_assign_request_id)
+    app.after_request(_send_request_id)
+    if app.debug or app.testing:
+        return
+    app.logger.removeHandler(default_handler) # it writes to stderr in the request's thread
+    start_listener(app)
+    app.logger.setLevel(logging.INFO) # records each instance of the app starting up
+    app.logger.info('RohanApp startup')
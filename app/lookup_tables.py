@@ -0,0 +1,219 @@
+from flask import current_app, has_request_context
+from threading import Lock, Thread
+from app.avatars import email_digest
+import mmap
+import os
+import struct
+import tempfile
+import time
+import zlib
+import redis
+try:
+    import fcntl
+except ImportError: # not on Windows, where every lookup falls back to the database
+    fcntl = None
+
+# username -> id and id -> (username, email digest) for every user, in a file that each web worker
+# on the machine maps into memory, so resolving a username or drawing a post's author takes no query,
+# no Redis round trip and no copy of the table per worker
+# one web worker per machine (whichever holds the lock file) rewrites the file, every
+# LOOKUP_TABLE_REFRESH seconds or soon after a user is renamed, changes email or is deleted; the others
+# pick up the new file within LOOKUP_TABLE_POLL seconds
+# users missing from the table (e.g. registered since it was written) are looked up in the database,
+# and callers must check what they get, a name may have moved to another user since
+
+# file layout, little-endian: the header, then for each id from 0 to max_id the offset of its username
+# (0 if there's no such user) and its email digest, then an open addressing hash table of user ids
+# keyed by the CRC-32 of the username, then the usernames, each after its length
+MAGIC = b'RUT1'
+HEADER = struct.Struct('<4sIII') # magic, hash table slots, max_id, offset of the usernames
+ENTRY = struct.Struct('<I16s') # username offset + 1, MD5 digest of the email
+SLOT = struct.Struct('<I')
+LENGTH = struct.Struct('<H')
+VERSION_KEY = 'lookup_tables:users'
+
+
+def write_table(path, users):
+    # users is [(id, username, email digest)], the file is replaced in one step so readers never see half of it
+    users = [(user_id, username.encode('utf-8'), bytes.fromhex(digest)) for user_id, username, digest in users]
+    max_id = max([user[0] for user in users] or [0])
+    slots = 8
+    while slots < 2 * len(users):
+        slots *= 2
+    strings = bytearray()
+    entries = bytearray(ENTRY.size * (max_id + 1))
+    table = bytearray(SLOT.size * slots)
+    for user_id, name, digest in users:
+        ENTRY.pack_into(entries, user_id * ENTRY.size, len(strings) + 1, digest)
+        strings += LENGTH.pack(len(name)) + name
+        slot = zlib.crc32(name) & (slots - 1)
+        while SLOT.unpack_from(table, slot * SLOT.size)[0]:
+            slot = (slot + 1) & (slots - 1)
+        SLOT.pack_into(table, slot * SLOT.size, user_id)
+    header = HEADER.pack(MAGIC, slots, max_id, HEADER.size + len(entries) + len(table))
+    directory = os.path.dirname(path)
+    fd, temporary = tempfile.mkstemp(dir=directory, prefix='.lookup-')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(header)
+        f.write(entries)
+        f.write(table)
+        f.write(strings)
+    os.chmod(temporary, 0o644)
+    os.replace(temporary, path)
+
+
+class Table(object):
+    # a read-only view of a table file, the mapping stays valid after the file is replaced
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.inode = stat.st_ino, stat.st_mtime_ns
+        magic, self.slots, self.max_id, self.strings = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            raise ValueError('{} is not a lookup table'.format(path))
+        self.table = HEADER.size + ENTRY.size * (self.max_id + 1)
+
+    def _name(self, user_id):
+        if not 0 < user_id <= self.max_id:
+            return None, None
+        offset, digest = ENTRY.unpack_from(self.map, HEADER.size + user_id * ENTRY.size)
+        if not offset:
+            return None, None
+        start = self.strings + offset - 1
+        length = LENGTH.unpack_from(self.map, start)[0]
+        return self.map[start + LENGTH.size:start + LENGTH.size + length], digest
+
+    def user_id(self, username):
+        name = username.encode('utf-8')
+        slot = zlib.crc32(name) & (self.slots - 1)
+        while True:
+            user_id = SLOT.unpack_from(self.map, self.table + slot * SLOT.size)[0]
+            if not user_id:
+                return None
+            if self._name(user_id)[0] == name:
+                return user_id
+            slot = (slot + 1) & (self.slots - 1)
+
+    def user_summary(self, user_id):
+        # (username, hex digest of the email), or None
+        name, digest = self._name(user_id)
+        return None if name is None else (name.decode('utf-8'), digest.hex())
+
+
+class _State(object):
+    def __init__(self, path):
+        self.path = path
+        self.table = None
+        self.checked = None # when the file was last looked at
+        self.elected = None # when this process last tried to become the writer
+        self.lock = Lock()
+        self.lock_file = None # open while this process is the writer
+        self.pid = os.getpid()
+
+
+def _path(app):
+    # one file per database, so a development server and a benchmark on the same machine don't mix
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    return os.path.join(app.config['LOOKUP_TABLE_DIR'], 'rohanapp-users-{:08x}.table'.format(zlib.crc32(uri.encode())))
+
+def _state():
+    app = current_app._get_current_object()
+    state = app.extensions.get('lookup_tables')
+    if state is None or state.pid != os.getpid(): # a forked process doesn't share its parent's writer lock
+        state = app.extensions['lookup_tables'] = _State(_path(app))
+    return state
+
+def _elect(app, state):
+    # the process that gets the lock file writes the table until it exits
+    try:
+        lock_file = open(state.path + '.lock', 'a')
+    except OSError: # e.g. a read-only LOOKUP_TABLE_DIR, or another user's lock file
+        app.logger.warning('Could not open %s.lock, lookups use the database', state.path)
+        return
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return
+    state.lock_file = lock_file
+    Thread(target=_write_forever, args=(app, state), daemon=True).start()
+
+def _recent(then, now, seconds):
+    return then is not None and now - then < seconds
+
+def _current():
+    # the newest table, or None; looks at the file at most every LOOKUP_TABLE_POLL seconds
+    app = current_app._get_current_object()
+    if not app.config['LOOKUP_TABLES'] or app.testing or fcntl is None:
+        return None
+    state = _state()
+    now = time.monotonic()
+    if _recent(state.checked, now, app.config['LOOKUP_TABLE_POLL']):
+        return state.table
+    with state.lock:
+        if _recent(state.checked, now, app.config['LOOKUP_TABLE_POLL']):
+            return state.table
+        state.checked = now
+        # only web workers write, e.g. not a task's short-lived process
+        if state.lock_file is None and has_request_context() and \
+                not _recent(state.elected, now, app.config['LOOKUP_TABLE_REFRESH']):
+            state.elected = now
+            _elect(app, state)
+        try:
+            stat = os.stat(state.path)
+            if stat.st_uid != os.getuid(): # not written by this app, e.g. another user's in a shared /dev/shm
+                state.table = None
+            elif state.table is None or state.table.inode != (stat.st_ino, stat.st_mtime_ns):
+                state.table = Table(state.path)
+        except (OSError, ValueError):
+            state.table = None
+    return state.table
+
+def user_id(username):
+    # the id the table has for a username, None if it has none (or there is no table)
+    table = _current()
+    return table.user_id(username) if table is not None else None
+
+def user_summary(user_id):
+    table = _current()
+    return table.user_summary(user_id) if table is not None else None
+
+# the writer
+
+def stale():
+    # after a commit that renamed, re-addressed or deleted users, so the writer rebuilds soon
+    try:
+        current_app.redis.incr(VERSION_KEY)
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Could not mark the lookup tables stale')
+
+def rebuild(path):
+    from app import db
+    from app.models import User
+    # rows written before email_digest was stored get it from the email, as User.avatar does
+    rows = db.session.execute(db.select(User.id, User.username, User.email_digest, User.email)).all()
+    write_table(path, [(user_id, username, digest or email_digest(email)) for user_id, username, digest, email in rows])
+    db.session.remove()
+
+def _version(app):
+    try:
+        return app.redis.get(VERSION_KEY)
+    except redis.exceptions.RedisError:
+        return None
+
+def _write_forever(app, state):
+    # until the app drops this state (e.g. a test turning the tables off)
+    version, built = None, None
+    while app.extensions.get('lookup_tables') is state:
+        latest = _version(app)
+        if built is None or latest != version or time.monotonic() - built >= app.config['LOOKUP_TABLE_REFRESH']:
+            try:
+                with app.app_context():
+                    rebuild(state.path)
+                version, built = latest, time.monotonic()
+            except Exception:
+                app.logger.exception('Could not rebuild the lookup tables')
+                version, built = latest, time.monotonic() # not again before the next refresh or change
+        time.sleep(app.config['LOOKUP_TABLE_POLL'])
+    state.lock_file.close()
@@ -1,14 +1,18 @@
-from flask import render_template, flash, redirect, url_for, request, g, jsonify, current_app
+from flask import render_template, flash, redirect, url_for, request, g, jsonify, current_app, abort, Response, send_file
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
 from app import db
 from app.main.forms import EditProfileForm, PostForm, SearchForm, MessageForm
-from app.models import User, Post, Message, Notification
+from app.models import User, Post, Message, Conversation
 from app.translate import translate
 from datetime import datetime
-from guess_language import guess_language
+from app.language import language_for_new, schedule_detection
 from app.main import bp
-from sqlalchemy import func, and_
+from app import metrics as app_metrics
+from app import avatars
+from app.replicas import replica
+import hmac
+import redis
 
 # VIEW functions
 
@@ -18,12 +22,12 @@ from sqlalchemy import func, and_
 def index():
     form = PostForm()
     if form.validate_on_submit():
-        language = guess_language(form.post.data)
-        if language == 'UNKNOWN' or len(language) > 5:
-            language = ''
+        language = language_for_new(form.post.data)
         post = Post(body=form.post.data, author=current_user, language=language)
         db.session.add(post)
         db.session.commit()
+        if language is None:
+            schedule_detection()
         flash(_('Your post is now live!'))
         return redirect(url_for('main.index'))
     # user = {'username': 'Rohan'}
@@ -44,8 +48,9 @@ def index():
 
 @bp.route('/user/<username>')
 @login_required
+@replica
 def user(username):
-    user = User.query.filter_by(username=username).first_or_404()
+    user = User.get_by_username_or_404(username)
     page = request.args.get('page', 1, type=int)
     posts = user.posts.order_by(Post.timestamp.desc()).paginate(
         page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
@@ -56,15 +61,22 @@ def user(username):
     else:
         last_page = posts.total // current_app.config['POSTS_PER_PAGE'] + 1
     last_url = url_for('main.user', username=user.username, page=last_page)
+    suggestions = current_user.follow_suggestions(current_app.config['FOLLOW_SUGGESTIONS']) \
+        if user == current_user else [] # only on your own profile
     return render_template('user.html', title = user.username, user = user, posts = posts.items,
-                            next_url = next_url, prev_url = prev_url, last_url = last_url)
+                            next_url = next_url, prev_url = prev_url, last_url = last_url,
+                            suggestions = suggestions)
 
 @bp.before_app_request # executed just before any view function
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow() # .strftime('%m/%d/%Y %I:%M:%S %p')
-        # db.session.add()
-        db.session.commit()
+        now = datetime.utcnow()
+        # only written once per LAST_SEEN_INTERVAL, not on every request (each write also drops the cached user)
+        if current_user.last_seen is None or \
+                (now - current_user.last_seen).total_seconds() > current_app.config['LAST_SEEN_INTERVAL']:
+            current_user.last_seen = now # .strftime('%m/%d/%Y %I:%M:%S %p')
+            # db.session.add()
+            db.session.commit()
         g.search_form = SearchForm()
         # under .is_authenticated, so search form appears iff logged in
         # need this form object to persist until it can be rendered at the end of the request
@@ -106,7 +118,7 @@ def edit_profile():
 @bp.route('/follow/<username>')
 @login_required
 def follow(username):
-    user = User.query.filter_by(username=username).first()
+    user = User.get_by_username(username)
     if user is None:
         flash('User {} not found.'.format(username)) # or 'User {} not found.' %s username
         return redirect(url_for('main.index'))
@@ -124,7 +136,7 @@ def follow(username):
 @bp.route('/unfollow/<username>')
 @login_required
 def unfollow(username):
-    user = User.query.filter_by(username=username).first()
+    user = User.get_by_username(username)
     if user is None:
         flash('User {} not found.'.format(username))
         return redirect(url_for('main.index'))
@@ -141,6 +153,7 @@ def unfollow(username):
 
 @bp.route('/explore')
 @login_required
+@replica
 def explore():
     page = request.args.get('page', 1, type=int) # "page" as opposed to "next" in URL
     posts = Post.query.order_by(Post.timestamp.desc()).paginate(
@@ -152,7 +165,9 @@ def explore():
     else:
         last_page = posts.total // current_app.config['POSTS_PER_PAGE'] + 1
     last_url = url_for('main.explore', page=last_page)
-    return render_template('explore.html', title='Explore', posts=posts.items, next_url=next_url, prev_url=prev_url, last_url=last_url)
+    suggestions = current_user.follow_suggestions(current_app.config['FOLLOW_SUGGESTIONS'])
+    return render_template('explore.html', title='Explore', posts=posts.items, next_url=next_url, prev_url=prev_url, last_url=last_url,
+                           suggestions=suggestions)
 
 @bp.route('/translate', methods=['POST']) # no form to GET
 @login_required
@@ -161,23 +176,23 @@ def translate_text():
 
 @bp.route('/user/<username>/popup')
 @login_required
+@replica
 def user_popup(username):
-    user = User.query.filter_by(username=username).first_or_404()
+    user = User.get_by_username_or_404(username)
     return render_template('user_popup.html', user=user)
 
 @bp.route('/send_message/<recipient>', methods=['GET', 'POST'])
 @login_required
 def send_message(recipient):
-    user = User.query.filter_by(username=recipient).first_or_404()
+    user = User.get_by_username_or_404(recipient)
     form = MessageForm()
     if form.validate_on_submit():
-        language = guess_language(form.message.data)
-        if language == 'UNKNOWN' or len(language) > 5:
-            language = ''
-        msg = Message(author=current_user, recipient=user, body=form.message.data, language=language)
-        db.session.add(msg)
+        language = language_for_new(form.message.data)
+        current_user.send_message(user, form.message.data, language)
         user.add_notification('unread_message_count', user.new_messages())
         db.session.commit()
+        if language is None:
+            schedule_detection()
         flash('Your message has been sent.')
         return redirect(url_for('main.user', username=recipient)) # redirect (when and) only when form is successfully submitted
     return render_template('send_message.html', title='Send Message',
@@ -186,15 +201,15 @@ def send_message(recipient):
 @bp.route('/messages')
 @login_required
 def messages():
-    current_user.last_message_read_time = datetime.utcnow()
+    current_user.mark_messages_read()
     current_user.add_notification('unread_message_count', current_user.new_messages())
     db.session.commit()
     page = request.args.get('page', 1, type=int)
-    sub = db.session.query(func.max(Message.timestamp).label("max_stamp")).filter(
-        Message.recipient == current_user).group_by(Message.sender_id).subquery()
-    messages = current_user.messages_received.join(sub, and_(Message.timestamp == sub.c.max_stamp)).order_by(
-        Message.timestamp.desc()).paginate(
-            page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
+    # the latest message received from each sender, via the conversation summaries
+    messages = Message.query.join(Conversation, Conversation.last_received_id == Message.id).filter(
+        Conversation.user_id == current_user.id).order_by(
+            Conversation.last_received_timestamp.desc()).paginate(
+                page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
     next_url = url_for('main.messages', page=messages.next_num) if messages.has_next else None
     prev_url = url_for('main.messages', page=messages.prev_num) if messages.has_prev else None
     if messages.total % current_app.config['POSTS_PER_PAGE'] == 0:
@@ -209,11 +224,11 @@ def messages():
 @login_required
 def sent_messages():
     page = request.args.get('page', 1, type=int)
-    sub = db.session.query(func.max(Message.timestamp).label("max_stamp")).filter(
-        Message.author == current_user).group_by(Message.recipient_id).subquery()
-    sent_messages = current_user.messages_sent.join(sub, and_(Message.timestamp == sub.c.max_stamp)).order_by(
-        Message.timestamp.desc()).paginate(
-            page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
+    # the latest message sent to each recipient who hasn't replied yet
+    sent_messages = Message.query.join(Conversation, Conversation.last_sent_id == Message.id).filter(
+        Conversation.user_id == current_user.id, Conversation.last_received_id.is_(None)).order_by(
+            Conversation.last_sent_timestamp.desc()).paginate(
+                page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
     next_url = url_for('main.sent_messages', page=sent_messages.next_num) if sent_messages.has_next else None
     prev_url = url_for('main.sent_messages', page=sent_messages.prev_num) if sent_messages.has_prev else None
     if sent_messages.total % current_app.config['POSTS_PER_PAGE'] == 0:
@@ -227,16 +242,15 @@ def sent_messages():
 @bp.route('/messages/<other>', methods=['GET', 'POST'])
 @login_required
 def conversation(other):
-    user = User.query.filter_by(username=other).first_or_404()
+    user = User.get_by_username_or_404(other)
     form = MessageForm()
     if form.validate_on_submit():
-        language = guess_language(form.message.data)
-        if language == 'UNKNOWN' or len(language) > 5:
-            language = ''
-        msg = Message(author=current_user, recipient=user, body=form.message.data, language=language)
-        db.session.add(msg)
+        language = language_for_new(form.message.data)
+        current_user.send_message(user, form.message.data, language)
         user.add_notification('unread_message_count', user.new_messages())
         db.session.commit()
+        if language is None:
+            schedule_detection()
         flash('Your message has been sent.')
         return redirect(url_for('main.conversation', other=other))
     page = request.args.get('page', 1, type=int)
@@ -257,24 +271,45 @@ def conversation(other):
 @login_required
 def notifications():
     since = request.args.get('since', 0.0, type=float)
-    notifications = current_user.notifications.filter(
-        Notification.timestamp > since).order_by(Notification.timestamp.asc()) # isn't .asc() the default ?
-    return jsonify([{
-        'name': n.name,
-        'data': n.get_data(),
-        'timestamp': n.timestamp
-    } for n in notifications])
+    # rows from the database and ephemeral ones from Redis, oldest first
+    return jsonify(current_user.notifications_since(since))
 
 @bp.route('/export_posts')
 @login_required
 def export_posts():
-    if current_user.get_task_in_progress('export_posts'):
+    if current_user.launch_task('export_posts', 'Exporting posts...') is None:
         flash('An export task is currently in progress')
     else:
-        current_user.launch_task('export_posts', 'Exporting posts...')
         db.session.commit() # after having already added task to session
     return redirect(url_for('main.user', username=current_user.username))
 
+@bp.route('/metrics')
+def metrics():
+    # for Prometheus, so no login but the METRICS_TOKEN bearer token; not there at all without one
+    token = current_app.config['METRICS_TOKEN']
+    if not token:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + token):
+        abort(401)
+    try:
+        body = app_metrics.render()
+    except redis.exceptions.RedisError:
+        abort(503)
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+@bp.route('/avatar/<digest>/<int:size>.png')
+def avatar(digest, size):
+    # with LOCAL_AVATARS, see app/avatars.py; a digest and size always give the same image
+    if not current_app.config['LOCAL_AVATARS'] or not avatars.DIGEST.match(digest) or size not in avatars.SIZES:
+        abort(404)
+    filename = avatars.path(digest, size, User.has_email_digest)
+    if filename is None:
+        abort(404)
+    response = send_file(filename, mimetype='image/png', max_age=avatars.CACHE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
 # set password criteria via validators
 # functionality for deleting posts
 # 'New Posts' divider based on current_user.last_seen
\ No newline at end of file
@@ -0,0 +1,211 @@
+from flask import current_app, g, request
+from collections import defaultdict
+from datetime import datetime, timezone
+from threading import Lock
+import bisect
+import json
+import os
+import socket
+import time
+import redis
+
+# counters for /metrics, in the Prometheus text format
+# each web worker adds up its requests and cache lookups in memory and flushes them to Redis hashes
+# every METRICS_FLUSH_INTERVAL seconds (one pipeline), so /metrics shows the totals of all workers
+# job durations are written by the RQ workers as each job finishes, queue lengths and database
+# pool usage are read when /metrics is scraped (pool usage as last reported by each web worker)
+
+REQUESTS_KEY = 'metrics:requests'
+LATENCY_KEY = 'metrics:latency'
+STATEMENTS_KEY = 'metrics:statements'
+CACHE_KEY = 'metrics:cache'
+JOBS_KEY = 'metrics:jobs'
+POOL_KEY = 'metrics:pool'
+JOB_BUCKETS = [0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600]  # seconds
+
+def _bucket(seconds, buckets):
+    # index of the first bucket the value fits in, len(buckets) for +Inf
+    return bisect.bisect_left(buckets, seconds)
+
+
+class Recorder(object):
+    def __init__(self):
+        self.lock = Lock()
+        self.counts = defaultdict(int) # (key, field) -> int
+        self.sums = defaultdict(float) # (key, field) -> float
+        self.flushed = time.monotonic()
+
+    def add(self, key, field, amount=1):
+        with self.lock:
+            self.counts[key, field] += amount
+
+    def add_float(self, key, field, amount):
+        with self.lock:
+            self.sums[key, field] += amount
+
+    def due(self, interval):
+        return time.monotonic() - self.flushed >= interval
+
+    def flush(self, connection, pool_status):
+        with self.lock:
+            counts, self.counts = self.counts, defaultdict(int)
+            sums, self.sums = self.sums, defaultdict(float)
+            self.flushed = time.monotonic()
+        pipe = connection.pipeline(transaction=False)
+        for (key, field), amount in counts.items():
+            pipe.hincrby(key, field, amount)
+        for (key, field), amount in sums.items():
+            pipe.hincrbyfloat(key, field, amount)
+        pipe.hset(POOL_KEY, '{}:{}'.format(socket.gethostname(), os.getpid()), json.dumps(pool_status))
+        try:
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            current_app.logger.warning('Could not flush metrics, %d counters lost', len(counts) + len(sums))
+
+
+def _recorder():
+    return current_app.extensions['metrics']
+
+def cache_lookup(cache, hit):
+    if 'metrics' in current_app.extensions:
+        _recorder().add(CACHE_KEY, '{}|{}'.format(cache, 'hit' if hit else 'miss'))
+
+def _pool_status():
+    from app import db
+    status = {'time': time.time()}
+    for bind, engine in db.engines.items():
+        pool = engine.pool
+        name = bind or 'default'
+        # not every pool class (e.g. SQLite's) counts connections
+        status[name] = {'checked_out': getattr(pool, 'checkedout', lambda: 0)(),
+                        'size': getattr(pool, 'size', lambda: 0)(),
+                        'overflow': max(0, getattr(pool, 'overflow', lambda: 0)())}
+    return status
+
+def _after_request(response):
+    if 'request_start' not in g:
+        return response
+    seconds = time.perf_counter() - g.request_start
+    endpoint = request.endpoint or 'unmatched'
+    recorder = _recorder()
+    recorder.add(REQUESTS_KEY, '{}|{}|{}'.format(endpoint, request.method, response.status_code))
+    recorder.add(LATENCY_KEY, '{}|{}'.format(endpoint, _bucket(seconds, current_app.config['METRICS_BUCKETS'])))
+    recorder.add(LATENCY_KEY, endpoint + '|count')
+    recorder.add_float(LATENCY_KEY, endpoint + '|sum', seconds)
+    recorder.add(STATEMENTS_KEY, endpoint, g.timings.get('db', [0])[0])
+    if recorder.due(current_app.config['METRICS_FLUSH_INTERVAL']):
+        recorder.flush(current_app.redis, _pool_status())
+    return response
+
+def _job_duration(job):
+    started = job.started_at
+    if started is None:
+        return 0.0
+    if started.tzinfo is None:
+        started = started.replace(tzinfo=timezone.utc)
+    return max(0.0, (datetime.now(timezone.utc) - started).total_seconds())
+
+def _record_job(connection, job, failed):
+    # runs in the RQ worker, without an app context
+    name = job.func_name
+    seconds = _job_duration(job)
+    pipe = connection.pipeline(transaction=False)
+    pipe.hincrby(JOBS_KEY, '{}|{}'.format(name, _bucket(seconds, JOB_BUCKETS)), 1)
+    pipe.hincrby(JOBS_KEY, name + '|count', 1)
+    pipe.hincrbyfloat(JOBS_KEY, name + '|sum', seconds)
+    if failed:
+        pipe.hincrby(JOBS_KEY, name + '|failed', 1)
+    pipe.execute()
+
+def job_succeeded(job, connection, result, *args, **kwargs):
+    _record_job(connection, job, False)
+
+def job_failed(job, connection, exc_type, exc_value, traceback):
+    _record_job(connection, job, True)
+
+def init_app(app):
+    app.extensions['metrics'] = Recorder()
+    app.after_request(_after_request)
+
+# rendering
+
+def _labels(**labels):
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in labels.items()) + '}'
+
+def _decode(fields):
+    return {field.decode(): value.decode() for field, value in fields.items()}
+
+def _histogram(lines, name, help, label, fields, buckets):
+    lines += ['# HELP {} {}'.format(name, help), '# TYPE {} histogram'.format(name)]
+    series = defaultdict(dict)
+    for field, value in fields.items():
+        key, _, part = field.rpartition('|')
+        series[key][part] = value
+    for key, parts in sorted(series.items()):
+        cumulative = 0
+        for i, bound in enumerate(buckets):
+            cumulative += int(parts.get(str(i), 0))
+            lines.append('{}_bucket{} {}'.format(name, _labels(**{label: key, 'le': bound}), cumulative))
+        lines.append('{}_bucket{} {}'.format(name, _labels(**{label: key, 'le': '+Inf'}), parts.get('count', 0)))
+        lines.append('{}_sum{} {}'.format(name, _labels(**{label: key}), parts.get('sum', 0)))
+        lines.append('{}_count{} {}'.format(name, _labels(**{label: key}), parts.get('count', 0)))
+
+def render():
+    from rq.registry import FailedJobRegistry, ScheduledJobRegistry, StartedJobRegistry
+    connection = current_app.redis
+    buckets = current_app.config['METRICS_BUCKETS']
+    pipe = connection.pipeline(transaction=False)
+    for key in (REQUESTS_KEY, LATENCY_KEY, STATEMENTS_KEY, CACHE_KEY, JOBS_KEY, POOL_KEY):
+        pipe.hgetall(key)
+    requests, latency, statements, caches, jobs, pools = [_decode(fields) for fields in pipe.execute()]
+    lines = ['# HELP rohanapp_requests_total Requests by endpoint, method and status.',
+             '# TYPE rohanapp_requests_total counter']
+    for field, value in sorted(requests.items()):
+        endpoint, method, status = field.split('|')
+        lines.append('rohanapp_requests_total{} {}'.format(_labels(endpoint=endpoint, method=method, status=status),
+                                                           value))
+    _histogram(lines, 'rohanapp_request_duration_seconds', 'Request latency by endpoint.', 'endpoint',
+               latency, buckets)
+    lines += ['# HELP rohanapp_sql_statements_total SQL statements run by endpoint.',
+              '# TYPE rohanapp_sql_statements_total counter']
+    lines += ['rohanapp_sql_statements_total{} {}'.format(_labels(endpoint=endpoint), value)
+              for endpoint, value in sorted(statements.items())]
+    lines += ['# HELP rohanapp_cache_requests_total Cache lookups by cache and result.',
+              '# TYPE rohanapp_cache_requests_total counter']
+    for field, value in sorted(caches.items()):
+        cache, result = field.split('|')
+        lines.append('rohanapp_cache_requests_total{} {}'.format(_labels(cache=cache, result=result), value))
+
+    # pool usage as last reported by each web worker, dropping workers that stopped reporting
+    stale = time.time() - 3 * max(current_app.config['METRICS_FLUSH_INTERVAL'], 10)
+    totals = defaultdict(lambda: defaultdict(int))
+    for worker, status in pools.items():
+        status = json.loads(status)
+        if status.pop('time') < stale:
+            connection.hdel(POOL_KEY, worker)
+            continue
+        for bind, values in status.items():
+            for name, value in values.items():
+                totals[bind][name] += value
+    for name, help in (('checked_out', 'Database connections in use.'), ('size', 'Database pool size.'),
+                       ('overflow', 'Database connections over the pool size.')):
+        lines += ['# HELP rohanapp_db_pool_{} {}'.format(name, help), '# TYPE rohanapp_db_pool_{} gauge'.format(name)]
+        lines += ['rohanapp_db_pool_{}{} {}'.format(name, _labels(bind=bind), values[name])
+                  for bind, values in sorted(totals.items())]
+
+    lines += ['# HELP rohanapp_queue_jobs Jobs by queue and state.', '# TYPE rohanapp_queue_jobs gauge']
+    for queue in current_app.task_queues.values():
+        lines.append('rohanapp_queue_jobs{} {}'.format(_labels(queue=queue.name, state='queued'), len(queue)))
+        for state, registry in (('started', StartedJobRegistry), ('scheduled', ScheduledJobRegistry),
+                                ('failed', FailedJobRegistry)):
+            lines.append('rohanapp_queue_jobs{} {}'.format(_labels(queue=queue.name, state=state),
+                                                          registry(queue=queue).count))
+    failures = {field.rpartition('|')[0]: value for field, value in jobs.items() if field.endswith('|failed')}
+    _histogram(lines, 'rohanapp_job_duration_seconds', 'Background job run time by function.', 'func',
+               {field: value for field, value in jobs.items() if not field.endswith('|failed')}, JOB_BUCKETS)
+    lines += ['# HELP rohanapp_job_failures_total Failed background jobs by function.',
+              '# TYPE rohanapp_job_failures_total counter']
+    lines += ['rohanapp_job_failures_total{} {}'.format(_labels(func=func), value)
+              for func, value in sorted(failures.items())]
+    return '\n'.join(lines) + '\n'
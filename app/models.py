@@ -1,15 +1,20 @@
-from flask import current_app, url_for
+from flask import current_app, url_for, abort
 from app import db, login
 from app.search import add_to_index, remove_from_index, query_index
-from datetime import datetime
+from app import follow_cache, passwords, token_cache, user_cache, task_status, task_queues, live_notifications
+from app import query_cache, lookup_tables
+from app.avatars import avatar_url, email_digest
+from datetime import datetime, timedelta
 from time import time
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
-from hashlib import md5
+from hashlib import sha256
+from sqlalchemy import inspect
+from sqlalchemy.orm import validates
+from importlib import import_module
 import jwt
 import json
+import secrets
 import redis
-import rq
 
 class SearchableMixin(object):
     @classmethod # as opposed to instance method
@@ -71,18 +76,92 @@ class PaginatedAPIMixin(object):
         return data
 
 followers = db.Table('followers',
-    db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
+    db.Column('follower_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Index('ix_followers_followed_id', 'followed_id', 'follower_id') # for followers lookups, the primary key covers followed
 )
 # followers is a so-called association table
 # this means that each row in the table accounts for one follower - followed relationship
 # if user1 is a follower of user2, then user2 is being followed by user1
 # and there is a single row in the followers table to document this
 
+def _record_follow_change(follower, followed, following):
+    # the follow cache is updated only once the change is committed
+    db.session.info.setdefault('follow_changes', []).append((follower, followed, following))
+    query_cache.changed(db.session, 'followers:{}'.format(followed.id), 'followed:{}'.format(follower.id))
+
+def _apply_follow_changes(session):
+    from app import suggestions # imports this module
+    changes = session.info.pop('follow_changes', None)
+    if changes:
+        # the objects are expired after the commit, their identities don't need a reload
+        changes = [(inspect(follower).identity[0], inspect(followed).identity[0], following)
+                   for follower, followed, following in changes]
+        follow_cache.apply_changes(changes)
+        suggestions.schedule_update(changes)
+
+def _discard_follow_changes(session, previous_transaction):
+    session.info.pop('follow_changes', None)
+
+db.event.listen(db.session, 'after_commit', _apply_follow_changes)
+db.event.listen(db.session, 'after_soft_rollback', _discard_follow_changes)
+
+def _collect_changed_users(session, flush_context):
+    # after a flush the changed objects are still in session.dirty/deleted, at commit time they may not be
+    changed = session.info.setdefault('changed_users', set())
+    changed.update(obj.id for obj in session.dirty.union(session.deleted) if isinstance(obj, User))
+
+def _invalidate_changed_users(session):
+    changed = session.info.pop('changed_users', None)
+    if changed:
+        user_cache.invalidate(*changed)
+
+def _discard_changed_users(session, previous_transaction):
+    session.info.pop('changed_users', None)
+
+db.event.listen(db.session, 'after_flush', _collect_changed_users)
+db.event.listen(db.session, 'after_commit', _invalidate_changed_users)
+db.event.listen(db.session, 'after_soft_rollback', _discard_changed_users)
+
+def _forget_revoked_tokens(session):
+    # not before the commit, or a request still reading the old row could cache the token again
+    for token_hash in session.info.pop('revoked_tokens', ()):
+        token_cache.forget(token_hash)
+
+def _discard_revoked_tokens(session, previous_transaction):
+    session.info.pop('revoked_tokens', None)
+
+db.event.listen(db.session, 'after_commit', _forget_revoked_tokens)
+db.event.listen(db.session, 'after_soft_rollback', _discard_revoked_tokens)
+
+# cached query results are dropped by the tags of what a commit changed, see app/query_cache.py
+db.event.listen(db.session, 'after_flush', query_cache._collect_tags)
+db.event.listen(db.session, 'after_commit', query_cache._invalidate_tags)
+db.event.listen(db.session, 'after_soft_rollback', query_cache._discard_tags)
+
+def _collect_renamed_users(session, flush_context):
+    # changes that the lookup tables show (new users are looked up in the database until the next rewrite)
+    for obj in session.dirty.union(session.deleted):
+        if isinstance(obj, User) and (obj in session.deleted or inspect(obj).attrs.username.history.deleted or
+                                      inspect(obj).attrs.email.history.deleted):
+            session.info['lookup_tables_stale'] = True
+
+def _mark_lookup_tables_stale(session):
+    if session.info.pop('lookup_tables_stale', False):
+        lookup_tables.stale()
+
+def _discard_lookup_tables_stale(session, previous_transaction):
+    session.info.pop('lookup_tables_stale', None)
+
+db.event.listen(db.session, 'after_flush', _collect_renamed_users)
+db.event.listen(db.session, 'after_commit', _mark_lookup_tables_stale)
+db.event.listen(db.session, 'after_soft_rollback', _discard_lookup_tables_stale)
+
 class User(PaginatedAPIMixin, UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
+    email_digest = db.Column(db.String(32), index=True) # MD5 of the email for avatars, see set_email_digest
     password_hash = db.Column(db.String(256))
     posts = db.relationship('Post', backref='author', lazy='dynamic') # u.posts, p.author(s)
     about_me = db.Column(db.String(140))
@@ -99,16 +178,66 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     last_message_read_time = db.Column(db.DateTime)
     notifications = db.relationship('Notification', backref='user', lazy='dynamic')
     tasks = db.relationship('Task', backref='user', lazy='dynamic') # only task will be exporting own posts
+    api_tokens = db.relationship('ApiToken', backref='user', lazy='dynamic') # one per client
+
+    def cache_tags(self):
+        # the old username too, if it changed
+        usernames = set(inspect(self).attrs.username.history.deleted) | {self.username}
+        return ['username:{}'.format(username) for username in usernames]
+
+    @staticmethod
+    def get_by_username(username):
+        user_id = lookup_tables.user_id(username)
+        if user_id is not None:
+            user = load_user(user_id)
+            if user is not None and user.username == username: # the table may be a little behind
+                return user
+        user_id = query_cache.get('user_id', [username], ['username:{}'.format(username)],
+                                  lambda: db.session.scalar(db.select(User.id).filter_by(username=username)))
+        return load_user(user_id) if user_id is not None else None
+
+    @staticmethod
+    def get_by_username_or_404(username):
+        user = User.get_by_username(username)
+        if user is None:
+            abort(404)
+        return user
+
+    def post_count(self):
+        return query_cache.get('post_count', [self.id], ['posts:{}'.format(self.id)], self.posts.count)
+
+    def follower_count(self):
+        return query_cache.get('follower_count', [self.id], ['followers:{}'.format(self.id)], self.followers.count)
+
+    def followed_count(self):
+        return query_cache.get('followed_count', [self.id], ['followed:{}'.format(self.id)], self.followed.count)
+
+    @validates('email')
+    def set_email_digest(self, key, email):
+        self.email_digest = email_digest(email)
+        return email
 
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest() # .encode('utf-8') converts email string to bytes
-        return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(digest, size)
+        return avatar_url(self.email_digest or email_digest(self.email), size)
+
+    @staticmethod
+    def has_email_digest(digest):
+        return db.session.scalar(db.select(User.id).filter_by(email_digest=digest).limit(1)) is not None
+
+    @staticmethod
+    def known_email_digests(digests):
+        return set(db.session.scalars(db.select(User.email_digest).filter(User.email_digest.in_(digests))))
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = passwords.hash_password(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if not passwords.verify_password(self.password_hash, password):
+            return False
+        if passwords.needs_rehash(self.password_hash):
+            # hashed with old parameters, upgrade it while the plain password is at hand (the caller commits)
+            self.password_hash = passwords.hash_password(password)
+        return True
 
     def __repr__(self):
         return '<User {}>'.format(self.username)
@@ -116,14 +245,34 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     def follow(self, user):
         if not self.is_following(user):
             self.followed.append(user) # built-in list functionality
+            _record_follow_change(self, user, True)
 
     def unfollow(self, user):
         if self.is_following(user):
             self.followed.remove(user) # built-in list functionality
+            _record_follow_change(self, user, False)
 
     def is_following(self, user):
+        if self.id is not None and user.id is not None and not db.session.info.get('follow_changes'):
+            # uncommitted follow changes aren't in the cache yet, so those sessions go to the database
+            following = follow_cache.is_following(self.id, user.id, self.followed_ids)
+            if following is not None:
+                return following
         return self.followed.filter(followers.c.followed_id == user.id).count() > 0 # filter ==, filter_by =
 
+    def followed_ids(self):
+        return [row.followed_id for row in db.session.query(followers.c.followed_id).filter(
+            followers.c.follower_id == self.id)]
+
+    def follow_suggestions(self, count):
+        from app import suggestions
+        ids = suggestions.get(self.id, count * 2) # a few spares in case some are stale
+        if not ids:
+            return []
+        already = db.session.query(followers.c.followed_id).filter(followers.c.follower_id == self.id)
+        return User.query.filter(User.id.in_(ids), User.id != self.id, ~User.id.in_(already)).order_by(
+            db.case({id: i for i, id in enumerate(ids)}, value=User.id)).limit(count).all()
+
     def followed_posts(self):
         followed = Post.query.join(
             followers, (followers.c.followed_id == Post.user_id)).filter(
@@ -148,14 +297,53 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
             return # return None
         return User.query.get(id)
 
+    def get_token(self, expires_in=3600):
+        # a new token every time, next to the user's other ones, so a second client doesn't log out the first
+        # expired tokens are dropped here, and the oldest ones beyond API_TOKENS_PER_USER are revoked
+        now = datetime.utcnow()
+        self.api_tokens.filter(ApiToken.expiration < now).delete(synchronize_session=False)
+        for api_token in self.api_tokens.order_by(ApiToken.expiration.desc()).offset(
+                current_app.config['API_TOKENS_PER_USER'] - 1):
+            api_token.revoke()
+        token = secrets.token_urlsafe(32)
+        db.session.add(ApiToken(token_hash=ApiToken.hash(token), user=self,
+                                expiration=now + timedelta(seconds=expires_in)))
+        return token
+
+    def revoke_token(self, token):
+        # only this one, the user's other clients keep theirs
+        api_token = self.api_tokens.filter_by(token_hash=ApiToken.hash(token)).first()
+        if api_token is not None:
+            api_token.revoke()
+
+    @staticmethod
+    def check_token(token):
+        token_hash = ApiToken.hash(token)
+        user_id = token_cache.get_user_id(token_hash)
+        if user_id is not None:
+            return load_user(user_id)
+        api_token = db.session.get(ApiToken, token_hash)
+        if api_token is None or api_token.expiration < datetime.utcnow():
+            return None
+        token_cache.set_user_id(token_hash, api_token.user_id,
+                                (api_token.expiration - datetime.utcnow()).total_seconds())
+        return api_token.user
+
     def new_messages(self):
-        # last_read_time = self.last_message_read_time or datetime(1900, 1, 1) # latter iff former is empty
-        # return Message.query.filter_by(recipient=self).filter(
-        #    Message.timestamp > last_read_time).count()
-        new_messages = 0
-        for user in User.query.all():
-            new_messages += self.new_messages_from_other(user)
-        return new_messages
+        # unread counts are kept per conversation, so this no longer scans every user's messages
+        return db.session.query(db.func.coalesce(db.func.sum(Conversation.unread_count), 0)).filter(
+            Conversation.user_id == self.id).scalar()
+
+    def mark_messages_read(self):
+        self.last_message_read_time = datetime.utcnow()
+        Conversation.query.filter(Conversation.user_id == self.id, Conversation.unread_count > 0).update(
+            {'unread_count': 0}, synchronize_session=False)
+
+    def send_message(self, recipient, body, language):
+        msg = Message(author=self, recipient=recipient, body=body, language=language)
+        db.session.add(msg)
+        Conversation.record(msg)
+        return msg
 
     def new_messages_from_other(self, other):
         last_read_time = self.last_message_read_time or datetime(1900, 1, 1) # latter iff former is empty
@@ -165,30 +353,53 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     # def last_read_time_other(self, other):
 
     def all_messages_with_other(self, other):
-        received = Message.query.filter_by(author=other).filter_by(recipient=self)
-        sent = Message.query.filter_by(author=self).filter_by(recipient=other)
-        return received.union(sent).order_by(Message.timestamp.desc())
+        # one query over the (sender_id, recipient_id, timestamp) index instead of a UNION of two
+        return Message.query.filter(db.or_(
+            db.and_(Message.sender_id == other.id, Message.recipient_id == self.id),
+            db.and_(Message.sender_id == self.id, Message.recipient_id == other.id))).order_by(
+                Message.timestamp.desc())
 
     def messages_from_other(self, other):
         return Message.query.filter_by(author=other).filter_by(recipient=self).count()
 
     def add_notification(self, name, data):
-        self.notifications.filter_by(name=name).delete() # not db.session.delete
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
-        db.session.add(n)
-        return n # why both add n and return n ?
+        # one row per (user, name), updated in place
+        if name in current_app.config['NOTIFICATIONS_IN_REDIS'] and live_notifications.add(self.id, name, data):
+            return
+        Notification.upsert(self.id, name, json.dumps(data))
+
+    def notifications_since(self, since):
+        notifications = [{'name': n.name, 'data': n.get_data(), 'timestamp': n.timestamp}
+                         for n in self.notifications.filter(Notification.timestamp > since)]
+        notifications += live_notifications.since(self.id, since)
+        return sorted(notifications, key=lambda n: n['timestamp'])
 
     def launch_task(self, name, description, *args, **kwargs):
-        rq_job = current_app.task_queue.enqueue('app.tasks.' + name, self.id, # how can we include user.id here?
-                                                *args, **kwargs)
+        # None if the user already has as many of these tasks as TASK_TYPES allows
+        rq_job = task_queues.launch(name, self.id, *args, **kwargs) # how can we include user.id here?
+        if rq_job is None:
+            return None
         task = Task(id=rq_job.get_id(), name=name, description=description, user=self)
         db.session.add(task)
+        task_status.remember(self.id, True)
         return task
 
     def get_tasks_in_progress(self):
-        return Task.query.filter_by(user=self, complete=False).all()
+        if task_status.has_tasks_in_progress(self.id) is False:
+            return []
+        tasks = Task.query.filter_by(user=self, complete=False).all()
+        task_status.remember(self.id, bool(tasks))
+        return tasks
+
+    def get_tasks_progress(self):
+        # [(task, progress)] with all the progress values read from Redis at once
+        tasks = self.get_tasks_in_progress()
+        progress = task_status.get_progress([task.id for task in tasks])
+        return [(task, progress[task.id]) for task in tasks]
 
     def get_task_in_progress(self, name):
+        if task_status.has_tasks_in_progress(self.id) is False:
+            return None
         return Task.query.filter_by(name=name, user=self, complete=False).first()
         # task.complete is set in task helper
 
@@ -198,9 +409,9 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
             'username': self.username,
             'last_seen': self.last_seen.isoformat() + 'Z',
             'about_me': self.about_me,
-            'post_count': self.posts.count(),
-            'follower_count': self.followers.count(),
-            'followed_count': self.followed.count(),
+            'post_count': self.post_count(),
+            'follower_count': self.follower_count(),
+            'followed_count': self.followed_count(),
             '_links': {
                 'self': url_for('api.get_user', id=self.id),
                 'followers': url_for('api.get_followers', id=self.id),
@@ -226,10 +437,31 @@ class Post(SearchableMixin, db.Model):
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow) # datetime.utcnow, NOT datetime.utcnow()
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     language = db.Column(db.String(5))
+    __table_args__ = (
+        db.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp'), # profile pages and timelines
+    )
 
     def __repr__(self):
         return '<Post {}>'.format(self.body)
 
+    def cache_tags(self):
+        return ['posts:{}'.format(self.user_id)]
+
+    def author_summary(self):
+        # (username, email digest) of the author, from the lookup tables if they have it, so a page of
+        # posts doesn't load every author
+        summary = lookup_tables.user_summary(self.user_id)
+        if summary is None:
+            author = self.author
+            summary = author.username, author.email_digest or email_digest(author.email)
+        return summary
+
+    def author_username(self):
+        return self.author_summary()[0]
+
+    def author_avatar(self, size):
+        return avatar_url(self.author_summary()[1], size)
+
 db.event.listen(db.session, 'before_commit', Post.before_commit) # purpose of middle component ?
 db.event.listen(db.session, 'after_commit', Post.after_commit)
 
@@ -240,20 +472,109 @@ class Message(db.Model):
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     language = db.Column(db.String(5))
+    __table_args__ = (
+        db.Index('ix_message_sender_id_recipient_id_timestamp', 'sender_id', 'recipient_id', 'timestamp'),
+    )
 
     def __repr__(self):
         return '<Message {}>'.format(self.body)
 
+class Conversation(db.Model):
+    # denormalized summary of the messages between two users, one row for each side
+    # so the inbox and outbox are an index range scan on (user_id, timestamp) instead of a GROUP BY
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    other_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    last_received_id = db.Column(db.Integer, db.ForeignKey('message.id'))
+    last_received_timestamp = db.Column(db.DateTime)
+    last_sent_id = db.Column(db.Integer, db.ForeignKey('message.id'))
+    last_sent_timestamp = db.Column(db.DateTime)
+    unread_count = db.Column(db.Integer, nullable=False, default=0)
+    last_received = db.relationship('Message', foreign_keys=[last_received_id])
+    last_sent = db.relationship('Message', foreign_keys=[last_sent_id])
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'other_id', name='uq_conversation_user_id_other_id'),
+        db.Index('ix_conversation_user_id_last_received_timestamp', 'user_id', 'last_received_timestamp'),
+        db.Index('ix_conversation_user_id_last_sent_timestamp', 'user_id', 'last_sent_timestamp'),
+    )
+
+    @staticmethod
+    def between(user, other):
+        conversation = Conversation.query.filter_by(user_id=user.id, other_id=other.id).first()
+        if conversation is None:
+            conversation = Conversation(user_id=user.id, other_id=other.id, unread_count=0)
+            db.session.add(conversation)
+        return conversation
+
+    @staticmethod
+    def record(message):
+        # called when a message is added to the session, the summaries are written in the same commit
+        if message.timestamp is None:
+            message.timestamp = datetime.utcnow() # the column default would only be applied at insert
+        sent = Conversation.between(message.author, message.recipient)
+        sent.last_sent = message
+        sent.last_sent_timestamp = message.timestamp
+        received = Conversation.between(message.recipient, message.author)
+        received.last_received = message
+        received.last_received_timestamp = message.timestamp
+        if received.id is None:
+            received.unread_count = 1
+        else:
+            received.unread_count = Conversation.unread_count + 1 # incremented in SQL, not in Python
+
+    @staticmethod
+    def backfill():
+        # rebuilds every summary from the message table, ties on timestamp are broken by message id
+        Conversation.query.delete()
+        last_ids = db.session.query(db.func.max(Message.id)).group_by(
+            Message.sender_id, Message.recipient_id)
+        for message in Message.query.filter(Message.id.in_(last_ids)).order_by(Message.id):
+            sent = Conversation.between(message.author, message.recipient)
+            sent.last_sent = message
+            sent.last_sent_timestamp = message.timestamp
+            received = Conversation.between(message.recipient, message.author)
+            received.last_received = message
+            received.last_received_timestamp = message.timestamp
+            db.session.flush()
+        unread = db.session.query(Message.recipient_id, Message.sender_id, db.func.count(Message.id)).join(
+            User, User.id == Message.recipient_id).filter(
+                Message.timestamp > db.func.coalesce(User.last_message_read_time, datetime(1900, 1, 1))).group_by(
+                    Message.recipient_id, Message.sender_id)
+        for user_id, other_id, count in unread.all():
+            Conversation.query.filter_by(user_id=user_id, other_id=other_id).update(
+                {'unread_count': count}, synchronize_session=False)
+        return Conversation.query.count()
+
 class Notification(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128), index=True) # name == 'unread_message_count'
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     timestamp = db.Column(db.Float, index=True, default=time) # time() is a float, not a datetime object!
     payload_json = db.Column(db.Text)
+    __table_args__ = (
+        db.Index('ix_notification_user_id_name', 'user_id', 'name', unique=True),
+    )
 
     def get_data(self):
         return json.loads(str(self.payload_json)) # since json.dumps returns a string, why is str() necessary?
 
+    @staticmethod
+    def upsert(user_id, name, payload_json):
+        # a single INSERT ... ON CONFLICT DO UPDATE, instead of deleting the old row and inserting a new one
+        values = {'user_id': user_id, 'name': name, 'payload_json': payload_json, 'timestamp': time()}
+        dialect = db.session.get_bind().dialect.name
+        if dialect in ('sqlite', 'postgresql'):
+            insert = import_module('sqlalchemy.dialects.' + dialect).insert
+            statement = insert(Notification).values(**values)
+            db.session.execute(statement.on_conflict_do_update(
+                index_elements=['user_id', 'name'],
+                set_={'payload_json': statement.excluded.payload_json, 'timestamp': statement.excluded.timestamp}))
+            return
+        updated = db.session.execute(db.update(Notification).where(
+            Notification.user_id == user_id, Notification.name == name).values(**values)).rowcount
+        if not updated:
+            db.session.execute(db.insert(Notification).values(**values))
+
     # def __repr__(self):
     #    return '<Notification {}>'.format(self.id)
 
@@ -263,9 +584,13 @@ class Task(db.Model):
     description = db.Column(db.String(128))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     complete = db.Column(db.Boolean, default=False)
+    __table_args__ = (
+        db.Index('ix_task_user_id_complete', 'user_id', 'complete'),
+    )
     # no timestamp for when task was initiated
 
     def get_rq_job(self):
+        import rq.job
         try:
             rq_job = rq.job.Job.fetch(self.id, connection=current_app.redis) # like rq.get_current_job()
         except (redis.exceptions.RedisError, rq.exceptions.NoSuchJobError):
@@ -277,7 +602,27 @@ class Task(db.Model):
         return job.meta.get('progress', 0) if job is not None else 100
         # manually add 'progress' key to job.meta dictionary ?
 
+class ApiToken(db.Model):
+    token_hash = db.Column(db.String(64), primary_key=True) # only the SHA-256 of a token is stored
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    expiration = db.Column(db.DateTime)
+
+    @staticmethod
+    def hash(token):
+        return sha256(token.encode('utf-8')).hexdigest()
+
+    def revoke(self):
+        # dropped from the cache once this is committed
+        db.session.info.setdefault('revoked_tokens', set()).add(self.token_hash)
+        db.session.delete(self)
+
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    fields = user_cache.get(int(id))
+    if fields is not None:
+        return user_cache.attach(db.session, User, fields)
+    user = db.session.get(User, int(id))
+    if user is not None:
+        user_cache.put(user)
+    return user
 # UserMixin includes get_id(), which generates unique identifier (as string) for a given user
\ No newline at end of file
@@ -0,0 +1,34 @@
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+from concurrent.futures import ProcessPoolExecutor
+import functools
+
+# password hashing parameters come from PASSWORD_HASH_METHOD, e.g. 'scrypt:32768:8:1' or 'pbkdf2:sha256:600000'
+# hashes made with other parameters still verify, and are replaced at the next successful login
+# with PASSWORD_HASH_WORKERS > 0, verification runs in a process pool, so with threaded or gevent workers
+# a slow hash doesn't hold the GIL (or the event loop) while other requests wait
+
+@functools.lru_cache(maxsize=None)
+def _method_prefix(method):
+    # werkzeug fills in default arguments ('scrypt' -> 'scrypt:32768:8:1'), so compare against a real hash
+    return generate_password_hash('', method=method, salt_length=1).split('$', 1)[0]
+
+def hash_password(password):
+    return generate_password_hash(password, method=current_app.config['PASSWORD_HASH_METHOD'],
+                                  salt_length=current_app.config['PASSWORD_SALT_LENGTH'])
+
+def needs_rehash(pwhash):
+    return pwhash.split('$', 1)[0] != _method_prefix(current_app.config['PASSWORD_HASH_METHOD'])
+
+def _get_pool():
+    app = current_app._get_current_object()
+    if 'password_pool' not in app.extensions:
+        app.extensions['password_pool'] = ProcessPoolExecutor(max_workers=app.config['PASSWORD_HASH_WORKERS'])
+    return app.extensions['password_pool']
+
+def verify_password(pwhash, password):
+    if not pwhash:
+        return False
+    if current_app.config['PASSWORD_HASH_WORKERS']:
+        return _get_pool().submit(check_password_hash, pwhash, password).result()
+    return check_password_hash(pwhash, password)
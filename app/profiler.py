@@ -0,0 +1,182 @@
+from flask import current_app, g, request
+from collections import Counter
+from threading import Thread, Event, Lock, get_ident
+import os
+import random
+import sys
+import time
+import zlib
+
+# opt-in sampling profiler: a fraction of requests (PROFILER_SAMPLE_RATE), requests to PROFILER_ENDPOINTS,
+# and requests sending PROFILER_TOKEN in an X-Profile header have their thread's stack sampled every
+# PROFILER_INTERVAL seconds by a background thread; the samples are written to
+# PROFILER_DIR/<endpoint>/<time>-<pid>.collapsed in the collapsed stack format ("a;b;c 12" per line),
+# which flamegraph.pl and speedscope read, and "flask profile" aggregates
+# only the newest PROFILER_MAX_FILES files of each endpoint are kept
+# when nothing is configured no hooks are registered, so requests pay nothing
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno).replace(';', ':')
+
+def collapse(frame):
+    # root first, as in the collapsed stack format
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Sampler(object):
+    # one thread per process samples every registered thread, and sleeps while there are none
+    def __init__(self, interval):
+        self.interval = interval
+        self.samples = {} # thread id -> Counter of collapsed stacks
+        self.lock = Lock()
+        self.wake = Event()
+        self.thread = None
+
+    def register(self, thread_id):
+        with self.lock:
+            self.samples[thread_id] = Counter()
+            if self.thread is None or not self.thread.is_alive(): # none survive a fork
+                self.thread = Thread(target=self._run, daemon=True)
+                self.thread.start()
+        self.wake.set()
+
+    def unregister(self, thread_id):
+        with self.lock:
+            return self.samples.pop(thread_id, Counter())
+
+    def _run(self):
+        while True:
+            self.wake.wait()
+            with self.lock:
+                if not self.samples:
+                    self.wake.clear()
+                    continue
+                frames = sys._current_frames()
+                for thread_id, counter in self.samples.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        counter[collapse(frame)] += 1
+            time.sleep(self.interval)
+
+
+def _wants_profile():
+    config = current_app.config
+    token = config['PROFILER_TOKEN']
+    if token and request.headers.get('X-Profile') == token:
+        return True
+    if request.endpoint in config['PROFILER_ENDPOINTS']:
+        return True
+    return random.random() < config['PROFILER_SAMPLE_RATE']
+
+def _start():
+    if _wants_profile():
+        g.profile_thread = get_ident()
+        current_app.extensions['profiler'].register(g.profile_thread)
+
+def _stop(exc):
+    thread_id = g.pop('profile_thread', None)
+    if thread_id is None:
+        return
+    samples = current_app.extensions['profiler'].unregister(thread_id)
+    if samples:
+        write(samples, request.endpoint or 'unmatched')
+
+def write(samples, endpoint):
+    directory = os.path.join(current_app.config['PROFILER_DIR'], endpoint)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, '{:.3f}-{}.collapsed'.format(time.time(), os.getpid()))
+    with open(path, 'w') as f:
+        for stack, count in samples.most_common():
+            f.write('{} {}\n'.format(stack, count))
+    prune(directory, current_app.config['PROFILER_MAX_FILES'])
+    return path
+
+def prune(directory, keep):
+    # file names start with the time, so the oldest sort first
+    names = sorted(name for name in os.listdir(directory) if name.endswith('.collapsed'))
+    for name in names[:max(0, len(names) - keep)]:
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError: # another worker pruned it
+            pass
+
+def init_app(app):
+    config = app.config
+    if not (config['PROFILER_SAMPLE_RATE'] or config['PROFILER_ENDPOINTS'] or config['PROFILER_TOKEN']):
+        return
+    app.extensions['profiler'] = Sampler(config['PROFILER_INTERVAL'])
+    app.before_request(_start)
+    app.teardown_request(_stop)
+
+# reading profiles back, for the "flask profile" commands
+
+def load(directory, endpoints=None, since=None):
+    # merges the collapsed files of the given endpoints (all by default), returns (Counter, files read)
+    stacks = Counter()
+    files = 0
+    if not os.path.isdir(directory):
+        return stacks, files
+    for endpoint in sorted(os.listdir(directory)):
+        if endpoints and endpoint not in endpoints:
+            continue
+        for name in os.listdir(os.path.join(directory, endpoint)):
+            path = os.path.join(directory, endpoint, name)
+            if not name.endswith('.collapsed') or (since and os.path.getmtime(path) < since):
+                continue
+            files += 1
+            with open(path) as f:
+                for line in f:
+                    stack, _, count = line.rstrip('\n').rpartition(' ')
+                    stacks[stack] += int(count)
+    return stacks, files
+
+def top(stacks, count):
+    # [(frame, self samples, total samples)] for the frames with the most samples of their own
+    own = Counter()
+    total = Counter()
+    for stack, samples in stacks.items():
+        frames = stack.split(';')
+        own[frames[-1]] += samples
+        for frame in set(frames):
+            total[frame] += samples
+    return [(frame, samples, total[frame]) for frame, samples in own.most_common(count)]
+
+def flamegraph(stacks, title='Flame graph', width=1200, row=16):
+    # an SVG icicle graph (the root at the top): each frame is as wide as its share of the samples
+    tree = {}
+    for stack, samples in stacks.items():
+        node = tree
+        for frame in stack.split(';'):
+            entry = node.setdefault(frame, [0, {}])
+            entry[0] += samples
+            node = entry[1]
+    total = sum(stacks.values()) or 1
+    rects = []
+    def layout(node, x, depth):
+        for frame, (samples, children) in sorted(node.items()):
+            w = width * samples / total
+            if w >= 0.5:
+                rects.append((x, depth, w, frame, samples))
+                layout(children, x, depth + 1)
+            x += w
+    layout(tree, 0.0, 1)
+    depth = max([rect[1] for rect in rects] or [0]) + 1
+    escape = lambda text: text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+    parts = ['<svg xmlns="http://www.w3.org/2000/svg" width="{}" height="{}" font-family="monospace" '
+             'font-size="11">'.format(width, depth * row + 4),
+             '<text x="4" y="12">{} ({} samples)</text>'.format(escape(title), total)]
+    for x, level, w, frame, samples in rects:
+        hue = 10 + zlib.crc32(frame.split(' ')[0].encode()) % 50 # the same colour for a function every time
+        label = frame if len(frame) * 7 < w - 4 else frame[:max(0, int((w - 4) / 7) - 2)] + '..'
+        parts.append('<g><title>{} ({} samples, {:.1f}%)</title><rect x="{:.1f}" y="{}" width="{:.1f}" height="{}" '
+                     'fill="hsl({},80%,60%)" stroke="white"/>{}</g>'.format(
+                         escape(frame), samples, 100.0 * samples / total, x, level * row, w, row, hue,
+                         '<text x="{:.1f}" y="{}">{}</text>'.format(x + 2, level * row + 12, escape(label))
+                         if w > 20 else ''))
+    parts.append('</svg>')
+    return '\n'.join(parts)
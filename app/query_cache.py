@@ -0,0 +1,130 @@
+from flask import current_app, g, has_request_context
+from collections import OrderedDict
+from threading import Lock
+from app import db, metrics
+import json
+import time
+import redis
+
+# results of repeated queries (ids and counts, never ORM objects), cached in Redis for all workers and
+# for a few seconds in each worker, and dropped by tag when a commit changes what they were read from
+# every tag has a version in Redis, which a commit touching the tag moves on; an entry is stored with
+# the versions its tags had before the query ran, and is only used while they are still current, so a
+# result read while another worker committed is never served as fresh
+# versions come from one counter that never expires, so a tag key that expired and is set again can't
+# get back a version an entry was stored with; tag keys outlive the entries (twice QUERY_CACHE_TTL), so
+# an entry stored while a tag had no key has expired before that tag's key can expire again
+# models list the tags a change to them affects in cache_tags(), changes made without ORM objects
+# (e.g. bulk updates) are announced with changed()
+
+_lock = Lock()
+
+CLOCK_KEY = 'qcache:clock'
+
+# the next version of the counter, for every tag of a commit
+_INVALIDATE = """
+local version = redis.call('incr', KEYS[1])
+for i = 2, #KEYS do
+    redis.call('set', KEYS[i], version, 'ex', ARGV[1])
+end
+"""
+
+def _tag_key(tag):
+    return 'qcache:tag:{}'.format(tag)
+
+def _key(name, args):
+    return 'qcache:{}:{}'.format(name, ':'.join(str(arg) for arg in args))
+
+def _local():
+    # key -> (expires at, tags, value), least recently used first, kept per application
+    return current_app.extensions.setdefault('query_cache', OrderedDict())
+
+def _get_local(key):
+    with _lock:
+        local = _local()
+        entry = local.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return False, None
+        local.move_to_end(key)
+        return True, entry[2]
+
+def _put_local(key, tags, value):
+    with _lock:
+        local = _local()
+        local[key] = (time.monotonic() + current_app.config['QUERY_CACHE_LOCAL_TTL'], set(tags), value)
+        local.move_to_end(key)
+        while len(local) > current_app.config['QUERY_CACHE_LOCAL_SIZE']:
+            local.popitem(last=False)
+
+def _bypass(session):
+    # a session with uncommitted changes must see them
+    return session.new or session.dirty or session.deleted or session.info.get('cache_tags')
+
+def _from_replica():
+    # what a lagging replica returns could be older than the tag versions read before the query
+    return has_request_context() and g.get('db_replica', False)
+
+def get(name, args, tags, load):
+    # the cached result of load(), which must return something JSON can store
+    if _bypass(db.session):
+        return load()
+    key = _key(name, args)
+    found, value = _get_local(key)
+    if found:
+        metrics.cache_lookup(name + '_local', True)
+        return value
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        pipe.get(key)
+        pipe.mget([_tag_key(tag) for tag in tags])
+        data, versions = pipe.execute()
+    except redis.exceptions.RedisError:
+        return load()
+    versions = [int(version or 0) for version in versions]
+    if data is not None:
+        stored_versions, value = json.loads(data)
+        if stored_versions == versions:
+            metrics.cache_lookup(name, True)
+            _put_local(key, tags, value)
+            return value
+    metrics.cache_lookup(name, False)
+    value = load()
+    if _from_replica():
+        return value
+    try:
+        current_app.redis.set(key, json.dumps([versions, value]), ex=current_app.config['QUERY_CACHE_TTL'])
+    except redis.exceptions.RedisError:
+        pass
+    _put_local(key, tags, value)
+    return value
+
+def invalidate(*tags):
+    tags = set(tags)
+    with _lock:
+        local = _local()
+        for key in [key for key, entry in local.items() if entry[1] & tags]:
+            del local[key]
+    try:
+        script = current_app.redis.register_script(_INVALIDATE)
+        script(keys=[CLOCK_KEY] + [_tag_key(tag) for tag in sorted(tags)],
+               args=[2 * current_app.config['QUERY_CACHE_TTL']])
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Could not invalidate cached queries %s', sorted(tags))
+
+def changed(session, *tags):
+    # tags of changes in this transaction, dropped once it commits
+    session.info.setdefault('cache_tags', set()).update(tags)
+
+def _collect_tags(session, flush_context):
+    # after a flush the changed objects (and their old values) are still there, at commit time they may not be
+    for obj in session.new.union(session.dirty).union(session.deleted):
+        if hasattr(obj, 'cache_tags'):
+            changed(session, *obj.cache_tags())
+
+def _invalidate_tags(session):
+    tags = session.info.pop('cache_tags', None)
+    if tags:
+        invalidate(*tags)
+
+def _discard_tags(session, previous_transaction):
+    session.info.pop('cache_tags', None)
@@ -0,0 +1,66 @@
+from flask import current_app, g, has_request_context, session as client_session
+from flask_sqlalchemy.session import Session
+from functools import wraps
+import sqlalchemy as sa
+import time
+
+# with DATABASE_REPLICA_URL set, the SELECTs of views marked @replica go to a read replica (the
+# "replica" bind) and everything else to the primary
+# a client that committed something reads from the primary for DATABASE_REPLICA_STICKY seconds
+# (remembered in its session cookie), so it sees its own writes even if the replica lags behind,
+# and so does the rest of a request once it has written
+
+def engine_options(app, url):
+    options = {'pool_pre_ping': app.config['DATABASE_POOL_PRE_PING'],
+               'pool_recycle': app.config['DATABASE_POOL_RECYCLE']}
+    if not url.startswith('sqlite'): # SQLite's pools have no size
+        options.update(pool_size=app.config['DATABASE_POOL_SIZE'], max_overflow=app.config['DATABASE_MAX_OVERFLOW'],
+                       pool_timeout=app.config['DATABASE_POOL_TIMEOUT'])
+    return options
+
+def configure(app):
+    # before db.init_app, options set in SQLALCHEMY_ENGINE_OPTIONS win
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(engine_options(app, app.config['SQLALCHEMY_DATABASE_URI']),
+                                                   **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    url = app.config['DATABASE_REPLICA_URL']
+    if url:
+        app.config['SQLALCHEMY_BINDS'] = dict(app.config.get('SQLALCHEMY_BINDS') or {},
+                                              replica=dict(engine_options(app, url), url=url))
+
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and _reads_replica(self, clause):
+            return self._db.engines['replica']
+        return super(RoutingSession, self).get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+def _reads_replica(session, clause):
+    return has_request_context() and g.get('db_replica', False) and not session._flushing and \
+        isinstance(clause, sa.Select) and clause._for_update_arg is None # not SELECT ... FOR UPDATE
+
+def replica(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if current_app.config['DATABASE_REPLICA_URL']:
+            written = client_session.get('db_written', 0)
+            g.db_replica = time.time() - written > current_app.config['DATABASE_REPLICA_STICKY']
+        return f(*args, **kwargs)
+    return decorated_function
+
+def _after_flush(session, flush_context):
+    if has_request_context() and current_app.config['DATABASE_REPLICA_URL']:
+        g.db_replica = False
+        g.db_written = True
+
+def _after_commit(session):
+    if has_request_context() and g.pop('db_written', False):
+        client_session['db_written'] = time.time()
+
+def _after_soft_rollback(session, previous_transaction):
+    if has_request_context():
+        g.pop('db_written', None)
+
+def listen(scoped_session):
+    sa.event.listen(scoped_session, 'after_flush', _after_flush)
+    sa.event.listen(scoped_session, 'after_commit', _after_commit)
+    sa.event.listen(scoped_session, 'after_soft_rollback', _after_soft_rollback)
@@ -0,0 +1,208 @@
+from flask import current_app
+from datetime import timedelta
+from rq import get_current_job
+from rq.exceptions import NoSuchJobError
+from rq.job import Job, JobStatus
+from rq.registry import clean_registries
+from app import db, task_queues
+from app.search import count_index
+import time
+import uuid
+import redis
+
+# periodic maintenance, run by the task workers: a tick job runs every SCHEDULER_TICK seconds,
+# starts whichever of SCHEDULER_JOBS are due, and schedules the next tick (workers need --with-scheduler)
+# each job takes a lease in Redis for its interval, so it runs once per interval however many ticks there are
+# start it with "flask scheduler start", run times and results are in "flask scheduler stats"
+# there is one chain of ticks: TICK_KEY holds the job id of its next tick, a tick only schedules the next one
+# while the key still holds its own id, and start() only starts a chain when that job is gone
+
+TICK_KEY = 'scheduler:next-tick'
+
+# moves the chain on to ARGV[2] if KEYS[1] still holds ARGV[1] ('' for no chain), in one step so that
+# of two ticks, or two deploys, only one carries the chain on
+_ADVANCE = """
+if (redis.call('get', KEYS[1]) or '') ~= ARGV[1] then
+    return 0
+end
+redis.call('set', KEYS[1], ARGV[2])
+return 1
+"""
+
+def _lease_key(name):
+    return 'scheduler:lease:{}'.format(name)
+
+def _stats_key(name):
+    return 'scheduler:stats:{}'.format(name)
+
+def prune_notifications():
+    # clients only ask for notifications since their last poll, so old ones are never read again
+    from app.models import Notification
+    cutoff = time.time() - current_app.config['NOTIFICATION_RETENTION']
+    count = Notification.query.filter(Notification.timestamp < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+    return count
+
+def prune_tasks(batch_size=500):
+    # a completed task is only shown while its RQ job exists, so drop those whose job has expired
+    from app.models import Task
+    count = 0
+    last_id = ''
+    while True:
+        ids = [task_id for task_id, in db.session.query(Task.id).filter(Task.complete == True, Task.id > last_id)
+               .order_by(Task.id).limit(batch_size)]
+        if not ids:
+            return count
+        pipe = current_app.redis.pipeline(transaction=False)
+        for task_id in ids:
+            pipe.exists(Job.key_for(task_id))
+        expired = [task_id for task_id, exists in zip(ids, pipe.execute()) if not exists]
+        if expired:
+            Task.query.filter(Task.id.in_(expired)).delete(synchronize_session=False)
+            db.session.commit()
+        count += len(expired)
+        last_id = ids[-1]
+
+def clean_queues():
+    # moves expired jobs out of the started/finished/failed registries and deletes their hashes
+    for queue in current_app.task_queues.values():
+        clean_registries(queue)
+    return len(current_app.task_queues)
+
+def compact_redis(count=500):
+    # cache keys are written with an expiry, one without (e.g. from an interrupted write) would live forever
+    ttls = current_app.config['SCHEDULER_KEY_TTLS']
+    fixed = 0
+    for pattern, ttl in ttls.items():
+        for key in current_app.redis.scan_iter(match=pattern, count=count):
+            if current_app.redis.ttl(key) == -1:
+                current_app.redis.expire(key, ttl)
+                fixed += 1
+    return fixed
+
+def verify_search_index():
+    # compares the number of indexed documents with the rows they index, reindexing on a mismatch
+    from app.models import SearchableMixin
+    if not current_app.elasticsearch:
+        return None
+    mismatched = 0
+    for model in SearchableMixin.__subclasses__():
+        indexed = count_index(model.__tablename__)
+        rows = db.session.query(db.func.count(model.id)).scalar()
+        if indexed != rows:
+            current_app.logger.warning('Search index %s has %d documents for %d rows',
+                                       model.__tablename__, indexed, rows)
+            mismatched += 1
+            if current_app.config['SEARCH_INDEX_REPAIR']:
+                model.reindex()
+    return mismatched
+
+def rebuild_suggestions():
+    from app import suggestions
+    return suggestions.compute_all()
+
+def detect_languages():
+    from app import language
+    from app.models import Post, Message
+    return language.backfill(Post) + language.backfill(Message)
+
+def prune_avatars():
+    # drops generated avatars of emails no user has any more, see app/avatars.py
+    from app import avatars
+    from app.models import User
+    return avatars.prune(User.known_email_digests)
+
+JOBS = {
+    'prune_notifications': prune_notifications,
+    'prune_tasks': prune_tasks,
+    'clean_queues': clean_queues,
+    'compact_redis': compact_redis,
+    'verify_search_index': verify_search_index,
+    'rebuild_suggestions': rebuild_suggestions,
+    'detect_languages': detect_languages,
+    'prune_avatars': prune_avatars,
+}
+
+def run_job(name):
+    # runs one job and records how long it took and what it returned
+    started = time.time()
+    try:
+        result = JOBS[name]()
+    except Exception:
+        db.session.rollback()
+        current_app.logger.error('Scheduled job %s failed', name, exc_info=True)
+        _record(name, {'last_failure': started}, failures=1)
+        return None
+    duration = time.time() - started
+    _record(name, {'last_run': started, 'last_seconds': duration, 'last_result': '' if result is None else result},
+            runs=1, total_seconds=duration)
+    current_app.logger.info('Scheduled job %s returned %s in %.2fs', name, result, duration)
+    return result
+
+def _record(name, fields, **increments):
+    pipe = current_app.redis.pipeline()
+    for field, amount in increments.items():
+        pipe.hincrbyfloat(_stats_key(name), field, amount)
+    pipe.hset(_stats_key(name), mapping=fields)
+    try:
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Could not record stats of scheduled job %s', name)
+
+def due_jobs():
+    connection = current_app.redis
+    for name, interval in current_app.config['SCHEDULER_JOBS'].items():
+        if interval and connection.set(_lease_key(name), int(time.time()), nx=True, ex=interval):
+            yield name
+
+def tick():
+    # keeps the chain alive first, so a slow or failing job doesn't stop the scheduler;
+    # a tick of a chain that has been replaced ends it instead
+    job = get_current_job()
+    if not _schedule_next(job.id if job else ''):
+        current_app.logger.warning('Scheduler tick %s is not the next one of the chain, ending it',
+                                   job.id if job else None)
+        return []
+    ran = []
+    for name in due_jobs():
+        run_job(name)
+        ran.append(name)
+    return ran
+
+def _advance(tick_id, next_id):
+    return bool(current_app.redis.register_script(_ADVANCE)(keys=[TICK_KEY], args=[tick_id, next_id]))
+
+def _schedule_next(tick_id):
+    next_id = str(uuid.uuid4())
+    if not _advance(tick_id, next_id):
+        return False
+    task_queues.enqueue_in('default', timedelta(seconds=current_app.config['SCHEDULER_TICK']),
+                           'app.tasks.scheduler_tick', job_id=next_id)
+    return True
+
+def _waiting(tick_id):
+    # whether the tick is still to run (scheduled or queued) or running
+    try:
+        status = Job.fetch(tick_id, connection=current_app.redis).get_status()
+    except NoSuchJobError:
+        return False
+    return status in (JobStatus.SCHEDULED, JobStatus.QUEUED, JobStatus.DEFERRED, JobStatus.STARTED)
+
+def start():
+    # enqueues the first tick unless the chain's next tick is still waiting, so it is safe to call on
+    # every deploy; a chain whose next tick was lost (e.g. with a worker) is replaced
+    current = current_app.redis.get(TICK_KEY)
+    current = current.decode() if current else ''
+    if current and _waiting(current):
+        return False
+    next_id = str(uuid.uuid4())
+    if not _advance(current, next_id):
+        return False # another deploy started one meanwhile
+    task_queues.enqueue('default', 'app.tasks.scheduler_tick', job_id=next_id)
+    return True
+
+def stats():
+    try:
+        return {name: current_app.redis.hgetall(_stats_key(name)) for name in JOBS}
+    except redis.exceptions.RedisError:
+        return {}
@@ -0,0 +1,100 @@
+from flask import current_app
+from app import db, task_queues
+from app.models import followers
+from sqlalchemy import and_, func
+import heapq
+import redis
+
+# "who to follow" suggestions are precomputed into one Redis sorted set per user
+# a candidate's score is the number of people the user follows who follow the candidate
+# more candidates are stored than displayed, so follow events can update the sets incrementally
+# and suggestions that get followed are replaced from the surplus
+
+def _key(user_id):
+    return 'suggestions:{}'.format(user_id)
+
+def second_degree_counts(first_id, last_id):
+    # one set-based pass over the follow graph for a range of users, using the followers indexes
+    f1 = followers.alias('f1') # user -> followed
+    f2 = followers.alias('f2') # followed -> candidate
+    f3 = followers.alias('f3') # user -> candidate, must not exist
+    return db.session.query(f1.c.follower_id, f2.c.followed_id, func.count().label('score')).join(
+        f2, f2.c.follower_id == f1.c.followed_id).outerjoin(
+            f3, and_(f3.c.follower_id == f1.c.follower_id, f3.c.followed_id == f2.c.followed_id)).filter(
+                f1.c.follower_id.between(first_id, last_id),
+                f2.c.followed_id != f1.c.follower_id,
+                f3.c.follower_id.is_(None)).group_by(f1.c.follower_id, f2.c.followed_id)
+
+def compute_all(batch_size=500):
+    stored = current_app.config['FOLLOW_SUGGESTIONS_STORED']
+    last_id = db.session.query(func.max(followers.c.follower_id)).scalar() or 0
+    computed = 0
+    for first_id in range(1, last_id + 1, batch_size):
+        candidates = {}
+        for user_id, candidate_id, score in second_degree_counts(first_id, first_id + batch_size - 1):
+            candidates.setdefault(user_id, []).append((score, candidate_id))
+        pipe = current_app.redis.pipeline(transaction=False)
+        for user_id in range(first_id, min(first_id + batch_size, last_id + 1)):
+            pipe.delete(_key(user_id))
+            top = heapq.nlargest(stored, candidates.get(user_id, []))
+            if top:
+                pipe.zadd(_key(user_id), {candidate_id: score for score, candidate_id in top})
+        pipe.execute()
+        computed += len(candidates)
+    return computed
+
+def get(user_id, count):
+    try:
+        return [int(candidate_id) for candidate_id in current_app.redis.zrevrange(_key(user_id), 0, count - 1)]
+    except redis.exceptions.RedisError:
+        return []
+
+def schedule_update(changes):
+    # changes is a list of committed (follower_id, followed_id, followed) tuples
+    try:
+        for follower_id, followed_id, following in changes:
+            task_queues.enqueue('interactive', 'app.tasks.update_follow_suggestions',
+                                follower_id, followed_id, following)
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Could not schedule follow suggestion updates')
+
+def apply_follow_change(follower_id, followed_id, following):
+    # when A follows B, B's followed users become candidates for A,
+    # and B becomes a candidate for everyone who follows A (unfollowing reverses both)
+    delta = 1 if following else -1
+    a_followed = set(_followed_ids(follower_id))
+    pipe = current_app.redis.pipeline(transaction=False)
+    for candidate_id in _followed_ids(followed_id):
+        if candidate_id != follower_id and candidate_id not in a_followed:
+            pipe.zincrby(_key(follower_id), delta, candidate_id)
+    for user_id in _followers_not_following(follower_id, followed_id):
+        pipe.zincrby(_key(user_id), delta, followed_id)
+        _trim(pipe, user_id)
+    if following:
+        pipe.zrem(_key(follower_id), followed_id)
+    else:
+        # B can be suggested to A again, scored by how many of A's followed users follow B
+        score = db.session.query(func.count()).filter(
+            followers.c.follower_id.in_(a_followed), followers.c.followed_id == followed_id).scalar()
+        if score:
+            pipe.zadd(_key(follower_id), {followed_id: score})
+    _trim(pipe, follower_id)
+    pipe.execute()
+
+def _trim(pipe, user_id):
+    pipe.zremrangebyscore(_key(user_id), '-inf', 0)
+    pipe.zremrangebyrank(_key(user_id), 0, -current_app.config['FOLLOW_SUGGESTIONS_STORED'] - 1)
+
+def _followed_ids(user_id):
+    return [row.followed_id for row in db.session.query(followers.c.followed_id).filter(
+        followers.c.follower_id == user_id)]
+
+def _followers_not_following(user_id, other_id):
+    # followers of user_id, other than other_id, who don't already follow other_id
+    existing = followers.alias('existing')
+    return [row.follower_id for row in db.session.query(followers.c.follower_id).outerjoin(
+        existing, and_(existing.c.follower_id == followers.c.follower_id,
+                       existing.c.followed_id == other_id)).filter(
+                           followers.c.followed_id == user_id,
+                           followers.c.follower_id != other_id,
+                           existing.c.follower_id.is_(None))]
@@ -0,0 +1,122 @@
+from flask import current_app
+from app import metrics
+import redis
+
+# background work is split over named queues (TASK_QUEUES, highest priority first), so a worker
+# started with all of them always takes interactive jobs (mail, language detection) before bulk ones,
+# and a worker started with only the interactive queue never waits behind an export
+# user-launched tasks (TASK_TYPES) are also capped per user, which replaces the racy
+# "is one already running?" query, and per task type while running
+
+class TaskLimitReached(Exception):
+    pass
+
+def create_queues(app):
+    # app.task_queues, made when first used
+    from rq import Queue
+    return {name: Queue(queue_name, connection=app.redis, default_timeout=app.config['TASK_DEFAULT_TIMEOUT'])
+            for name, queue_name in app.config['TASK_QUEUES'].items()}
+
+def _defaults(kwargs):
+    from rq.job import Callback
+    kwargs.setdefault('result_ttl', current_app.config['TASK_RESULT_TTL'])
+    kwargs.setdefault('failure_ttl', current_app.config['TASK_FAILURE_TTL'])
+    kwargs.setdefault('on_success', Callback(metrics.job_succeeded)) # job durations for /metrics
+    kwargs.setdefault('on_failure', Callback(metrics.job_failed))
+    return kwargs
+
+def enqueue(queue, func, *args, **kwargs):
+    return current_app.task_queues[queue].enqueue(func, *args, **_defaults(kwargs))
+
+def enqueue_in(queue, delay, func, *args, **kwargs):
+    return current_app.task_queues[queue].enqueue_in(delay, func, *args, **_defaults(kwargs))
+
+def task_type(name):
+    return current_app.config['TASK_TYPES'].get(name, {})
+
+def _user_key(name, user_id):
+    return 'task_slots:{}:user:{}'.format(name, user_id)
+
+def _running_key(name):
+    return 'task_slots:{}:running'.format(name)
+
+# take a slot if fewer than ARGV[1] are taken, in one step so two requests can't both get the last one
+_ACQUIRE = """
+local taken = tonumber(redis.call('get', KEYS[1]) or '0')
+if taken >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('incr', KEYS[1])
+redis.call('expire', KEYS[1], ARGV[2])
+return 1
+"""
+
+_RELEASE = """
+if tonumber(redis.call('decr', KEYS[1])) <= 0 then
+    redis.call('del', KEYS[1])
+end
+"""
+
+def _acquire(connection, key, limit, ttl):
+    return bool(connection.register_script(_ACQUIRE)(keys=[key], args=[limit, ttl]))
+
+def _release(connection, key):
+    connection.register_script(_RELEASE)(keys=[key])
+
+def launch(name, user_id, *args, **kwargs):
+    # enqueues app.tasks.<name> for a user, or returns None if the user already has
+    # as many of these tasks as the task type allows
+    from rq.job import Callback
+    settings = task_type(name)
+    timeout = settings.get('timeout', current_app.config['TASK_DEFAULT_TIMEOUT'])
+    if not _acquire(current_app.redis, _user_key(name, user_id), settings.get('per_user', 1), timeout):
+        return None
+    try:
+        return enqueue(settings.get('queue', 'default'), 'app.tasks.' + name, user_id, *args,
+                       job_timeout=timeout, meta={'task_name': name, 'user_id': user_id},
+                       on_failure=Callback(release_after_failure), **kwargs)
+    except redis.exceptions.RedisError:
+        _release(current_app.redis, _user_key(name, user_id))
+        raise
+
+def release(name, user_id):
+    try:
+        _release(current_app.redis, _user_key(name, user_id))
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Could not release %s slot for user %s', name, user_id)
+
+def release_after_failure(job, connection, exc_type, exc_value, traceback):
+    # runs in the worker, without an app context, when a launched task raises; a failed task is not retried
+    metrics.job_failed(job, connection, exc_type, exc_value, traceback)
+    _release(connection, _user_key(job.meta['task_name'], job.meta['user_id']))
+
+def run_limited(name, func, *args):
+    # runs func for a launched task unless the task type's concurrency is used up, in which case the
+    # job returns an rq Retry and is run again (same job, so its Task row still finds it) after
+    # TASK_LIMIT_RETRY_INTERVAL seconds; only this is retried, and the user's slot is kept meanwhile
+    # after TASK_LIMIT_RETRIES tries it fails with TaskLimitReached, which releases the slot
+    from rq import Retry, get_current_job
+    settings = task_type(name)
+    limit = settings.get('concurrency')
+    if not limit:
+        return func(*args)
+    job = get_current_job()
+    timeout = settings.get('timeout', current_app.config['TASK_DEFAULT_TIMEOUT'])
+    interval = current_app.config['TASK_LIMIT_RETRY_INTERVAL']
+    connection = current_app.redis
+    user_key = _user_key(name, job.meta['user_id'])
+    key = _running_key(name)
+    if not _acquire(connection, key, limit, timeout):
+        deferred = job.meta.get('deferred', 0)
+        if deferred >= current_app.config['TASK_LIMIT_RETRIES']:
+            raise TaskLimitReached(name)
+        job.meta['deferred'] = deferred + 1
+        job.save_meta()
+        connection.expire(user_key, timeout + interval) # not before the retry has run
+        # rq counts no retries for a scheduled retry, so "deferred" is what limits them
+        return Retry(max=current_app.config['TASK_LIMIT_RETRIES'], interval=interval)
+    connection.expire(user_key, timeout) # time to run, however long it waited
+    try:
+        return func(*args)
+    finally:
+        _release(connection, key)
@@ -0,0 +1,59 @@
+from flask import current_app
+from app import metrics
+import redis
+
+# a per-user flag saying whether any task may be in progress, so pages for users with no tasks
+# (almost everyone, on almost every page) skip the task query entirely
+# '1' means "check the database", '0' means "nothing in progress" and is only written when no flag exists,
+# so a task launched while a page was looking can't be hidden; completing a task drops the flag
+
+def _key(user_id):
+    return 'tasks_in_progress:{}'.format(user_id)
+
+def has_tasks_in_progress(user_id):
+    # True, False, or None when unknown
+    try:
+        flag = current_app.redis.get(_key(user_id))
+    except redis.exceptions.RedisError:
+        return None
+    metrics.cache_lookup('tasks_in_progress', flag is not None)
+    return None if flag is None else flag == b'1'
+
+def remember(user_id, in_progress):
+    try:
+        if in_progress:
+            current_app.redis.set(_key(user_id), 1, ex=current_app.config['TASK_FLAG_TTL'])
+        else:
+            current_app.redis.set(_key(user_id), 0, ex=current_app.config['TASK_FLAG_TTL'], nx=True)
+    except redis.exceptions.RedisError:
+        pass
+
+def invalidate(user_id):
+    try:
+        current_app.redis.delete(_key(user_id))
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Could not reset task flag for user %s', user_id)
+
+def get_progress(job_ids):
+    # progress of many jobs in one pipelined round trip, reading only each job's meta
+    # a job that no longer exists counts as finished, as in Task.get_progress
+    import rq.job
+    import rq.serializers
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        for job_id in job_ids:
+            key = rq.job.Job.key_for(job_id)
+            pipe.exists(key)
+            pipe.hget(key, 'meta')
+        results = pipe.execute()
+    except redis.exceptions.RedisError:
+        return {job_id: 100 for job_id in job_ids}
+    serializer = rq.serializers.resolve_serializer()
+    progress = {}
+    for i, job_id in enumerate(job_ids):
+        exists, meta = results[2 * i], results[2 * i + 1]
+        if not exists:
+            progress[job_id] = 100
+        else:
+            progress[job_id] = (serializer.loads(meta) if meta else {}).get('progress', 0)
+    return progress
@@ -1,16 +1,20 @@
-from flask import render_template
+from flask import current_app, render_template
 from rq import get_current_job
 from app import db
 from app.models import Task, User, Post, Message
-from app.email import send_email
+from app.email import send_email, drain_outbox, DRAIN_SCHEDULED_KEY
+from datetime import timedelta
+from app import suggestions
+from app import language
+from app import task_status
+from app import task_queues
+from app import scheduler
 import sys
 import time
 import json
 
-from app import create_app
-
-app = create_app() # RQ worker doesn't know about creation of application in rohanapp.py
-app.app_context().push() # really need .push() ?
+# jobs run in the app context that app.worker.Worker creates and pushes when it starts,
+# so importing this module has no side effects
 
 # def example(seconds):
 #     job = get_current_job()
@@ -38,8 +42,14 @@ def _set_task_progress(progress):
         if progress >= 100: # = 100
             task.complete = True
         db.session.commit()
+        if progress >= 100:
+            task_status.invalidate(task.user_id) # the next page load looks again
+            task_queues.release(task.name, task.user_id) # the user may launch another one
 
 def export_posts(user_id):
+    return task_queues.run_limited('export_posts', _export_posts, user_id) # later if too many are running
+
+def _export_posts(user_id):
     try:
         # read user posts from database
         user = User.query.get(user_id)
@@ -52,14 +62,57 @@ def export_posts(user_id):
             time.sleep(2)
             i += 1
             _set_task_progress(100 * i // total_posts) # // is division as int, i.e. division without remainder
+        if total_posts == 0:
+            _set_task_progress(100) # completes the task, and frees the user's slot
         # send email with data to user
         send_email('[RohanApp] Your blog posts',
-                sender=app.config['ADMINS'][0], recipients=[user.email],
+                sender=current_app.config['ADMINS'][0], recipients=[user.email],
                 text_body=render_template('email/export_posts.txt', user=user),
                 html_body=render_template('email/export_posts.html', user=user),
-                attachments=[('posts.json', 'application/json', json.dumps({'posts': data}, indent=4))],
-                sync=True) # why are we sending this synchronously?
+                attachments=[('posts.json', 'application/json', json.dumps({'posts': data}, indent=4))])
+                # handed to the mail outbox, so this job doesn't wait on SMTP
     except:
         # handle unexpected errors
         _set_task_progress(100)
-        app.logger.error('Unhandled exception', exc_info=sys.exc_info()) # what's the stack trace?
\ No newline at end of file
+        current_app.logger.error('Unhandled exception', exc_info=sys.exc_info()) # what's the stack trace?
+
+def compute_follow_suggestions():
+    try:
+        users = suggestions.compute_all()
+        current_app.logger.info('Computed follow suggestions for %d users', users)
+    except:
+        current_app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+
+def update_follow_suggestions(follower_id, followed_id, following):
+    try:
+        suggestions.apply_follow_change(follower_id, followed_id, following)
+    except:
+        current_app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+
+def detect_languages():
+    try:
+        posts = language.backfill(Post)
+        messages = language.backfill(Message)
+        current_app.logger.info('Detected languages for %d posts and %d messages', posts, messages)
+    except:
+        db.session.rollback()
+        current_app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+
+def deliver_mail():
+    try:
+        sent = drain_outbox()
+        current_app.logger.info('Delivered %d emails', sent)
+    except:
+        current_app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+        # the unsent emails are still in the outbox, try again later
+        if current_app.redis.set(DRAIN_SCHEDULED_KEY, 1, nx=True, ex=current_app.config['MAIL_DRAIN_TIMEOUT']):
+            task_queues.enqueue_in('interactive', timedelta(seconds=current_app.config['MAIL_DRAIN_TIMEOUT']), deliver_mail)
+
+def scheduler_tick():
+    try:
+        ran = scheduler.tick()
+        if ran:
+            current_app.logger.info('Ran scheduled jobs %s', ', '.join(ran))
+    except:
+        db.session.rollback()
+        current_app.logger.error('Unhandled exception', exc_info=sys.exc_info())
@@ -0,0 +1,32 @@
+from flask import current_app
+from app import metrics
+import redis
+
+# maps the hash of an API token to its user's id, so authenticated API calls skip the token lookup
+# entries never outlive the token itself, and are dropped when a token is revoked
+
+def _key(token_hash):
+    return 'api_token:{}'.format(token_hash)
+
+def get_user_id(token_hash):
+    try:
+        user_id = current_app.redis.get(_key(token_hash))
+    except redis.exceptions.RedisError:
+        return None
+    metrics.cache_lookup('api_token', user_id is not None)
+    return int(user_id) if user_id is not None else None
+
+def set_user_id(token_hash, user_id, expires_in):
+    ttl = min(int(expires_in), current_app.config['API_TOKEN_CACHE_TTL'])
+    if ttl <= 0:
+        return
+    try:
+        current_app.redis.set(_key(token_hash), user_id, ex=ttl)
+    except redis.exceptions.RedisError:
+        pass
+
+def forget(token_hash):
+    try:
+        current_app.redis.delete(_key(token_hash))
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Could not drop cached API token')
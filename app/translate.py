@@ -1,7 +1,14 @@
 from flask import current_app
-import requests
+from app.instrumentation import timer
 
 
+def _session():
+    # requests is only imported by the processes that translate, and they keep the connection alive
+    if 'translate_session' not in current_app.extensions:
+        import requests
+        current_app.extensions['translate_session'] = requests.Session()
+    return current_app.extensions['translate_session']
+
 def translate(text, source_language, dest_language):
     """
     """
@@ -13,11 +20,12 @@ def translate(text, source_language, dest_language):
         'Content-Type': 'application/json'
     }
 
-    r = requests.post(
-        'https://api.cognitive.microsofttranslator.com/translate?api-version=3.0&from={}&to={}'.format(
-            source_language, dest_language
-        ), headers=auth, json=[{'Text': text}]
-    )
+    with timer('http'):
+        r = _session().post(
+            'https://api.cognitive.microsofttranslator.com/translate?api-version=3.0&from={}&to={}'.format(
+                source_language, dest_language
+            ), headers=auth, json=[{'Text': text}]
+        )
 
     # r = requests.get(
     #     'https://api.microsofttranslator.com/v2/Ajax.svc/Translate?text={}&from={}&to={}'.format(
@@ -0,0 +1,82 @@
+from flask import current_app
+from datetime import datetime
+from sqlalchemy.orm import make_transient_to_detached
+from threading import Lock
+from app import metrics
+import json
+import time
+import redis
+
+# flask_login loads the logged in user on every request, so the session-relevant columns are cached
+# for a few seconds in each worker, and for a few minutes in Redis (shared by all workers)
+# committed changes to a user drop both copies, other workers' local copies expire on their own
+# the password hash is deliberately left out, it is loaded from the database if accessed
+
+FIELDS = ['id', 'username', 'email', 'email_digest', 'about_me', 'last_seen', 'last_message_read_time']
+DATETIME_FIELDS = {'last_seen', 'last_message_read_time'}
+
+_lock = Lock()
+
+def _local():
+    # user id -> (expires at, fields), kept per application
+    return current_app.extensions.setdefault('user_cache', {})
+
+def _key(user_id):
+    return 'user:{}'.format(user_id)
+
+def _dump(user):
+    return {field: getattr(user, field).isoformat() if field in DATETIME_FIELDS and getattr(user, field)
+            else getattr(user, field) for field in FIELDS}
+
+def _load(fields):
+    return {field: datetime.fromisoformat(value) if field in DATETIME_FIELDS and value else value
+            for field, value in fields.items()}
+
+def get(user_id):
+    now = time.monotonic()
+    entry = _local().get(user_id)
+    if entry is not None and entry[0] > now:
+        metrics.cache_lookup('user_local', True)
+        return _load(entry[1])
+    try:
+        data = current_app.redis.get(_key(user_id))
+    except redis.exceptions.RedisError:
+        return None
+    metrics.cache_lookup('user', data is not None)
+    if data is None:
+        return None
+    fields = json.loads(data)
+    _remember(user_id, fields)
+    return _load(fields)
+
+def put(user):
+    fields = _dump(user)
+    _remember(user.id, fields)
+    try:
+        current_app.redis.set(_key(user.id), json.dumps(fields), ex=current_app.config['USER_CACHE_TTL'])
+    except redis.exceptions.RedisError:
+        pass
+
+def _remember(user_id, fields):
+    local = _local()
+    with _lock:
+        if len(local) >= current_app.config['USER_CACHE_LOCAL_SIZE']:
+            local.clear() # crude, but entries only live a few seconds anyway
+        local[user_id] = (time.monotonic() + current_app.config['USER_CACHE_LOCAL_TTL'], fields)
+
+def invalidate(*user_ids):
+    local = _local()
+    with _lock:
+        for user_id in user_ids:
+            local.pop(user_id, None)
+    try:
+        current_app.redis.delete(*[_key(user_id) for user_id in user_ids])
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Could not invalidate cached users %s', user_ids)
+
+def attach(session, model, fields):
+    # builds the instance from cached columns and adds it to the session without a SELECT,
+    # any column that isn't cached is loaded on first access
+    user = model(**fields)
+    make_transient_to_detached(user)
+    return session.merge(user, load=False)
@@ -0,0 +1,22 @@
+from rq import Worker as BaseWorker
+
+# the RQ worker class to run ("rq worker --worker-class app.worker.Worker ..."): it creates the app and
+# pushes its context, and imports app.tasks, once when it starts, so each job's forked process inherits
+# the loaded app instead of importing and creating it again before every job
+
+
+class Worker(BaseWorker):
+    def __init__(self, *args, **kwargs):
+        super(Worker, self).__init__(*args, **kwargs)
+        from app import create_app
+        self.app = create_app() # RQ worker doesn't know about creation of application in rohanapp.py
+        self.app_context = self.app.app_context()
+        self.app_context.push() # the jobs use current_app
+        import app.tasks
+
+    def main_work_horse(self, job, queue):
+        # runs in the forked process, which must not use the database connections of its parent
+        from app import db
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+        super(Worker, self).main_work_horse(job, queue)
@@ -0,0 +1 @@
+# Benchmarks for RohanApp, run from the project root with python -m benchmarks.<name>
@@ -0,0 +1,156 @@
+"""Deterministic synthetic dataset for benchmarks.
+
+Creates users, posts, a follow graph whose in-degrees follow a power law (a few
+users have most of the followers, as on real sites), and private messages with
+their conversation summaries. Everything is derived from --seed, so the same
+arguments always produce the same rows. Rows are bulk inserted with Core
+statements, and every user shares one password hash (the password is
+"password"), so a large dataset loads in seconds.
+
+    python -m benchmarks.datagen --database sqlite:////tmp/bench.db --users 2000
+    python -m benchmarks.datagen --database postgresql://localhost/rohanapp_bench --reset
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+from app import create_app, db, passwords
+from app.avatars import email_digest
+from app.models import User, Post, Message, Conversation, followers
+from config import Config
+
+PASSWORD = 'password'
+START = datetime(2024, 1, 1)
+WORDS = ('the quick brown fox jumps over a lazy dog while we talk about coffee code music travel '
+         'books weather football movies dinner weekend plans and everything else people post').split()
+
+def make_config(database):
+    class BenchConfig(Config):
+        TESTING = True
+        WTF_CSRF_ENABLED = False
+        SQLALCHEMY_DATABASE_URI = database
+    return BenchConfig
+
+def username(i):
+    return 'user{}'.format(i)
+
+def _sentence(rng, words):
+    return ' '.join(rng.choice(WORDS) for i in range(words)).capitalize()[:140]
+
+def _follows(rng, users, mean, exponent):
+    # each user follows a Pareto distributed number of others, picked with Zipf weights by popularity rank
+    weights = [1 / (rank + 1) ** exponent for rank in range(users)]
+    popular = list(range(1, users + 1))
+    rng.shuffle(popular) # so popularity isn't simply the user id
+    cumulative = []
+    total = 0
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    for follower in range(1, users + 1):
+        count = min(users - 1, int(rng.paretovariate(1.5) * mean / 3))
+        followed = set()
+        while len(followed) < count:
+            for other in rng.choices(popular, cum_weights=cumulative, k=count - len(followed)):
+                if other != follower:
+                    followed.add(other)
+        for other in sorted(followed):
+            yield {'follower_id': follower, 'followed_id': other}
+
+def _insert(table, rows, batch_size):
+    batch = []
+    count = 0
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            db.session.execute(db.insert(table), batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        db.session.execute(db.insert(table), batch)
+        count += len(batch)
+    return count
+
+def generate(users=1000, posts=20, follows=30, messages=5, exponent=1.1, seed=42, batch_size=1000):
+    # posts and messages are per user on average, follows is the mean number of users each user follows
+    rng = random.Random(seed)
+    password_hash = passwords.hash_password(PASSWORD)
+    span = timedelta(days=365).total_seconds()
+    counts = {}
+
+    counts['users'] = _insert(User.__table__, ({
+        'id': i, 'username': username(i), 'email': username(i) + '@example.com',
+        'email_digest': email_digest(username(i) + '@example.com'), 'password_hash': password_hash,
+        'about_me': _sentence(rng, 8), 'last_seen': START + timedelta(seconds=span),
+        'last_message_read_time': START + timedelta(seconds=rng.uniform(0, span)),
+    } for i in range(1, users + 1)), batch_size)
+
+    def post_rows():
+        post_id = 0
+        for i in range(1, users + 1):
+            for j in range(int(rng.expovariate(1 / posts)) if posts else 0):
+                post_id += 1
+                yield {'id': post_id, 'user_id': i, 'body': _sentence(rng, rng.randint(3, 20)), 'language': 'en',
+                       'timestamp': START + timedelta(seconds=rng.uniform(0, span))}
+    counts['posts'] = _insert(Post.__table__, post_rows(), batch_size)
+    counts['follows'] = _insert(followers, _follows(rng, users, follows, exponent), batch_size)
+
+    # messages, with the conversation summaries worked out here rather than by Conversation.backfill
+    read_time = dict(db.session.execute(db.select(User.id, User.last_message_read_time)).all())
+    summaries = {}
+    def summary(user_id, other_id):
+        if (user_id, other_id) not in summaries:
+            summaries[user_id, other_id] = {
+                'user_id': user_id, 'other_id': other_id, 'last_received_id': None, 'last_received_timestamp': None,
+                'last_sent_id': None, 'last_sent_timestamp': None, 'unread_count': 0}
+        return summaries[user_id, other_id]
+
+    def message_rows():
+        timestamps = sorted(START + timedelta(seconds=rng.uniform(0, span)) for i in range(users * messages))
+        for message_id, timestamp in enumerate(timestamps, 1):
+            sender, recipient = rng.sample(range(1, users + 1), 2) if users > 1 else (1, 1)
+            sent, received = summary(sender, recipient), summary(recipient, sender)
+            sent['last_sent_id'], sent['last_sent_timestamp'] = message_id, timestamp
+            received['last_received_id'], received['last_received_timestamp'] = message_id, timestamp
+            if timestamp > read_time[recipient]:
+                received['unread_count'] += 1
+            yield {'id': message_id, 'sender_id': sender, 'recipient_id': recipient, 'timestamp': timestamp,
+                   'body': _sentence(rng, rng.randint(2, 15)), 'language': 'en'}
+    counts['messages'] = _insert(Message.__table__, message_rows(), batch_size)
+    counts['conversations'] = _insert(Conversation.__table__, summaries.values(), batch_size)
+    db.session.commit()
+    if db.engine.dialect.name == 'postgresql':
+        # explicit ids leave the sequences behind
+        for table in ('user', 'post', 'message', 'conversation'):
+            db.session.execute(db.text("SELECT setval(pg_get_serial_sequence('\"{0}\"', 'id'), "
+                                       "(SELECT COALESCE(MAX(id), 1) FROM \"{0}\"))".format(table)))
+        db.session.commit()
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', default='sqlite:////tmp/rohanapp-bench.db', help='SQLAlchemy database URL')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=20, help='mean posts per user')
+    parser.add_argument('--follows', type=int, default=30, help='mean users followed per user')
+    parser.add_argument('--messages', type=int, default=5, help='messages sent per user')
+    parser.add_argument('--exponent', type=float, default=1.1, help='power law exponent of follower counts')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--reset', action='store_true', help='drop and recreate the tables first')
+    args = parser.parse_args()
+
+    app = create_app(make_config(args.database))
+    with app.app_context():
+        if args.reset:
+            db.drop_all()
+        db.create_all()
+        if db.session.query(User.id).first() is not None:
+            parser.error('the database already has users, use --reset to replace them')
+        start = time.perf_counter()
+        counts = generate(args.users, args.posts, args.follows, args.messages, args.exponent, args.seed)
+        print(', '.join('{} {}'.format(count, name) for name, count in counts.items()),
+              'in {:.1f}s'.format(time.perf_counter() - start))
+        print('log in as {} (or any userN) with password "{}"'.format(username(1), PASSWORD))
+
+if __name__ == '__main__':
+    main()
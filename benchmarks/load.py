@@ -0,0 +1,178 @@
+"""HTTP load test replaying user sessions.
+
+Each virtual user logs in as a random generated user (see benchmarks.datagen),
+gets an API token, and then browses: the index, explore, profiles, messages,
+notification polls and the users API, with think times between requests.
+Latency percentiles and throughput are reported per page.
+
+Against a running server (any database):
+
+    python -m benchmarks.load --url http://localhost:5000 --users 20 --duration 60
+
+In process, through the Flask test client, against a generated database:
+
+    python -m benchmarks.datagen --database sqlite:////tmp/bench.db --reset
+    python -m benchmarks.load --database sqlite:////tmp/bench.db --users 4 --duration 20
+"""
+import argparse
+import random
+import re
+import threading
+import time
+from base64 import b64encode
+from collections import defaultdict
+
+CSRF_RE = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+# (page, weight), a session picks its next page with these weights
+PAGES = [('index', 30), ('explore', 20), ('user', 20), ('messages', 8), ('notifications', 15), ('api_user', 7)]
+
+class HTTPClient(object):
+    # a requests session against a running server
+    def __init__(self, url):
+        import requests
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+
+    def get(self, path, headers=None):
+        response = self.session.get(self.url + path, headers=headers, allow_redirects=False)
+        return response.status_code, response.text
+
+    def post(self, path, data=None, headers=None):
+        response = self.session.post(self.url + path, data=data, headers=headers, allow_redirects=False)
+        return response.status_code, response.text
+
+
+class AppClient(object):
+    # the Flask test client, for measuring without a web server
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def get(self, path, headers=None):
+        response = self.client.get(path, headers=headers)
+        return response.status_code, response.get_data(as_text=True)
+
+    def post(self, path, data=None, headers=None):
+        response = self.client.post(path, data=data, headers=headers)
+        return response.status_code, response.get_data(as_text=True)
+
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, page, seconds, ok):
+        with self.lock:
+            self.latencies[page].append(seconds)
+            if not ok:
+                self.errors[page] += 1
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def timed(stats, page, request, *args, **kwargs):
+    start = time.perf_counter()
+    status, body = request(*args, **kwargs)
+    stats.record(page, time.perf_counter() - start, status < 400)
+    return status, body
+
+def login(client, stats, name, password):
+    status, body = client.get('/auth/login')
+    match = CSRF_RE.search(body)
+    data = {'username': name, 'password': password, 'submit': 'Sign In'}
+    if match:
+        data['csrf_token'] = match.group(1)
+    status, body = timed(stats, 'login', client.post, '/auth/login', data=data)
+    if status != 302:
+        raise RuntimeError('could not log in as {}'.format(name))
+    credentials = b64encode('{}:{}'.format(name, password).encode()).decode()
+    status, body = timed(stats, 'api_token', client.post, '/api/tokens',
+                         headers={'Authorization': 'Basic ' + credentials})
+    return {'Authorization': 'Bearer ' + re.search(r'"token": ?"([^"]+)"', body).group(1)}
+
+def session(client, stats, rng, users, password, deadline, think):
+    user_id = rng.randint(1, users)
+    headers = login(client, stats, 'user{}'.format(user_id), password)
+    pages, weights = zip(*PAGES)
+    since = 0
+    while time.monotonic() < deadline:
+        page = rng.choices(pages, weights)[0]
+        if page == 'index':
+            timed(stats, page, client.get, '/index?page={}'.format(rng.choice([1, 1, 1, 2, 3])))
+        elif page == 'explore':
+            timed(stats, page, client.get, '/explore')
+        elif page == 'user':
+            timed(stats, page, client.get, '/user/user{}'.format(rng.randint(1, users)))
+        elif page == 'messages':
+            timed(stats, page, client.get, '/messages')
+        elif page == 'notifications':
+            status, body = timed(stats, page, client.get, '/notifications?since={}'.format(since))
+            since = time.time() - 10
+        elif page == 'api_user':
+            timed(stats, page, client.get, '/api/users/{}'.format(rng.randint(1, users)), headers=headers)
+        if think:
+            time.sleep(rng.expovariate(1 / think))
+
+def run(make_client, virtual_users, users, password, duration, think, seed):
+    stats = Stats()
+    deadline = time.monotonic() + duration
+
+    def virtual_user(i):
+        rng = random.Random(seed + i)
+        while time.monotonic() < deadline:
+            session(make_client(), stats, rng, users, password, deadline, think)
+
+    threads = [threading.Thread(target=virtual_user, args=(i,)) for i in range(virtual_users)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return stats, time.perf_counter() - start
+
+def report(stats, elapsed):
+    print('{:14} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9}'.format('page', 'requests', 'errors', 'req/s',
+                                                          'p50 ms', 'p95 ms', 'p99 ms'))
+    total = 0
+    for page, latencies in sorted(stats.latencies.items()):
+        total += len(latencies)
+        print('{:14} {:>8} {:>7} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+            page, len(latencies), stats.errors[page], len(latencies) / elapsed,
+            *[1000 * percentile(latencies, p) for p in (50, 95, 99)]))
+    print('{} requests in {:.1f}s, {:.1f} requests/second'.format(total, elapsed, total / elapsed))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--url', help='base URL of a running server')
+    target.add_argument('--database', help='SQLAlchemy URL of a generated database, to run in process')
+    parser.add_argument('--users', type=int, default=10, help='concurrent virtual users')
+    parser.add_argument('--dataset-users', type=int, help='users in the dataset (default: count them)')
+    parser.add_argument('--password', default='password', help='password of the generated users')
+    parser.add_argument('--duration', type=float, default=30, help='seconds')
+    parser.add_argument('--think', type=float, default=0, help='mean seconds between requests in a session')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    if args.url:
+        make_client = lambda: HTTPClient(args.url)
+        users = args.dataset_users
+        if users is None:
+            parser.error('--dataset-users is required with --url')
+    else:
+        from app import create_app, db
+        from app.models import User
+        from benchmarks.datagen import make_config
+        app = create_app(make_config(args.database))
+        with app.app_context():
+            users = args.dataset_users or db.session.query(db.func.count(User.id)).scalar()
+        make_client = lambda: AppClient(app)
+    stats, elapsed = run(make_client, args.users, users, args.password, args.duration, args.think, args.seed)
+    report(stats, elapsed)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""Login throughput for different password hashing settings.
+
+For each hash method, a user is created with that method and the login view is
+driven through the test client from several threads, inline and (optionally)
+with verification offloaded to a process pool.
+
+    python -m benchmarks.password_hashing
+    python -m benchmarks.password_hashing --method pbkdf2:sha256:600000 --threads 4 --pool 4
+"""
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from app import create_app, db
+from app.models import User
+from config import Config
+
+METHODS = ['scrypt:32768:8:1', 'scrypt:16384:8:1', 'pbkdf2:sha256:1000000', 'pbkdf2:sha256:600000']
+
+def make_config(database, method, workers):
+    class BenchConfig(Config):
+        TESTING = True
+        WTF_CSRF_ENABLED = False
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + database
+        PASSWORD_HASH_METHOD = method
+        PASSWORD_HASH_WORKERS = workers
+    return BenchConfig
+
+def logins_per_second(method, threads, workers, logins):
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app(make_config(os.path.join(tmp, 'bench.db'), method, workers))
+        with app.app_context():
+            db.create_all()
+            user = User(username='bench', email='bench@example.com')
+            user.set_password('correct horse battery staple')
+            db.session.add(user)
+            db.session.commit()
+
+        def login(i):
+            client = app.test_client()
+            response = client.post('/auth/login', data={'username': 'bench',
+                                                         'password': 'correct horse battery staple'})
+            assert response.status_code == 302 and '/auth/login' not in response.location
+
+        login(0) # warm up (and start the process pool)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(login, range(logins)))
+        elapsed = time.perf_counter() - start
+        if 'password_pool' in app.extensions:
+            app.extensions['password_pool'].shutdown()
+        return logins / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--method', action='append', help='hash method (repeatable, default: a standard set)')
+    parser.add_argument('--threads', type=int, default=4, help='concurrent login threads')
+    parser.add_argument('--pool', type=int, default=0, help='also measure with a process pool of this size')
+    parser.add_argument('--logins', type=int, default=40, help='logins per measurement')
+    args = parser.parse_args()
+
+    print('{:28} {:>10} {:>14}'.format('method', 'workers', 'logins/second'))
+    for method in args.method or METHODS:
+        for workers in [0, args.pool] if args.pool else [0]:
+            rate = logins_per_second(method, args.threads, workers, args.logins)
+            print('{:28} {:>10} {:>14.1f}'.format(method, workers or 'inline', rate))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""Timings and SQL statement counts of the hot model methods.
+
+Each method is run against generated datasets (see benchmarks.datagen) of
+increasing size. For every method the statements per call and the scaling
+slope (of log time against log dataset size: about 0 for an index lookup,
+1 for a scan of a table that grows with the users) are compared with
+benchmarks/baselines.json, and --check exits with an error when either is
+worse, so it can gate a CI job. The stored baselines are from SQLite with no
+Redis server running, so cached lookups fall back to the database. Cases that
+need a service (search needs ELASTICSEARCH_URL) are skipped without it, and
+get no baseline from that run.
+
+    python -m benchmarks.queries
+    python -m benchmarks.queries --check
+    python -m benchmarks.queries --update     # after an intended change
+"""
+import argparse
+import json
+import math
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from app import create_app, db
+from app.models import User, Post
+from benchmarks.datagen import generate, make_config
+
+BASELINES = os.path.join(os.path.dirname(__file__), 'baselines.json')
+SIZES = [250, 1000, 4000]
+
+# name -> function(user, other), each runs what a page runs
+CASES = {
+    'followed_posts': lambda user, other: user.followed_posts().paginate(page=1, per_page=10, error_out=False).items,
+    'new_messages': lambda user, other: user.new_messages(),
+    'is_following': lambda user, other: user.is_following(other),
+    'to_dict': lambda user, other: user.to_dict(),
+    'search': lambda user, other: Post.search('coffee', 1, 10)[0].all(),
+}
+
+# case -> the setting without which it measures nothing (search would run a query for no posts)
+REQUIRES = {
+    'search': 'ELASTICSEARCH_URL',
+}
+
+def skipped(config):
+    return {name: setting for name, setting in REQUIRES.items() if not getattr(config, setting)}
+
+class StatementCounter(object):
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+def measure(users, repeat, seed, cases):
+    # {case: (seconds per call, statements per call)} for a dataset of this many users
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app(make_config('sqlite:///' + os.path.join(tmp, 'bench.db')))
+        with app.app_context(), app.test_request_context():
+            db.create_all()
+            generate(users=users, seed=seed)
+            rng = random.Random(seed)
+            pairs = [(db.session.get(User, rng.randint(1, users)), db.session.get(User, rng.randint(1, users)))
+                     for i in range(repeat)]
+            counter = StatementCounter()
+            db.event.listen(db.engine, 'before_cursor_execute', counter)
+            for name in cases:
+                case = CASES[name]
+                case(*pairs[0]) # warm up
+                counter.count = 0
+                timings = []
+                for user, other in pairs:
+                    start = time.perf_counter()
+                    case(user, other)
+                    timings.append(time.perf_counter() - start)
+                results[name] = (statistics.median(timings), counter.count / len(pairs))
+            db.event.remove(db.engine, 'before_cursor_execute', counter)
+    return results
+
+def slope(sizes, timings):
+    # least squares fit of log(time) = slope * log(size) + c
+    xs = [math.log(size) for size in sizes]
+    ys = [math.log(max(timing, 1e-9)) for timing in timings]
+    mean_x, mean_y = statistics.mean(xs), statistics.mean(ys)
+    return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / sum((x - mean_x) ** 2 for x in xs)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='dataset sizes, in users')
+    parser.add_argument('--repeat', type=int, default=50, help='calls of each method per dataset')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--tolerance', type=float, default=0.3, help='allowed slope above the baseline')
+    parser.add_argument('--check', action='store_true', help='exit with status 1 on a regression')
+    parser.add_argument('--update', action='store_true', help='write the results as the new baselines')
+    args = parser.parse_args()
+
+    skip = skipped(make_config(None))
+    cases = [name for name in CASES if name not in skip]
+    by_size = {size: measure(size, args.repeat, args.seed, cases) for size in args.sizes}
+    baselines = {}
+    if os.path.exists(BASELINES):
+        with open(BASELINES) as f:
+            baselines = json.load(f)
+
+    print('{:16} {}  {:>10} {:>8}  {}'.format('method', '  '.join('{:>9}'.format('{} ms'.format(size))
+                                                                 for size in args.sizes),
+                                             'statements', 'slope', 'baseline'))
+    results = {}
+    failures = []
+    for name, setting in skip.items():
+        print('{:16} skipped, {} is not set'.format(name, setting))
+        if name in baselines:
+            results[name] = baselines[name] # kept for runs that have the service
+    for name in cases:
+        timings = [by_size[size][name][0] for size in args.sizes]
+        statements = max(by_size[size][name][1] for size in args.sizes)
+        results[name] = {'statements': statements, 'slope': round(slope(args.sizes, timings), 2)}
+        baseline = baselines.get(name)
+        if baseline:
+            if statements > baseline['statements']:
+                failures.append('{} runs {:g} statements, baseline {:g}'.format(name, statements,
+                                                                                baseline['statements']))
+            if results[name]['slope'] > baseline['slope'] + args.tolerance:
+                failures.append('{} scales with slope {:.2f}, baseline {:.2f}'.format(name, results[name]['slope'],
+                                                                                     baseline['slope']))
+        print('{:16} {}  {:>10g} {:>8.2f}  {}'.format(
+            name, '  '.join('{:>9.3f}'.format(1000 * timing) for timing in timings), statements,
+            results[name]['slope'],
+            '{statements:g} statements, slope {slope:.2f}'.format(**baseline) if baseline else '-'))
+
+    if args.update:
+        with open(BASELINES, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+            f.write('\n')
+        print('Baselines written to ' + BASELINES)
+    elif failures:
+        print('\n'.join(['', 'Regressions:'] + failures))
+        if args.check:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Compare gunicorn worker types under the load test.
+
+For each profile a gunicorn server is started with gunicorn.conf.py against a
+generated database (see benchmarks.datagen), the load test of benchmarks.load
+is run against it, and the server is stopped. Besides the latencies, the
+memory of the server is reported as the proportional set size (PSS) of the
+master and its workers (Linux only), where pages still shared after the fork
+count once. The results are in deployment/README.md.
+
+    python -m benchmarks.datagen --database sqlite:////tmp/rohanapp-bench.db --reset
+    python -m benchmarks.servers --database sqlite:////tmp/rohanapp-bench.db --dataset-users 1000
+    python -m benchmarks.servers --profiles sync gevent --workers 4 --users 40 --duration 60
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+from benchmarks.load import HTTPClient, report, run
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name -> gunicorn.conf.py environment
+PROFILES = {
+    'sync': {'GUNICORN_WORKER_CLASS': 'sync'},
+    'gthread': {'GUNICORN_WORKER_CLASS': 'gthread', 'GUNICORN_THREADS': '4'},
+    'gevent': {'GUNICORN_WORKER_CLASS': 'gevent', 'GUNICORN_WORKER_CONNECTIONS': '100'},
+}
+
+def _children(pid):
+    try:
+        with open('/proc/{0}/task/{0}/children'.format(pid)) as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+def pss(pid):
+    # kB of memory used by a process and its children, shared pages divided between the processes sharing them
+    total = 0
+    for process in [pid] + _children(pid):
+        try:
+            with open('/proc/{}/smaps_rollup'.format(process)) as f:
+                total += sum(int(line.split()[1]) for line in f if line.startswith('Pss:'))
+        except OSError:
+            pass
+    return total
+
+def start(profile, database, workers, port):
+    env = dict(os.environ, DATABASE_URL=database, WEB_CONCURRENCY=str(workers), PORT=str(port),
+               ELASTICSEARCH_URL='', LOG_TO_STDOUT='1', **PROFILES[profile])
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'rohanapp:app'],
+                              cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    client = HTTPClient('http://localhost:{}'.format(port))
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            if client.get('/auth/login')[0] == 200 and len(_children(server.pid)) >= workers:
+                return server
+        except Exception:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError('gunicorn did not start with the {} profile'.format(profile))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', required=True, help='SQLAlchemy URL of a generated database')
+    parser.add_argument('--dataset-users', type=int, default=1000, help='users in the dataset')
+    parser.add_argument('--profiles', nargs='+', default=['sync', 'gthread', 'gevent'], choices=sorted(PROFILES))
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn worker processes')
+    parser.add_argument('--users', type=int, default=16, help='concurrent virtual users')
+    parser.add_argument('--duration', type=float, default=20, help='seconds per profile')
+    parser.add_argument('--think', type=float, default=0, help='mean seconds between requests in a session')
+    parser.add_argument('--password', default='password', help='password of the generated users')
+    parser.add_argument('--port', type=int, default=8123)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    for profile in args.profiles:
+        print('== {} ({} workers, {} virtual users)'.format(profile, args.workers, args.users))
+        server = start(profile, args.database, args.workers, args.port)
+        try:
+            idle = pss(server.pid)
+            make_client = lambda: HTTPClient('http://localhost:{}'.format(args.port))
+            stats, elapsed = run(make_client, args.users, args.dataset_users, args.password, args.duration,
+                                 args.think, args.seed)
+            report(stats, elapsed)
+            print('memory (PSS): {:.1f} MB idle, {:.1f} MB after the test'.format(idle / 1024,
+                                                                                  pss(server.pid) / 1024))
+        finally:
+            server.terminate()
+            server.wait()
+        print()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""Start-up times of the app: imports, create_app, a first request and an RQ worker's start.
+
+Every measurement runs in a new Python process, as a gunicorn reload, a
+flask command or a new RQ worker would, and the medians of the runs are
+reported. The times are from the first import to the end of the step, so
+they include the steps before it; the bare interpreter start-up is shown
+separately. --modules lists the top-level packages a web process imports,
+for spotting a heavy dependency that crept back onto the start-up path.
+
+    python -m benchmarks.startup
+    python -m benchmarks.startup --runs 20 --modules
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name -> code, timed in a new process
+STEPS = [
+    ('import app', 'import app'),
+    ('create_app', 'from app import create_app\nweb = create_app()'),
+    ('first request', 'from app import create_app\nweb = create_app()\nweb.test_client().get("/auth/login")'),
+    ('worker', 'from app import create_app\nworker = create_app()\nimport app.tasks'), # as app.worker.Worker
+]
+
+SCRIPT = """
+import os, sys, time
+start = time.perf_counter()
+{code}
+print(time.perf_counter() - start)
+"""
+
+def _run(script):
+    env = dict(os.environ, DATABASE_URL='sqlite://', ELASTICSEARCH_URL='', LOG_TO_STDOUT='1')
+    output = subprocess.run([sys.executable, '-c', script], cwd=ROOT, env=env, check=True,
+                            capture_output=True, text=True)
+    return output.stdout.strip().splitlines()[-1]
+
+def interpreter():
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'pass'], check=True)
+    return time.perf_counter() - start
+
+def step(code):
+    return float(_run(SCRIPT.format(code=code)))
+
+def loaded_modules():
+    code = 'import json, sys\nfrom app import create_app\nweb = create_app()\n' \
+           'print(json.dumps(sorted({name.split(".")[0] for name in sys.modules if not name.startswith("_")})))'
+    return json.loads(_run(code))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10, help='new processes per step')
+    parser.add_argument('--modules', action='store_true', help='also list the packages create_app imports')
+    args = parser.parse_args()
+    print('{:<18} {:>10} {:>10}'.format('step', 'median ms', 'min ms'))
+    timings = [interpreter() for _ in range(args.runs)]
+    print('{:<18} {:>10.1f} {:>10.1f}'.format('python', 1000 * statistics.median(timings), 1000 * min(timings)))
+    for name, code in STEPS:
+        timings = [step(code) for _ in range(args.runs)]
+        print('{:<18} {:>10.1f} {:>10.1f}'.format(name, 1000 * statistics.median(timings), 1000 * min(timings)))
+    if args.modules:
+        print()
+        print(' '.join(loaded_modules()))
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 import os
+import tempfile
 from dotenv import load_dotenv  # Do not add .env file to version control !!! ***
 
 basedir = os.path.abspath(os.path.dirname(__file__))
@@ -11,15 +12,110 @@ class Config(object):
         'postgres://', 'postgresql://') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # pool settings for the primary and the replica, the sizes only apply to client/server databases
+    DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE') or 5)  # connections kept open per process
+    DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW') or 10)  # extra ones opened under load
+    DATABASE_POOL_TIMEOUT = int(os.environ.get('DATABASE_POOL_TIMEOUT') or 30)  # seconds to wait for a connection
+    DATABASE_POOL_RECYCLE = int(os.environ.get('DATABASE_POOL_RECYCLE') or 1800)  # seconds, -1 keeps them forever
+    DATABASE_POOL_PRE_PING = os.environ.get('DATABASE_NO_PRE_PING') is None  # test connections as they're taken
+    DATABASE_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL', '').replace('postgres://', 'postgresql://')
+    DATABASE_REPLICA_STICKY = 10  # seconds a client reads from the primary after it wrote
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'scrypt:32768:8:1'  # werkzeug method string
+    PASSWORD_SALT_LENGTH = 16
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 0)  # 0 verifies in the request thread
     POSTS_PER_PAGE = 10
     LANGUAGES = ['en', 'es']
+    LANGUAGE_DETECTOR = os.environ.get('LANGUAGE_DETECTOR') or 'trigram'  # or 'guess_language'
+    LANGUAGE_CACHE_SIZE = int(os.environ.get('LANGUAGE_CACHE_SIZE') or 4096)  # 0 disables memoization
+    LANGUAGE_DETECTION_DEFERRED = os.environ.get('LANGUAGE_DETECTION_DEFERRED') is not None
     MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
     LOG_TO_STDOUT = os.environ.get('LOG_TO_STDOUT')
+    LOG_FORMAT = os.environ.get('LOG_FORMAT') or 'json'  # or 'text'
+    LOG_FILE = os.environ.get('LOG_FILE') or 'logs/rohanapp.log'  # rotated by logrotate, see app/log.py
+    LOG_MAIL_INTERVAL = 300  # seconds before the same error is emailed again
+    LOG_MAIL_MAX_PER_HOUR = 10
+    LOG_REQUESTS = os.environ.get('LOG_REQUESTS') is not None  # log every request with its timings
+    SERVER_TIMING = os.environ.get('SERVER_TIMING') is not None  # send timings in a Server-Timing header
+    REQUEST_QUERY_BUDGET = int(os.environ.get('REQUEST_QUERY_BUDGET') or 30)  # SQL statements per request
+    REQUEST_TIME_BUDGET = float(os.environ.get('REQUEST_TIME_BUDGET') or 0.5)  # seconds
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # /metrics requires it as a bearer token, and is a 404 without
+    METRICS_FLUSH_INTERVAL = 10  # seconds between each web worker's writes of its counters to Redis
+    PROFILER_SAMPLE_RATE = float(os.environ.get('PROFILER_SAMPLE_RATE') or 0)  # fraction of requests profiled
+    PROFILER_ENDPOINTS = set(filter(None, (os.environ.get('PROFILER_ENDPOINTS') or '').split(',')))  # e.g. main.index
+    PROFILER_TOKEN = os.environ.get('PROFILER_TOKEN')  # requests with this X-Profile header are profiled
+    PROFILER_INTERVAL = 0.005  # seconds between samples
+    PROFILER_DIR = os.environ.get('PROFILER_DIR') or os.path.join(basedir, 'profiles')
+    PROFILER_MAX_FILES = int(os.environ.get('PROFILER_MAX_FILES') or 200)  # per endpoint, older ones are deleted
+    METRICS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]  # request latency, seconds
     REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'  # REDISTOGO_URL, REDISCLOUD
+    LAST_SEEN_INTERVAL = 60  # seconds between writes of User.last_seen
+    USER_CACHE_TTL = 300  # seconds a logged in user's columns stay in Redis
+    USER_CACHE_LOCAL_TTL = 5  # seconds they stay in each worker's memory
+    USER_CACHE_LOCAL_SIZE = 1024
+    QUERY_CACHE_TTL = 3600  # seconds a cached query result stays in Redis
+    QUERY_CACHE_LOCAL_TTL = 5  # seconds it stays in each worker's memory
+    QUERY_CACHE_LOCAL_SIZE = 1024  # results kept in each worker, least recently used dropped first
+    LOOKUP_TABLES = os.environ.get('NO_LOOKUP_TABLES') is None  # memory-mapped user tables, see app/lookup_tables.py
+    LOOKUP_TABLE_DIR = os.environ.get('LOOKUP_TABLE_DIR') or \
+        ('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir())  # shared by the workers on a machine
+    LOOKUP_TABLE_REFRESH = 300  # seconds between rewrites of the tables when no user changed
+    LOOKUP_TABLE_POLL = 2  # seconds between checks for a new file, and for changed users
+    LOCAL_AVATARS = os.environ.get('LOCAL_AVATARS') is not None  # draw identicons here instead of gravatar.com
+    AVATAR_DIR = os.environ.get('AVATAR_DIR') or os.path.join(basedir, 'avatars')  # generated PNGs
+    API_TOKEN_CACHE_TTL = 300  # seconds, never longer than the token itself
+    API_TOKENS_PER_USER = 10  # unexpired tokens each user may have, a new one revokes the oldest beyond that
+    TASK_FLAG_TTL = 86400  # seconds
+    TASK_QUEUES = {  # highest priority first, run workers with the queue names in this order
+        'interactive': 'rohanapp-interactive',  # short jobs someone is waiting for: mail, language detection
+        'default': 'rohanapp-tasks',
+        'bulk': 'rohanapp-bulk',  # exports and rebuilds
+    }
+    TASK_TYPES = {  # tasks users launch, see User.launch_task
+        'export_posts': {'queue': 'bulk', 'per_user': 1, 'concurrency': 2, 'timeout': 3600},
+    }
+    TASK_DEFAULT_TIMEOUT = 600  # seconds
+    TASK_RESULT_TTL = 600  # seconds a finished job (and its meta) is kept
+    TASK_FAILURE_TTL = 86400
+    TASK_LIMIT_RETRIES = 20  # a task over its concurrency limit is put back this many times, then fails
+    TASK_LIMIT_RETRY_INTERVAL = 30  # seconds
+    SCHEDULER_TICK = 60  # seconds between checks for due maintenance jobs
+    SCHEDULER_JOBS = {  # job -> seconds between runs, see app/scheduler.py, 0 disables it
+        'prune_notifications': 3600,
+        'prune_tasks': 3600,
+        'clean_queues': 900,
+        'compact_redis': 86400,
+        'verify_search_index': 86400,
+        'rebuild_suggestions': int(os.environ.get('SUGGESTIONS_REBUILD_INTERVAL') or 0),
+        'detect_languages': 3600 if os.environ.get('LANGUAGE_DETECTION_DEFERRED') is not None else 0,
+        'prune_avatars': 86400 if os.environ.get('LOCAL_AVATARS') is not None else 0,  # workers must see AVATAR_DIR
+    }
+    SCHEDULER_KEY_TTLS = {  # cache keys that should always have an expiry, and the one to give them
+        'followed:*': 3600,
+        'user:*': 300,
+        'api_token:*': 300,
+        'tasks_in_progress:*': 86400,
+        'task_slots:*': 3600,
+    }
+    NOTIFICATION_RETENTION = 7 * 86400  # seconds
+    NOTIFICATIONS_IN_REDIS = {'task_progress'}  # names only kept in Redis, they fall back to the database
+    NOTIFICATION_REDIS_TTL = 86400  # seconds
+    SEARCH_INDEX_REPAIR = os.environ.get('SEARCH_INDEX_REPAIR') is not None  # reindex when counts differ
+    FOLLOW_SUGGESTIONS = 5
+    FOLLOW_SUGGESTIONS_STORED = 50  # extra candidates kept so incremental updates have something to promote
+    FOLLOW_CACHE_TTL = int(os.environ.get('FOLLOW_CACHE_TTL') or 3600)  # seconds
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)  # Is int() really necessary here?
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ADMINS = ['rohanapp.email@gmail.com']
+    MAIL_QUEUE = os.environ.get('MAIL_QUEUE') or 'pool'  # 'pool' (threads in each web worker) or 'rq'
+    MAIL_POOL_WORKERS = int(os.environ.get('MAIL_POOL_WORKERS') or 2)
+    MAIL_QUEUE_SIZE = 1000  # emails waiting in each web worker, beyond that they go to the Redis outbox
+    MAIL_BATCH_SIZE = 20  # emails sent per SMTP connection
+    MAIL_MAX_RETRIES = 3
+    MAIL_RETRY_BACKOFF = 2  # seconds, doubled after each failure
+    MAIL_DRAIN_TIMEOUT = 60  # seconds before a failed outbox drain is retried
+    MAIL_MAX_ATTEMPTS = 5  # failed drains before an email is moved to the dead letters
+    MAIL_DEAD_LETTERS = 1000  # dead letters kept
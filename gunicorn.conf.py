@@ -0,0 +1,40 @@
+# gunicorn settings, read by "gunicorn rohanapp:app" run from this directory
+# the app is created once in the master process (preload_app) and the workers are forked from it, see
+# app/forking.py; benchmarks/servers.py compares the worker types, see deployment/README.md
+#
+#   WEB_CONCURRENCY              worker processes (default: 2 per CPU + 1)
+#   GUNICORN_WORKER_CLASS        sync (default), gthread or gevent
+#   GUNICORN_THREADS             threads per gthread worker (default 4)
+#   GUNICORN_WORKER_CONNECTIONS  concurrent requests per gevent worker (default 100)
+#   GUNICORN_TIMEOUT             seconds before a stuck worker is restarted (default 30)
+import multiprocessing
+import os
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync')
+
+if worker_class == 'gevent':
+    # before the app (and so socket, ssl, threading, redis, SQLAlchemy) is imported by the master,
+    # or the workers would inherit blocking versions of them
+    from gevent import monkey
+    monkey.patch_all()
+    try:
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg() # PostgreSQL queries yield to other requests
+    except ImportError:
+        pass
+
+bind = '0.0.0.0:' + os.environ.get('PORT', '8000')
+workers = int(os.environ.get('WEB_CONCURRENCY') or multiprocessing.cpu_count() * 2 + 1)
+threads = int(os.environ.get('GUNICORN_THREADS') or (4 if worker_class == 'gthread' else 1))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS') or 100)
+timeout = int(os.environ.get('GUNICORN_TIMEOUT') or 30)
+preload_app = True
+
+
+def when_ready(server):
+    from app import forking
+    forking.preload(server.app.wsgi())
+
+def post_fork(server, worker):
+    from app import forking
+    forking.after_fork(server.app.wsgi())
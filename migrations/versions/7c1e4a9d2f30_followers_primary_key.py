@@ -0,0 +1,49 @@
+"""followers primary key and reverse index
+
+Revision ID: 7c1e4a9d2f30
+Revises: b9473399aece
+Create Date: 2026-10-19 09:12:41.503218
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c1e4a9d2f30'
+down_revision = 'b9473399aece'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # remove rows that would violate the new primary key (nulls and duplicate pairs)
+    op.execute('CREATE TEMPORARY TABLE followers_dedup AS '
+               'SELECT DISTINCT follower_id, followed_id FROM followers '
+               'WHERE follower_id IS NOT NULL AND followed_id IS NOT NULL')
+    op.execute('DELETE FROM followers')
+    op.execute('INSERT INTO followers (follower_id, followed_id) '
+               'SELECT follower_id, followed_id FROM followers_dedup')
+    op.execute('DROP TABLE followers_dedup')
+
+    with op.batch_alter_table('followers', schema=None) as batch_op:
+        batch_op.alter_column('follower_id',
+               existing_type=sa.Integer(),
+               nullable=False)
+        batch_op.alter_column('followed_id',
+               existing_type=sa.Integer(),
+               nullable=False)
+        batch_op.create_primary_key('pk_followers', ['follower_id', 'followed_id'])
+        batch_op.create_index('ix_followers_followed_id', ['followed_id', 'follower_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('followers', schema=None) as batch_op:
+        batch_op.drop_index('ix_followers_followed_id')
+        batch_op.drop_constraint('pk_followers', type_='primary')
+        batch_op.alter_column('followed_id',
+               existing_type=sa.Integer(),
+               nullable=True)
+        batch_op.alter_column('follower_id',
+               existing_type=sa.Integer(),
+               nullable=True)
@@ -0,0 +1,64 @@
+"""api token table
+
+Revision ID: 93b0256af484
+Revises: d3a8c61f4e27
+Create Date: 2026-10-19 13:40:44.857104
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '93b0256af484'
+down_revision = 'd3a8c61f4e27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('api_token',
+    sa.Column('token_hash', sa.String(length=64), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('expiration', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('token_hash')
+    )
+    with op.batch_alter_table('api_token', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_api_token_user_id'), ['user_id'], unique=False)
+
+    # the tokens users have now keep working
+    op.execute('INSERT INTO api_token (token_hash, user_id, expiration) '
+               'SELECT token_hash, id, token_expiration FROM "user" WHERE token_hash IS NOT NULL')
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_index('ix_user_token_hash')
+        batch_op.drop_column('token_hash')
+        batch_op.drop_column('token_expiration')
+
+
+def downgrade():
+    # a user has one token again, the others stop working
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('token_expiration', sa.DateTime(), nullable=True))
+        batch_op.add_column(sa.Column('token_hash', sa.String(length=64), nullable=True))
+        batch_op.create_index('ix_user_token_hash', ['token_hash'], unique=True)
+
+    api_token = sa.table('api_token', sa.column('token_hash', sa.String), sa.column('user_id', sa.Integer),
+                         sa.column('expiration', sa.DateTime))
+    user = sa.table('user', sa.column('id', sa.Integer), sa.column('token_hash', sa.String),
+                    sa.column('token_expiration', sa.DateTime))
+    connection = op.get_bind()
+    latest = {}
+    for token_hash, user_id, expiration in connection.execute(
+            sa.select(api_token.c.token_hash, api_token.c.user_id, api_token.c.expiration)
+            .order_by(api_token.c.expiration)).all():
+        latest[user_id] = token_hash, expiration
+    for user_id, (token_hash, expiration) in latest.items():
+        connection.execute(user.update().where(user.c.id == user_id)
+                           .values(token_hash=token_hash, token_expiration=expiration))
+
+    with op.batch_alter_table('api_token', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_api_token_user_id'))
+
+    op.drop_table('api_token')
@@ -0,0 +1,35 @@
+"""email digest
+
+Revision ID: b7e2f49c1d38
+Revises: e5d1a9c3b7f4
+Create Date: 2026-10-19 15:12:08.604217
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from hashlib import md5
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e2f49c1d38'
+down_revision = 'e5d1a9c3b7f4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('email_digest', sa.String(length=32), nullable=True))
+
+    # not every database has md5(), so existing users are filled in here
+    user = sa.table('user', sa.column('id', sa.Integer), sa.column('email', sa.String),
+                    sa.column('email_digest', sa.String))
+    connection = op.get_bind()
+    for user_id, email in connection.execute(sa.select(user.c.id, user.c.email)).all():
+        digest = md5((email or '').lower().encode('utf-8')).hexdigest()
+        connection.execute(user.update().where(user.c.id == user_id).values(email_digest=digest))
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('email_digest')
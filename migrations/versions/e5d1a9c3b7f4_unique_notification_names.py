@@ -0,0 +1,31 @@
+"""unique notification names
+
+Revision ID: e5d1a9c3b7f4
+Revises: c41f7b3e9a02
+Create Date: 2026-10-19 13:02:41.310558
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5d1a9c3b7f4'
+down_revision = 'c41f7b3e9a02'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # keep only the newest notification of each name, as add_notification used to leave it
+    op.execute('DELETE FROM notification WHERE id NOT IN '
+               '(SELECT MAX(id) FROM notification GROUP BY user_id, name)')
+    with op.batch_alter_table('notification', schema=None) as batch_op:
+        batch_op.drop_index('ix_notification_user_id_name')
+        batch_op.create_index('ix_notification_user_id_name', ['user_id', 'name'], unique=True)
+
+
+def downgrade():
+    with op.batch_alter_table('notification', schema=None) as batch_op:
+        batch_op.drop_index('ix_notification_user_id_name')
+        batch_op.create_index('ix_notification_user_id_name', ['user_id', 'name'], unique=False)
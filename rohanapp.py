@@ -1,9 +1,10 @@
 from app import create_app, db, cli
-from app.models import User, Post, Message, Notification, Task
+from app.models import User, Post, Message, Notification, Task, Conversation
 
 app = create_app()
 cli.register(app)
 
 @app.shell_context_processor
 def make_shell_context():
-    return {'db': db, 'User': User, 'Post': Post, 'Message': Message, 'Notification': Notification, 'Task': Task}
\ No newline at end of file
+    return {'db': db, 'User': User, 'Post': Post, 'Message': Message, 'Notification': Notification, 'Task': Task,
+            'Conversation': Conversation}
\ No newline at end of file
@@ -1,13 +1,143 @@
 from datetime import datetime, timedelta
+from hashlib import md5
+import fnmatch
+import json
+import os
+import smtplib
+import tempfile
+import time
 import unittest
-from app import create_app, db
-from app.models import User, Post
+from unittest import mock
+import redis
+from app import create_app, db, mail
+from app.email import send_email, get_dispatcher, send_messages, drain_outbox, MailError, OUTBOX_KEY, DEAD_LETTER_KEY
+from app.models import User, Post, Conversation, Notification, Task, load_user
+from app import suggestions, language, user_cache, scheduler, forking, lookup_tables, follow_cache, task_queues
+from app import profiler, cli, query_cache, task_status, tasks
+from collections import Counter
+from app.replicas import replica
+from app.avatars import email_digest
+from flask import session
+from flask_mail import Message
 from config import Config
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
 
+class ProfilerConfig(TestConfig):
+    PROFILER_TOKEN = 'secret'
+
+class ReplicaConfig(TestConfig):
+    DATABASE_REPLICA_URL = 'sqlite://' # a second, empty, database
+
+class FakeRedis(object):
+    # the few commands these tests need, kept in a dict as there's no Redis server in the tests;
+    # the task slot scripts are run as their Python equivalents
+    def __init__(self):
+        self.data = {}
+        self.expiries = {}
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+            self.expiries.pop(key, None)
+
+    def exists(self, key):
+        return int(key in self.data)
+
+    def incr(self, key):
+        self.data[key] = self.data.get(key, 0) + 1
+        return self.data[key]
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value if isinstance(value, bytes) else str(value).encode() # as Redis returns it
+        if ex:
+            self.expiries[key] = ex
+        return True
+
+    def expire(self, key, seconds):
+        if key in self.data:
+            self.expiries[key] = seconds
+        return key in self.data
+
+    def ttl(self, key):
+        return self.expiries.get(key, -1) if key in self.data else -2
+
+    def scan_iter(self, match=None, count=None):
+        return [key for key in list(self.data) if fnmatch.fnmatchcase(key, match or '*')]
+
+    def hincrby(self, key, field, amount=1):
+        fields = self.data.setdefault(key, {})
+        fields[field] = fields.get(field, 0) + amount
+
+    def hincrbyfloat(self, key, field, amount):
+        fields = self.data.setdefault(key, {})
+        fields[field] = fields.get(field, 0.0) + amount
+
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[field] = value
+
+    def hget(self, key, field):
+        return self.data.get(key, {}).get(field)
+
+    def hgetall(self, key):
+        return {field.encode(): str(value).encode() for field, value in self.data.get(key, {}).items()}
+
+    def hdel(self, key, *fields):
+        for field in fields:
+            self.data.get(key, {}).pop(field, None)
+
+    def register_script(self, script):
+        return {task_queues._ACQUIRE: self._acquire, task_queues._RELEASE: self._release,
+                query_cache._INVALIDATE: self._invalidate, scheduler._ADVANCE: self._advance}[script]
+
+    def _advance(self, keys, args):
+        if (self.data.get(keys[0]) or b'').decode() != args[0]:
+            return 0
+        self.data[keys[0]] = args[1].encode()
+        return 1
+
+    def _invalidate(self, keys, args):
+        self.incr(keys[0])
+        for key in keys[1:]:
+            self.data[key] = self.data[keys[0]]
+
+    def _acquire(self, keys, args):
+        if self.data.get(keys[0], 0) >= args[0]:
+            return 0
+        self.data[keys[0]] = self.data.get(keys[0], 0) + 1
+        return 1
+
+    def _release(self, keys):
+        self.data[keys[0]] = self.data.get(keys[0], 0) - 1
+        if self.data[keys[0]] <= 0:
+            del self.data[keys[0]]
+
+class FakePipeline(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.calls = []
+
+    def __getattr__(self, name):
+        command = getattr(self.connection, name)
+        return lambda *args, **kwargs: self.calls.append((command, args, kwargs))
+
+    def execute(self):
+        calls, self.calls = self.calls, []
+        return [command(*args, **kwargs) for command, args, kwargs in calls]
+
 class UserModelCase(unittest.TestCase):
     def setUp(self):
         self.app = create_app(TestConfig)
@@ -27,10 +157,49 @@ class UserModelCase(unittest.TestCase):
         self.assertFalse(u.check_password('dog'))
         self.assertTrue(u.check_password('cat'))
 
+    def test_password_rehash(self):
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+        u = User(username='susan')
+        u.set_password('cat')
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+        self.app.config['PASSWORD_HASH_METHOD'] = 'scrypt:16384:8:1'
+        self.assertFalse(u.check_password('dog'))
+        self.assertTrue(u.password_hash.startswith('pbkdf2:')) # only upgraded after a successful check
+        self.assertTrue(u.check_password('cat'))
+        self.assertTrue(u.password_hash.startswith('scrypt:16384:8:1$'))
+        self.assertTrue(u.check_password('cat'))
+
     def test_avatar(self):
         u = User(username='john', email='john@example.com')
         self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/d4c74594d841139328695756648b6bd6?d=identicon&s=128'))
 
+    def test_local_avatar(self):
+        u = User(username='john', email='john@example.com')
+        u.email = 'John@Example.org'
+        self.assertEqual(u.email_digest, md5(b'john@example.org').hexdigest())
+        db.session.add(u)
+        db.session.commit()
+        with tempfile.TemporaryDirectory() as directory:
+            self.app.config.update(LOCAL_AVATARS=True, AVATAR_DIR=directory)
+            with self.app.test_request_context():
+                url = u.avatar(60) # the next size that is drawn
+            self.assertEqual(url, '/avatar/{}/64.png'.format(u.email_digest))
+            client = self.app.test_client()
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.data.startswith(b'\x89PNG'))
+            self.assertIn('immutable', response.headers['Cache-Control'])
+            path = os.path.join(directory, u.email_digest[:2], '{}-64.png'.format(u.email_digest))
+            self.assertTrue(os.path.exists(path))
+            self.assertEqual(client.get('/avatar/{}/65.png'.format(u.email_digest)).status_code, 404)
+            self.assertEqual(client.get('/avatar/{}/64.png'.format('0' * 32)).status_code, 404) # no such user
+            self.assertFalse(os.path.exists(os.path.join(directory, '00')))
+
+            u.email = 'john@example.net'
+            db.session.commit()
+            self.assertEqual(scheduler.prune_avatars(), 1) # the old email's avatar
+            self.assertFalse(os.path.exists(path))
+
     def test_follow(self):
         u1 = User(username='john', email='john@example.com') # probably don't need email for this test
         u2 = User(username='susan', email='susan@example.com')
@@ -54,6 +223,35 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.followed.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
 
+    def test_follow_changes_after_rollback(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        with mock.patch('app.follow_cache.apply_changes') as apply_changes, \
+                mock.patch('app.suggestions.schedule_update'):
+            u1.follow(u2)
+            u1.about_me = 'hello'
+            db.session.flush()
+            db.session.rollback() # the pending changes are forgotten, not applied by the next commit
+            self.assertNotIn('follow_changes', db.session.info)
+            self.assertNotIn('changed_users', db.session.info)
+            db.session.commit()
+            apply_changes.assert_not_called()
+            u1.follow(u2)
+            db.session.commit()
+            apply_changes.assert_called_once_with([(u1.id, u2.id, True)])
+
+    def test_follow_cache_apply(self):
+        client = self.app.__dict__['redis'] = mock.MagicMock() # in place of the app's client
+        follow_cache.apply_changes([(1, 2, True), (1, 3, False)])
+        script = client.register_script.return_value
+        self.assertEqual([(call.kwargs['keys'], call.kwargs['args']) for call in script.call_args_list],
+                         [(['followed:1'], ['sadd', 2]), (['followed:1'], ['srem', 3])])
+        client.pipeline.return_value.execute.side_effect = redis.exceptions.RedisError
+        follow_cache.apply_changes([(1, 2, True)])
+        client.delete.assert_called_once_with('followed:1') # dropped rather than left stale
+
     def test_follow_posts(self):
         # create four users
         u1 = User(username='john', email='john@example.com') # probably don't need email for this test
@@ -88,5 +286,525 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_follow_suggestion_counts(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        u4 = User(username='david', email='david@example.com')
+        db.session.add_all([u1, u2, u3, u4])
+        db.session.commit()
+        u1.follow(u2)  # john follows susan and mary
+        u1.follow(u3)
+        u2.follow(u4)  # both of them follow david
+        u3.follow(u4)
+        u2.follow(u1)  # susan follows john back, who must not be suggested to himself
+        u3.follow(u2)  # mary follows susan, whom john already follows
+        db.session.commit()
+
+        counts = {(user_id, candidate_id): score for user_id, candidate_id, score
+                  in suggestions.second_degree_counts(u1.id, u1.id)}
+        self.assertEqual(counts, {(u1.id, u4.id): 2})
+
+    def test_conversation_summary(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        m1 = u2.send_message(u1, 'hi john', 'en')
+        m2 = u2.send_message(u1, 'are you there?', 'en')
+        m3 = u3.send_message(u1, 'hello from mary', 'en')
+        m4 = u1.send_message(u3, 'hi mary', 'en')
+        db.session.commit()
+        self.assertEqual(u1.new_messages(), 3)
+        self.assertEqual(u3.new_messages(), 1)
+        received = Conversation.query.filter_by(user_id=u1.id).order_by(Conversation.other_id).all()
+        self.assertEqual([c.last_received for c in received], [m2, m3])
+        self.assertEqual(received[1].last_sent, m4)
+        self.assertEqual(set(u1.all_messages_with_other(u3)), {m3, m4})
+        self.assertEqual(u3.all_messages_with_other(u1).count(), 2)
+
+        u1.mark_messages_read()
+        db.session.commit()
+        self.assertEqual(u1.new_messages(), 0)
+
+        # rebuilding from the message table gives the same summaries
+        Conversation.backfill()
+        db.session.commit()
+        self.assertEqual(Conversation.query.count(), 4)
+        self.assertEqual(u1.new_messages(), 0)
+        self.assertEqual(u3.new_messages(), 1)
+        self.assertEqual(Conversation.query.filter_by(user_id=u2.id).one().last_sent, m2)
+
+    def test_language_detection(self):
+        texts = ['Hello there, how are you doing today my friend?',
+                 'Hola, como estas hoy amigo mio? Espero que bien.',
+                 'Olá, tudo bem com você? Estou muito feliz hoje',
+                 'Привет, как дела? У меня все хорошо, спасибо',
+                 'hi']
+        for text in texts:
+            self.assertEqual(language.TrigramDetector()(text), language.GuessLanguageDetector()(text))
+        self.assertEqual(language.detect_language('hi'), '')
+
+        self.app.config['LANGUAGE_DETECTION_DEFERRED'] = True
+        u = User(username='john', email='john@example.com')
+        p = Post(body=texts[1], author=u, language=language.language_for_new(texts[1]))
+        db.session.add_all([u, p])
+        db.session.commit()
+        self.assertIsNone(p.language)
+        self.assertEqual(language.backfill(Post), 1)
+        self.assertEqual(p.language, 'es')
+
+    def test_mail_dispatcher(self):
+        with mail.record_messages() as outbox:
+            for i in range(5):
+                send_email('subject {}'.format(i), sender='admin@example.com', recipients=['john@example.com'],
+                           text_body='text', html_body='<p>html</p>')
+            get_dispatcher().join()
+        self.assertEqual(sorted(msg.subject for msg in outbox), ['subject {}'.format(i) for i in range(5)])
+
+    def _payload(self, subject):
+        return {'subject': subject, 'sender': 'admin@example.com', 'recipients': ['john@example.com'],
+                'text_body': 'text', 'html_body': '<p>html</p>', 'attachments': None}
+
+    def test_mail_backpressure(self):
+        # a full queue or an unavailable outbox never makes the request send, or fail
+        self.app.config['MAIL_QUEUE_SIZE'] = 1
+        client = self.app.__dict__['redis'] = mock.MagicMock()
+        with mock.patch('app.email.send_messages') as send, mock.patch('app.task_queues.enqueue'), \
+                mock.patch('app.email.MailDispatcher._start'): # no threads to take from the queue
+            get_dispatcher().queue.put_nowait(Message('waiting'))
+            send_email('full', sender='admin@example.com', recipients=['john@example.com'],
+                       text_body='text', html_body='<p>html</p>')
+            self.assertEqual(json.loads(client.rpush.call_args.args[1])['subject'], 'full')
+            self.app.config['MAIL_QUEUE'] = 'rq'
+            client.rpush.side_effect = redis.exceptions.ConnectionError()
+            send_email('dropped', sender='admin@example.com', recipients=['john@example.com'],
+                       text_body='text', html_body='<p>html</p>')
+            send.assert_not_called()
+
+    def test_mail_refused(self):
+        def send(msg):
+            if msg.subject == 'bad':
+                raise smtplib.SMTPRecipientsRefused({'john@example.com': (550, b'no such user')})
+            sent.append(msg.subject)
+        sent = []
+        with mock.patch.object(mail, 'connect') as connect:
+            connect.return_value.__enter__.return_value.send.side_effect = send
+            messages = [Message(subject, recipients=['john@example.com']) for subject in ['a', 'bad', 'b']]
+            self.assertEqual(send_messages(messages), 2) # the refused one is skipped, not retried
+        self.assertEqual(sent, ['a', 'b'])
+        self.assertEqual(connect.call_count, 1)
+
+    def test_mail_outbox_requeue(self):
+        self.app.config['MAIL_MAX_RETRIES'] = 0
+        client = self.app.__dict__['redis'] = mock.MagicMock()
+        client.lpop.return_value = [json.dumps(self._payload(subject)) for subject in ['a', 'b', 'c']]
+        def send(msg):
+            if msg.subject == 'b':
+                raise smtplib.SMTPServerDisconnected()
+        with mock.patch.object(mail, 'connect') as connect:
+            connect.return_value.__enter__.return_value.send.side_effect = send
+            self.assertRaises(MailError, drain_outbox)
+            pipe = client.pipeline.return_value
+            pipe.lpush.assert_called_once_with(OUTBOX_KEY, json.dumps(self._payload('c'))) # 'a' was sent
+            self.assertEqual(json.loads(pipe.rpush.call_args.args[1]), dict(self._payload('b'), attempts=1))
+
+            pipe.reset_mock()
+            failing = dict(self._payload('b'), attempts=self.app.config['MAIL_MAX_ATTEMPTS'] - 1)
+            client.lpop.return_value = [json.dumps(failing)]
+            self.assertRaises(MailError, drain_outbox)
+            self.assertEqual(pipe.rpush.call_args.args[0], DEAD_LETTER_KEY)
+
+    def test_api_tokens(self):
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        client = self.app.test_client()
+        self.assertEqual(client.get('/api/users').status_code, 401)
+        self.assertEqual(client.post('/api/tokens', auth=('john', 'dog')).status_code, 401)
+
+        token = client.post('/api/tokens', auth=('john', 'cat')).get_json()['token']
+        self.assertNotIn(token, u.password_hash + u.api_tokens.first().token_hash) # only stored hashed
+        headers = {'Authorization': 'Bearer ' + token}
+        self.assertEqual(client.get('/api/users/{}'.format(u.id), headers=headers).get_json()['username'], 'john')
+        other = {'Authorization': 'Bearer ' + client.post('/api/tokens', auth=('john', 'cat')).get_json()['token']}
+        self.assertEqual(client.get('/api/users', headers=headers).status_code, 200) # a second client's token
+
+        self.assertEqual(client.delete('/api/tokens', headers=headers).status_code, 204)
+        self.assertEqual(client.get('/api/users', headers=headers).status_code, 401)
+        self.assertEqual(client.get('/api/users', headers=other).status_code, 200) # only the one used was revoked
+
+    def test_api_token_limit(self):
+        self.app.config['API_TOKENS_PER_USER'] = 2
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        expired = u.get_token(expires_in=-1)
+        first = u.get_token(expires_in=100)
+        second = u.get_token(expires_in=200)
+        third = u.get_token(expires_in=300)
+        db.session.commit()
+        self.assertEqual(u.api_tokens.count(), 2) # the expired one dropped, the oldest revoked
+        self.assertEqual([User.check_token(token) for token in [expired, first, second, third]], [None, None, u, u])
+
+    def test_token_forgotten_after_commit(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        token = u.get_token()
+        db.session.commit()
+        token_hash = u.api_tokens.first().token_hash
+        with mock.patch('app.token_cache.forget') as forget:
+            u.revoke_token(token)
+            forget.assert_not_called() # a concurrent request could still cache the old row
+            db.session.rollback()
+            u.revoke_token(token)
+            db.session.commit()
+            forget.assert_called_once_with(token_hash)
+        self.assertIsNone(User.check_token(token))
+
+    def test_task_slots(self):
+        connection = self.app.__dict__['redis'] = FakeRedis()
+        with mock.patch('app.task_queues.enqueue') as enqueue:
+            job = task_queues.launch('export_posts', 1)
+            self.assertIsNotNone(job)
+            self.assertIsNone(task_queues.launch('export_posts', 1)) # one per user
+            self.assertIsNotNone(task_queues.launch('export_posts', 2))
+            self.assertNotIn('retry', enqueue.call_args.kwargs) # failures aren't retried
+            task_queues.release('export_posts', 1)
+            self.assertIsNotNone(task_queues.launch('export_posts', 1))
+            failed = mock.Mock(meta={'task_name': 'export_posts', 'user_id': 2})
+            with mock.patch('app.metrics.job_failed'):
+                task_queues.release_after_failure(failed, connection, ValueError, ValueError(), None)
+            self.assertIsNone(connection.get(task_queues._user_key('export_posts', 2)))
+
+    def test_task_concurrency(self):
+        from rq import Retry
+        connection = self.app.__dict__['redis'] = FakeRedis()
+        connection.data[task_queues._running_key('export_posts')] = 2 # as many as may run
+        connection.data[task_queues._user_key('export_posts', 1)] = 1
+        job = mock.Mock(meta={'task_name': 'export_posts', 'user_id': 1})
+        run = mock.Mock()
+        with mock.patch('rq.get_current_job', return_value=job):
+            self.assertIsInstance(task_queues.run_limited('export_posts', run), Retry)
+            run.assert_not_called()
+            self.assertEqual(connection.get(task_queues._user_key('export_posts', 1)), 1) # still held
+            job.meta['deferred'] = self.app.config['TASK_LIMIT_RETRIES']
+            self.assertRaises(task_queues.TaskLimitReached, task_queues.run_limited, 'export_posts', run)
+            del connection.data[task_queues._running_key('export_posts')]
+            task_queues.run_limited('export_posts', run, 42)
+            run.assert_called_once_with(42)
+            self.assertIsNone(connection.get(task_queues._running_key('export_posts'))) # given back
+
+    def test_task_progress(self):
+        from rq.job import Job
+        from rq.serializers import resolve_serializer
+        connection = self.app.__dict__['redis'] = FakeRedis()
+        connection.data[Job.key_for('running')] = {'meta': resolve_serializer().dumps({'progress': 40})}
+        self.assertEqual(task_status.get_progress(['running', 'gone']), {'running': 40, 'gone': 100}) # gone is done
+
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        self.assertEqual(u.get_tasks_in_progress(), [])
+        self.assertIs(task_status.has_tasks_in_progress(u.id), False) # the next page skips the query
+        with mock.patch('app.task_queues.enqueue', return_value=mock.Mock(get_id=lambda: 'export')):
+            task = u.launch_task('export_posts', 'Exporting posts...')
+        db.session.commit()
+        self.assertIs(task_status.has_tasks_in_progress(u.id), True)
+        self.assertEqual(u.get_tasks_in_progress(), [task])
+        with mock.patch('app.tasks.get_current_job', return_value=mock.Mock(meta={}, get_id=lambda: 'export')):
+            tasks._set_task_progress(100)
+        self.assertIsNone(task_status.has_tasks_in_progress(u.id)) # cleared, so the next page looks again
+        self.assertTrue(task.complete)
+        self.assertEqual(u.get_tasks_in_progress(), [])
+
+    def test_cached_user_loader(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        self.assertEqual(load_user(str(u.id)), u)
+        db.session.remove()
+
+        statements = []
+        db.event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        u = load_user(str(u.id)) # from the cache, attached to the new session without a query
+        self.assertEqual(u.username, 'john')
+        self.assertEqual(statements, [])
+
+        u.about_me = 'hello'
+        db.session.commit()
+        self.assertIsNone(user_cache.get(u.id))
+        self.assertEqual(load_user(str(u.id)).about_me, 'hello')
+
+    def test_notification_upsert(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        u.add_notification('unread_message_count', 1)
+        u.add_notification('unread_message_count', 2)
+        db.session.commit()
+        self.assertEqual([(n['name'], n['data']) for n in u.notifications_since(0)],
+                         [('unread_message_count', 2)])
+
+    def test_prune_notifications(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        u.add_notification('unread_message_count', 1)
+        db.session.add(Notification(name='task_progress', payload_json='{}', user=u,
+                                    timestamp=time.time() - self.app.config['NOTIFICATION_RETENTION'] - 1))
+        db.session.commit()
+        self.assertEqual(scheduler.prune_notifications(), 1)
+        self.assertEqual([n.name for n in u.notifications], ['unread_message_count'])
+
+    def test_prune_tasks(self):
+        connection = self.app.__dict__['redis'] = FakeRedis()
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([Task(id='expired', name='export_posts', user=u, complete=True),
+                            Task(id='kept', name='export_posts', user=u, complete=True),
+                            Task(id='running', name='export_posts', user=u, complete=False)])
+        db.session.commit()
+        connection.data[b'rq:job:kept'] = {}
+        self.assertEqual(scheduler.prune_tasks(batch_size=1), 1)
+        self.assertEqual(sorted(task.id for task in Task.query), ['kept', 'running'])
+
+    def test_compact_redis(self):
+        connection = self.app.__dict__['redis'] = FakeRedis()
+        connection.set('user:1', 'forever')
+        connection.set('user:2', 'expires', ex=10)
+        connection.set('lookup:other', 'not a cache key')
+        self.assertEqual(scheduler.compact_redis(), 1)
+        self.assertEqual(connection.ttl('user:1'), self.app.config['SCHEDULER_KEY_TTLS']['user:*'])
+        self.assertEqual(connection.ttl('user:2'), 10)
+        self.assertEqual(connection.ttl('lookup:other'), -1)
+
+    def test_scheduler_chain(self):
+        from rq.exceptions import NoSuchJobError
+        from rq.job import JobStatus
+        connection = self.app.__dict__['redis'] = FakeRedis()
+        self.app.config['SCHEDULER_JOBS'] = {'prune_tasks': 3600, 'compact_redis': 0}
+        with mock.patch('app.task_queues.enqueue') as enqueue, \
+                mock.patch('app.task_queues.enqueue_in') as enqueue_in, \
+                mock.patch('app.scheduler.Job.fetch') as fetch, \
+                mock.patch('app.scheduler.run_job') as run_job:
+            self.assertTrue(scheduler.start())
+            first = enqueue.call_args.kwargs['job_id']
+            self.assertEqual(connection.get(scheduler.TICK_KEY), first.encode())
+            fetch.return_value.get_status.return_value = JobStatus.SCHEDULED
+            self.assertFalse(scheduler.start()) # the chain's next tick is waiting
+            fetch.side_effect = NoSuchJobError
+            self.assertTrue(scheduler.start()) # it was lost, so a new chain replaces the old one
+            second = enqueue.call_args.kwargs['job_id']
+            self.assertNotEqual(second, first)
+
+            with mock.patch('app.scheduler.get_current_job', return_value=mock.Mock(id=first)):
+                self.assertEqual(scheduler.tick(), []) # the replaced chain ends
+            enqueue_in.assert_not_called()
+            with mock.patch('app.scheduler.get_current_job', return_value=mock.Mock(id=second)):
+                self.assertEqual(scheduler.tick(), ['prune_tasks'])
+            third = enqueue_in.call_args.kwargs['job_id']
+            self.assertEqual(connection.get(scheduler.TICK_KEY), third.encode())
+            with mock.patch('app.scheduler.get_current_job', return_value=mock.Mock(id=third)):
+                self.assertEqual(scheduler.tick(), []) # prune_tasks holds its lease
+            self.assertEqual(enqueue_in.call_count, 2)
+            run_job.assert_called_once_with('prune_tasks')
+
+    def test_server_timing(self):
+        self.assertNotIn('Server-Timing', self.app.test_client().get('/auth/login').headers) # opt-in
+        self.app.config['SERVER_TIMING'] = True
+        response = self.app.test_client().get('/auth/login')
+        timing = response.headers['Server-Timing']
+        self.assertIn('template;dur=', timing)
+        self.assertIn('total;dur=', timing)
+
+    def test_metrics(self):
+        self.app.config['METRICS_FLUSH_INTERVAL'] = 0 # every request flushes
+        client = self.app.test_client()
+        self.assertEqual(client.get('/metrics').status_code, 404) # no token configured, so not public
+        self.app.config['METRICS_TOKEN'] = 'secret'
+        self.assertEqual(client.get('/metrics').status_code, 401)
+        client.environ_base['HTTP_AUTHORIZATION'] = 'Bearer secret'
+        self.assertEqual(client.get('/metrics').status_code, 503) # Redis is unavailable
+        self.app.__dict__['redis'] = FakeRedis()
+        self.app.__dict__['task_queues'] = {}
+        for i in range(3):
+            client.get('/auth/login')
+        text = client.get('/metrics').get_data(as_text=True)
+        self.assertIn('rohanapp_requests_total{endpoint="auth.login",method="GET",status="200"} 3', text)
+        buckets = [int(line.split()[1]) for line in text.splitlines()
+                   if line.startswith('rohanapp_request_duration_seconds_bucket{endpoint="auth.login"')]
+        self.assertEqual(len(buckets), len(self.app.config['METRICS_BUCKETS']) + 1)
+        self.assertEqual(buckets, sorted(buckets)) # cumulative
+        self.assertEqual(buckets[-1], 3)
+        self.assertIn('rohanapp_request_duration_seconds_count{endpoint="auth.login"} 3', text)
+        self.assertIn('rohanapp_request_duration_seconds_sum{endpoint="auth.login"} ', text)
+        self.assertIn('rohanapp_sql_statements_total{endpoint="auth.login"} ', text)
+
+    def test_profiler(self):
+        app = create_app(ProfilerConfig)
+        with tempfile.TemporaryDirectory() as directory:
+            app.config.update(PROFILER_DIR=directory, PROFILER_MAX_FILES=2)
+            sampler = app.extensions['profiler']
+            client = app.test_client()
+            with mock.patch.object(sampler, 'register') as register, \
+                    mock.patch.object(sampler, 'unregister', return_value=Counter({'a;b': 3, 'a': 1})):
+                client.get('/auth/login')
+                client.get('/auth/login', headers={'X-Profile': 'wrong'})
+                register.assert_not_called()
+                for i in range(3):
+                    client.get('/auth/login', headers={'X-Profile': 'secret'})
+                self.assertEqual(register.call_count, 3)
+            self.assertEqual(len(os.listdir(os.path.join(directory, 'auth.login'))), 2) # the oldest was pruned
+            cli.register(app) # as rohanapp.py does
+            result = app.test_cli_runner().invoke(args=['profile', 'top'])
+            self.assertIn('8 samples from 2 profiles', result.output)
+            self.assertIn('b\n', result.output)
+            output = os.path.join(directory, 'flamegraph.svg')
+            result = app.test_cli_runner().invoke(args=['profile', 'flamegraph', '--output', output])
+            self.assertIn('Wrote', result.output)
+            with open(output) as f:
+                self.assertIn('8 samples', f.read())
+
+    def test_request_id(self):
+        client = self.app.test_client()
+        self.assertEqual(client.get('/auth/login', headers={'X-Request-ID': 'abc'}).headers['X-Request-ID'], 'abc')
+        self.assertEqual(len(client.get('/auth/login').headers['X-Request-ID']), 32)
+        unsafe = client.get('/auth/login', headers={'X-Request-ID': 'abc\tdef' + 'x' * 100}).headers['X-Request-ID']
+        self.assertEqual(len(unsafe), 32) # replaced, not logged or echoed
+
+    def test_worker_app(self):
+        from flask import current_app
+        from app.worker import Worker
+        import app.tasks
+        self.assertFalse(hasattr(app.tasks, 'app')) # importing the tasks creates no app
+        with mock.patch('rq.Worker.__init__', return_value=None):
+            worker = Worker()
+        try:
+            self.assertIs(current_app._get_current_object(), worker.app)
+        finally:
+            worker.app_context.pop()
+        self.assertIs(current_app._get_current_object(), self.app)
+
+    def test_after_fork(self):
+        dispatcher = get_dispatcher()
+        recorder = self.app.extensions['metrics']
+        self.app.redis.connection_pool # made on first use
+        forking.after_fork(self.app)
+        self.assertNotIn('mail_dispatcher', self.app.extensions)
+        self.assertIsNot(get_dispatcher(), dispatcher)
+        self.assertIsNot(self.app.extensions['metrics'], recorder)
+
+    def test_replica_routing(self):
+        app = create_app(ReplicaConfig)
+        try:
+            with app.app_context():
+                db.create_all()
+                db.metadata.create_all(db.engines['replica'])
+                db.session.add(User(username='susan', email='susan@example.com'))
+                db.session.commit() # not on the replica, as if it lagged behind
+                read = replica(lambda: User.query.filter_by(username='susan').first())
+                with app.test_request_context():
+                    self.assertIsNone(read())
+                with app.test_request_context():
+                    db.session.add(User(username='david', email='david@example.com'))
+                    db.session.commit()
+                    self.assertIn('db_written', session) # this client reads from the primary for a while
+                    self.assertIsNotNone(read())
+                db.session.remove()
+        finally:
+            del db.metadatas['replica'] # made for the bind, the other tests' apps have no such bind
+
+    def test_query_cache_tags(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        self.assertEqual(User.get_by_username('john'), u1)
+        self.assertIsNone(User.get_by_username('david'))
+        u1.username = 'david'
+        u1.follow(u2)
+        db.session.flush()
+        self.assertLessEqual({'username:john', 'username:david', 'followers:{}'.format(u2.id),
+                              'followed:{}'.format(u1.id)}, db.session.info['cache_tags'])
+        db.session.commit() # drops the cached results with these tags
+        self.assertNotIn('cache_tags', db.session.info)
+        self.assertEqual(User.get_by_username('david'), u1)
+        self.assertEqual(u2.follower_count(), 1)
+
+    def test_query_cache_versions(self):
+        connection = self.app.__dict__['redis'] = FakeRedis()
+        tag_key = query_cache._tag_key('posts:1')
+        query_cache.invalidate('posts:1')
+        self.assertEqual(query_cache.get('post_count', [1], ['posts:1'], lambda: 5), 5)
+        self.assertEqual(query_cache.get('post_count', [1], ['posts:1'], lambda: 6), 5)
+        del connection.data[tag_key] # expired, before the next change to the posts
+        query_cache.invalidate('posts:1')
+        self.assertEqual(query_cache.get('post_count', [1], ['posts:1'], lambda: 6), 6) # not the same version again
+
+    def test_lookup_table(self):
+        users = [(i, 'user{}'.format(i), email_digest('User{}@Example.com'.format(i))) for i in range(1, 200) if i != 7]
+        users.append((1000, 'josé', email_digest('jose@example.com')))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'users.table')
+            lookup_tables.write_table(path, users)
+            table = lookup_tables.Table(path)
+            self.assertEqual(table.user_id('user42'), 42)
+            self.assertEqual(table.user_id('josé'), 1000)
+            self.assertIsNone(table.user_id('user7'))
+            self.assertEqual(table.user_summary(3), ('user3', md5(b'user3@example.com').hexdigest()))
+            self.assertIsNone(table.user_summary(7))
+            self.assertIsNone(table.user_summary(5000))
+
+            u = User(username='john', email='John@example.com')
+            db.session.add(u)
+            db.session.commit()
+            db.session.execute(db.update(User).values(email_digest=None)) # as rows inserted without one
+            db.session.commit()
+            user_id = u.id
+            lookup_tables.rebuild(path)
+            self.assertEqual(lookup_tables.Table(path).user_summary(user_id), ('john', email_digest('john@example.com')))
+
+    def _wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.02)
+
+    def test_lookup_tables_enabled(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        post = Post(body="john's post", author=u1)
+        db.session.add_all([u1, u2, post])
+        db.session.commit()
+        self.app.__dict__['redis'] = FakeRedis()
+        with tempfile.TemporaryDirectory() as directory:
+            # tables are off when testing
+            self.app.config.update(TESTING=False, LOOKUP_TABLE_DIR=directory, LOOKUP_TABLE_POLL=0.02)
+            try:
+                with self.app.test_request_context(): # only web requests elect a writer
+                    lookup_tables.user_id('john')
+                    self._wait_for(lambda: lookup_tables.user_id('john') is not None)
+                    self.assertEqual(lookup_tables.user_id('john'), u1.id)
+                    self.assertEqual(User.get_by_username('john'), u1)
+                    self.assertEqual(post.author_summary(), ('john', u1.email_digest))
+                    u1.username = 'david'
+                    db.session.commit() # marks the tables stale, the writer rewrites them
+                    self._wait_for(lambda: lookup_tables.user_id('david') is not None)
+                    self.assertIsNone(lookup_tables.user_id('john'))
+                    self.assertEqual(User.get_by_username('david'), u1)
+                    self.assertIsNone(User.get_by_username('john'))
+            finally:
+                self.app.extensions.pop('lookup_tables', None) # stops the writer thread
+                self.app.config['TESTING'] = True
+
+    def test_lookup_tables_unwritable(self):
+        self.app.config.update(TESTING=False, LOOKUP_TABLE_DIR='/nonexistent/directory')
+        try:
+            with self.app.test_request_context():
+                self.assertIsNone(lookup_tables.user_id('john')) # no table, and no error
+        finally:
+            self.app.extensions.pop('lookup_tables', None)
+            self.app.config['TESTING'] = True
+
 if __name__ == '__main__':
     unittest.main(verbosity=2) # what is verbosity ?
\ No newline at end of file